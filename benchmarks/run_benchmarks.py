@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+import json
+from multiprocessing import Pipe, Process
+from os import devnull
+from os.path import join
+from platform import platform
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from sys import exit, version_info
+from tempfile import mkdtemp
+from time import time
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.sort_seqs import (compute_sequence_stats,
+                                             sort_seqs_by_taxonomic_depth)
+from nested_reference_otus.summarize_taxonomic_agreement import \
+        summarize_taxonomic_agreement
+from nested_reference_otus.unnest import (parse_otu_map, make_nodes,
+        join_nodes, build_nested_tree)
+from nested_reference_otus.nested_reference_workflow import rename_rep_seqs
+from nested_reference_otus.sketch_index import SketchIndex, write_sketch_index
+from synthetic_data import (generate_data, generate_reference_family, mutate,
+                            similarity_thresholds, unknown_keywords)
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Benchmarks the nested_reference_otus tools on synthetic data"""
+script_info['script_description'] = """
+This script generates deterministic synthetic data sets (FASTA, taxonomy map
+and nested OTU maps) at each of the requested scales and measures the run time
+and peak memory use of each benchmarked function on them. Each measurement is
+made in a fresh process so that one benchmark can't affect another. The
+sketch index benchmarks also report how well the LSH prefilter prunes: at
+each query identity, the fraction of the queries that find the reference they
+were mutated from (recall) and the mean fraction of the references that are
+candidates. The results can be written to a JSON file, and compared against a
+JSON file from an earlier run (the baseline) to flag regressions.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Record a baseline",
+"Run every benchmark at 10k and 100k sequences and save the results as a "
+"baseline.",
+"%prog -s 10000,100000 -o baselines/my_machine.json"))
+script_info['script_usage'].append(("Check for regressions",
+"Run the unnest benchmarks and compare them against the baseline. The script "
+"exits with a non-zero status if any benchmark is more than 25% slower or "
+"uses more than 25% more memory than the baseline.",
+"%prog -s 10000,100000 -b join_nodes,build_nested_tree -c "
+"baselines/my_machine.json"))
+script_info['output_description']= """
+A table of the results is printed to stdout, along with any regressions and
+failed benchmarks (which also make the script exit with a non-zero status).
+If an output filepath is given, the results are also written to it as JSON.
+"""
+
+script_info['required_options'] = []
+script_info['optional_options'] = [
+    make_option('-s','--scales',default='10000,100000,1000000',
+        help='comma-separated list of the number of sequences in each '
+        'synthetic data set [default: %default]'),
+    make_option('-d','--data_dir',default='benchmark_data',
+        help='the directory to generate the synthetic data sets in. Data '
+        'sets that were already generated are reused [default: %default]'),
+    make_option('-b','--benchmarks',default=None,
+        help='comma-separated list of the benchmarks to run, from '
+        'compute_sequence_stats, sort_seqs_by_taxonomic_depth, '
+        'summarize_taxonomic_agreement, join_nodes, build_nested_tree, '
+        'rename_rep_seqs, query_sketch_index and query_sketch_index_1_row '
+        '[default: all]'),
+    make_option('-n','--repeats',type='int',default=3,
+        help='the number of times to run each benchmark. The best time and '
+        'memory use are reported [default: %default]'),
+    make_option('-o','--output_fp',
+        help='the filepath to write the results to (as JSON) '
+        '[default: %default]'),
+    make_option('-c','--baseline_fp',
+        help='a results file from an earlier run to compare against '
+        '[default: %default]'),
+    make_option('-t','--tolerance',type='float',default=0.25,
+        help='the relative increase in time or memory over the baseline '
+        'that is flagged as a regression [default: %default]'),
+    make_option('--seed',type='int',default=0,
+        help='the seed used to generate the synthetic data '
+        '[default: %default]')
+]
+script_info['version'] = __version__
+
+# The identities that the sketch index benchmarks query at. The index is
+# built for the first one.
+query_identities = [0.97, 0.94, 0.90]
+
+# Time and memory differences below these are noise, not regressions.
+min_seconds = 0.05
+min_memory_kb = 1024
+
+def _read_lines(fp):
+    return open(fp, 'U').readlines()
+
+def _setup_compute_sequence_stats(fps):
+    fasta_lines = _read_lines(fps['seqs'])
+    tax_map_lines = _read_lines(fps['taxonomy'])
+    return lambda: compute_sequence_stats(fasta_lines, tax_map_lines,
+                                          unknown_keywords)
+
+def _setup_sort_seqs_by_taxonomic_depth(fps):
+    seq_stats = compute_sequence_stats(_read_lines(fps['seqs']),
+                                       _read_lines(fps['taxonomy']),
+                                       unknown_keywords)
+    return lambda: sort_seqs_by_taxonomic_depth(seq_stats)
+
+def _setup_summarize_taxonomic_agreement(fps):
+    otu_map_lines = _read_lines(fps['%d_otu_map' % similarity_thresholds[0]])
+    tax_map_lines = _read_lines(fps['taxonomy'])
+    return lambda: list(summarize_taxonomic_agreement(otu_map_lines,
+                                                      tax_map_lines))
+
+def _parse_levels(fps):
+    last_level = 100
+    parsed = []
+    for level in similarity_thresholds:
+        parsed.append((parse_otu_map(open(fps['%d_otu_map' % level], 'U')),
+                       float(last_level - level), level))
+        last_level = level
+    return parsed
+
+def _setup_join_nodes(fps):
+    parsed = _parse_levels(fps)
+    return lambda: join_nodes([make_nodes(*p) for p in parsed])
+
+def _setup_build_nested_tree(fps):
+    parsed = _parse_levels(fps)
+    return lambda: build_nested_tree(parsed)
+
+def _setup_rename_rep_seqs(fps):
+    def rename():
+        out_f = open(devnull, 'w')
+        for e in rename_rep_seqs(open(fps['rep_set'], 'U')):
+            out_f.write('>%s\n%s\n' % e)
+        out_f.close()
+    return rename
+
+def _setup_query_sketch_index(rows_per_band):
+    """Returns the setup function of a sketch index query benchmark.
+
+    The index holds as many related references (see
+    generate_reference_family) as the rep set has sequences, and is built
+    for query_identities[0]. It is queried with 100 mutants of random
+    references at each of query_identities. The benchmark returns the
+    fraction of the mutants whose reference is a candidate (the recall) and
+    the mean fraction of the references that are candidates at each
+    identity.
+
+    Arguments:
+        rows_per_band - the rows per LSH band of the index, or None to use
+            the default for query_identities[0]
+    """
+    def setup(fps):
+        num_refs = len([line for line in open(fps['rep_set'], 'U')
+                        if line.startswith('>')])
+        fasta = []
+        refs = generate_reference_family(num_refs)
+        for i, ref in enumerate(refs):
+            fasta.extend(['>%d\n' % i, ref + '\n'])
+        index_dir = mkdtemp(prefix='sketch_index')
+        write_sketch_index(fasta, index_dir, rows_per_band=rows_per_band,
+                           min_identity=query_identities[0])
+        index = SketchIndex(index_dir, mmap_mode=None)
+        rmtree(index_dir)
+
+        rng = Random(0)
+        queries = []
+        for identity in query_identities:
+            for i in range(100):
+                ref_idx = rng.randrange(num_refs)
+                queries.append((identity, ref_idx,
+                                mutate(refs[ref_idx], identity, rng)))
+
+        def query():
+            found = dict((identity, 0) for identity in query_identities)
+            candidates = dict((identity, 0) for identity in query_identities)
+            for identity, ref_idx, seq in queries:
+                index.query(seq, identity)
+                rows = index.candidates(index.sketch(seq))
+                found[identity] += ref_idx in rows
+                candidates[identity] += len(rows)
+            stats = {}
+            for identity in query_identities:
+                stats['recall_%d' % (identity * 100)] = found[identity] / 100
+                stats['candidates_%d' % (identity * 100)] = \
+                        candidates[identity] / (100 * num_refs)
+            return stats
+        return query
+    return setup
+
+benchmarks = [
+    ('compute_sequence_stats', _setup_compute_sequence_stats),
+    ('sort_seqs_by_taxonomic_depth', _setup_sort_seqs_by_taxonomic_depth),
+    ('summarize_taxonomic_agreement', _setup_summarize_taxonomic_agreement),
+    ('join_nodes', _setup_join_nodes),
+    ('build_nested_tree', _setup_build_nested_tree),
+    ('rename_rep_seqs', _setup_rename_rep_seqs),
+    ('query_sketch_index', _setup_query_sketch_index(None)),
+    ('query_sketch_index_1_row', _setup_query_sketch_index(1))
+]
+
+def _max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux (but bytes on OS X).
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+def _measure(setup, fps, conn):
+    """Runs a single benchmark in a child process and sends the result."""
+    f = setup(fps)
+    rss_before = _max_rss_kb()
+    start = time()
+    stats = f()
+    seconds = time() - start
+    result = {'seconds': seconds,
+              'memory_kb': max(0, _max_rss_kb() - rss_before)}
+    if isinstance(stats, dict):
+        result['stats'] = stats
+    conn.send(result)
+    conn.close()
+
+def run_benchmark(setup, fps, repeats=3):
+    """Runs a benchmark in a fresh process repeats times.
+
+    Returns a dictionary with the best time (in seconds) and the smallest
+    peak memory growth (in kilobytes) over the repeats. If the benchmarked
+    function returns a dictionary of statistics (which must be the same in
+    every repeat), it is included as 'stats'. Only the call being
+    benchmarked is measured: the time and memory spent loading its inputs
+    (in setup) are not. Returns None if the benchmark failed (its setup or
+    function raised, or its process died) in any of the repeats.
+
+    Arguments:
+        setup - a function that takes the data set filepaths and returns a
+            function (taking no arguments) that runs the benchmark
+        fps - the data set filepaths, as returned by generate_data
+        repeats - the number of times to run the benchmark
+    """
+    best = None
+    for i in range(repeats):
+        parent_conn, child_conn = Pipe(False)
+        process = Process(target=_measure, args=(setup, fps, child_conn))
+        process.start()
+        # Without the parent's copy of the child's end, recv() gets EOF if
+        # the child dies without sending a result.
+        child_conn.close()
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            process.join()
+            return None
+        finally:
+            parent_conn.close()
+        process.join()
+        if best is None:
+            best = result
+        else:
+            best['seconds'] = min(best['seconds'], result['seconds'])
+            best['memory_kb'] = min(best['memory_kb'], result['memory_kb'])
+    return best
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """Compares benchmark results to a baseline.
+
+    Returns a list of regressions, each of which is a tuple containing the
+    scale, benchmark name, metric ('seconds' or 'memory_kb'), baseline value,
+    and observed value. A result is a regression if it exceeds the baseline
+    by more than tolerance (relative to the baseline). Differences too small
+    to be measured reliably are ignored, as are benchmarks and scales that
+    are missing from either the results or the baseline.
+
+    Arguments:
+        results - the results of this run (as written to the JSON file)
+        baseline - the results of an earlier run
+        tolerance - the allowed relative increase over the baseline
+    """
+    regressions = []
+    for scale, scale_results in sorted(results['scales'].items()):
+        scale_baseline = baseline['scales'].get(scale, {})
+        for name, result in sorted(scale_results.items()):
+            if name not in scale_baseline:
+                continue
+            for metric, min_difference in [('seconds', min_seconds),
+                                           ('memory_kb', min_memory_kb)]:
+                expected = scale_baseline[name][metric]
+                observed = result[metric]
+                if observed - expected > max(expected * tolerance,
+                                             min_difference):
+                    regressions.append((scale, name, metric, expected,
+                                        observed))
+    return regressions
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    available = dict(benchmarks)
+    if opts.benchmarks:
+        names = opts.benchmarks.split(',')
+        for name in names:
+            if name not in available:
+                option_parser.error("Unknown benchmark: %s" % name)
+    else:
+        names = [name for name, setup in benchmarks]
+    if opts.repeats < 1:
+        option_parser.error("--repeats must be at least 1")
+
+    results = {'python': '%d.%d.%d' % version_info[:3],
+               'platform': platform(),
+               'seed': opts.seed,
+               'scales': {}}
+    print "scale\tbenchmark\tseconds\tmemory_kb\tstats"
+    failures = []
+    for num_seqs in map(int, opts.scales.split(',')):
+        fps = generate_data(join(opts.data_dir, '%d_seed%d' %
+                                 (num_seqs, opts.seed)),
+                            num_seqs, opts.seed)
+        scale_results = {}
+        for name in names:
+            result = run_benchmark(available[name], fps, opts.repeats)
+            if result is None:
+                failures.append((num_seqs, name))
+                print "%d\t%s\tFAILED" % (num_seqs, name)
+                continue
+            scale_results[name] = result
+            stats = ' '.join(['%s=%.3f' % e for e in
+                              sorted(result.get('stats', {}).items())])
+            print "%d\t%s\t%.3f\t%d\t%s" % (num_seqs, name,
+                    result['seconds'], result['memory_kb'], stats)
+        results['scales'][str(num_seqs)] = scale_results
+
+    if opts.output_fp:
+        output_f = open(opts.output_fp, 'w')
+        json.dump(results, output_f, indent=2, sort_keys=True)
+        output_f.close()
+
+    if opts.baseline_fp:
+        regressions = compare_to_baseline(results,
+                                          json.load(open(opts.baseline_fp)),
+                                          opts.tolerance)
+        for scale, name, metric, expected, observed in regressions:
+            print "REGRESSION: %s at %s seqs: %s %.3f -> %.3f" % (name,
+                    scale, metric, expected, observed)
+    else:
+        regressions = []
+
+    for num_seqs, name in failures:
+        print "FAILED: %s at %d seqs (see its traceback above)" % (name,
+                                                                num_seqs)
+    if regressions or failures:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
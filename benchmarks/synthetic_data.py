@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Generates deterministic synthetic inputs for the benchmark suite."""
+
+from os import makedirs
+from os.path import exists, join
+from random import Random
+
+tax_map_header = "ID Number\tGenBank Number\tNew Taxon String\tSource\n"
+unknown_keywords = ['Incertae_sedis', 'unidentified']
+level_prefixes = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__', 'st__']
+similarity_thresholds = [99, 97, 94]
+
+# Relative frequency of each known taxonomic depth (1-8). Most reference
+# sequences are only classified down to around family or genus.
+depth_weights = [1, 2, 4, 8, 12, 10, 5, 2]
+
+def generate_data(output_dir, num_seqs, seed=0, mean_length=1400,
+                  length_sd=100, num_lineages=None, otu_size_alpha=1.2):
+    """Writes a synthetic data set to output_dir, unless it already exists.
+
+    The same arguments always generate the same data set. The files written
+    are:
+        seqs.fasta - the input sequences
+        taxonomy.txt - a taxonomy map (with header) for every sequence
+        <threshold>_otu_map.txt - nested OTU maps for each of
+            similarity_thresholds, where each map clusters the reps of the
+            map before it
+        rep_set.fasta - the reps of the first OTU map, with headers in the
+            '<otu id> <seq id>' form that pick_rep_set.py writes
+
+    Returns a dictionary mapping each file's name (without extension) to its
+    filepath.
+
+    Arguments:
+        output_dir - the directory to write the data set to
+        num_seqs - the number of sequences to generate
+        seed - the seed for the random number generator
+        mean_length - the mean sequence length
+        length_sd - the standard deviation of the sequence lengths
+        num_lineages - the number of distinct full taxonomy strings. Defaults
+            to one for every 50 sequences
+        otu_size_alpha - the shape parameter of the Pareto distribution that
+            the OTU sizes are drawn from. Smaller values give heavier tails
+    """
+    fps = {'seqs': join(output_dir, 'seqs.fasta'),
+           'taxonomy': join(output_dir, 'taxonomy.txt'),
+           'rep_set': join(output_dir, 'rep_set.fasta')}
+    for threshold in similarity_thresholds:
+        fps['%d_otu_map' % threshold] = join(output_dir,
+                                              '%d_otu_map.txt' % threshold)
+    complete_fp = join(output_dir, 'complete')
+    if exists(complete_fp):
+        return fps
+    if not exists(output_dir):
+        makedirs(output_dir)
+
+    rng = Random(seed)
+    seq_ids = ['%d' % (100000 + i) for i in range(num_seqs)]
+    seq_lengths = dict((seq_id, max(100, int(rng.gauss(mean_length,
+                                                       length_sd))))
+                       for seq_id in seq_ids)
+
+    # Shuffle so that OTU membership isn't correlated with sequence ID.
+    shuffled_ids = seq_ids[:]
+    rng.shuffle(shuffled_ids)
+    otu_maps = []
+    members = shuffled_ids
+    for threshold in similarity_thresholds:
+        otu_map = _cluster(members, rng, otu_size_alpha)
+        otu_maps.append(otu_map)
+        members = [otu_seq_ids[0] for otu_id, otu_seq_ids in otu_map]
+
+    if num_lineages is None:
+        num_lineages = max(1, num_seqs // 50)
+    lineages = _generate_lineages(num_lineages, rng)
+    taxonomy = _assign_taxonomy(otu_maps[0], lineages, rng)
+
+    genome = ''.join(rng.choice('ACGT') for i in range(1 << 20))
+    seqs_f = open(fps['seqs'], 'w')
+    for seq_id in seq_ids:
+        seqs_f.write('>%s\n%s\n' % (seq_id,
+                                    _sequence(genome, seq_lengths[seq_id],
+                                              rng)))
+    seqs_f.close()
+
+    tax_f = open(fps['taxonomy'], 'w')
+    tax_f.write(tax_map_header)
+    for seq_id in seq_ids:
+        tax_f.write('%s\tGB%s\t%s\tsynthetic\n' % (seq_id, seq_id,
+                                                   taxonomy[seq_id]))
+    tax_f.close()
+
+    for threshold, otu_map in zip(similarity_thresholds, otu_maps):
+        otu_map_f = open(fps['%d_otu_map' % threshold], 'w')
+        for otu_id, otu_seq_ids in otu_map:
+            otu_map_f.write('%s\t%s\n' % (otu_id, '\t'.join(otu_seq_ids)))
+        otu_map_f.close()
+
+    rep_set_f = open(fps['rep_set'], 'w')
+    for otu_id, otu_seq_ids in otu_maps[0]:
+        rep_set_f.write('>%s %s\n%s\n' % (otu_id, otu_seq_ids[0],
+                _sequence(genome, seq_lengths[otu_seq_ids[0]], rng)))
+    rep_set_f.close()
+
+    open(complete_fp, 'w').close()
+    return fps
+
+def _cluster(members, rng, alpha):
+    """Groups members into OTUs with Pareto-distributed sizes."""
+    otu_map = []
+    start = 0
+    while start < len(members):
+        size = int(rng.paretovariate(alpha))
+        otu_map.append(('%d' % len(otu_map), members[start:start + size]))
+        start += size
+    return otu_map
+
+def _generate_lineages(num_lineages, rng):
+    """Returns num_lineages full taxonomy paths (lists of 8 names).
+
+    Names are drawn from a small pool at the top levels and a much larger
+    pool at the lower levels, so lineages often share their higher levels.
+    """
+    lineages = []
+    for i in range(num_lineages):
+        lineage = []
+        for level, prefix in enumerate(level_prefixes):
+            # Narrow at the top (few kingdoms), wide at the bottom.
+            num_names = 2 + 3 ** level
+            lineage.append('%s%d' % (prefix, rng.randrange(num_names)))
+        lineages.append(lineage)
+    return lineages
+
+def _assign_taxonomy(otu_map, lineages, rng):
+    """Returns a taxonomy string for every sequence in otu_map.
+
+    Most members of an OTU share the OTU's lineage, so the taxonomic
+    agreement within OTUs is high but not perfect. Each sequence is only
+    known down to a depth drawn from depth_weights, and the levels below that
+    are replaced with unknown keywords.
+    """
+    depths = []
+    for depth, weight in enumerate(depth_weights):
+        depths.extend([depth + 1] * weight)
+
+    taxonomy = {}
+    for otu_id, seq_ids in otu_map:
+        otu_lineage = rng.choice(lineages)
+        for seq_id in seq_ids:
+            if rng.random() < 0.9:
+                lineage = otu_lineage
+            else:
+                lineage = rng.choice(lineages)
+            depth = rng.choice(depths)
+            taxonomy[seq_id] = ';'.join(lineage[:depth] +
+                    [rng.choice(unknown_keywords)
+                     for level in range(len(lineage) - depth)])
+    return taxonomy
+
+def _sequence(genome, length, rng):
+    """Returns a sequence of length copied from a random offset of genome."""
+    start = rng.randrange(len(genome) - length)
+    return genome[start:start + length]
+
+def generate_reference_family(num_seqs, seed=0, length=1500,
+                              genus_size=25, genus_divergence=0.25,
+                              species_divergence=0.08):
+    """Returns num_seqs related sequences that resemble 16S references.
+
+    Unlike the sequences written by generate_data, which are unrelated, these
+    share conserved regions: every sequence descends from one ancestor, and
+    only the variable regions (about half of the positions, in blocks of
+    30-120 bases) mutate. Sequences are grouped into genera of genus_size,
+    so the sequences in a genus are more alike than the rest (about 93% and
+    80% identical with the defaults).
+
+    Arguments:
+        num_seqs - the number of sequences to generate
+        seed - the seed for the random number generator
+        length - the length of every sequence
+        genus_size - the number of sequences in each genus
+        genus_divergence - the fraction of the variable positions that are
+            substituted in each genus
+        species_divergence - the fraction of the variable positions that are
+            substituted in each sequence of a genus
+    """
+    rng = Random(seed)
+    ancestor = ''.join(rng.choice('ACGT') for i in range(length))
+    variable_positions = []
+    start = 0
+    while start < length:
+        block_length = rng.randrange(30, 121)
+        if rng.random() < 0.5:
+            variable_positions.extend(range(start,
+                                            min(start + block_length,
+                                                length)))
+        start += block_length
+
+    seqs = []
+    while len(seqs) < num_seqs:
+        genus = _substitute(ancestor, variable_positions, genus_divergence,
+                            rng)
+        for i in range(min(genus_size, num_seqs - len(seqs))):
+            seqs.append(_substitute(genus, variable_positions,
+                                    species_divergence, rng))
+    return seqs
+
+def mutate(seq, identity, rng):
+    """Returns seq with each base substituted with probability 1 - identity.
+    """
+    return _substitute(seq, range(len(seq)), 1 - identity, rng)
+
+def _substitute(seq, positions, rate, rng):
+    """Returns seq with each of positions substituted with probability rate.
+    """
+    seq = list(seq)
+    for position in positions:
+        if rng.random() < rate:
+            seq[position] = rng.choice([base for base in 'ACGT'
+                                        if base != seq[position]])
+    return ''.join(seq)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+from collections import deque
+from multiprocessing import Pool
+from os import listdir
+from os.path import join
+from numpy import (arange, argmax, argsort, array, concatenate, cumsum,
+                   flatnonzero, full, int64, maximum, searchsorted, split,
+                   zeros)
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.seq_store import get_reference_seqs
+from nested_reference_otus.sketch_index import (compute_sketches, EMPTY,
+        jaccard_to_identity)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Top-down assignment of sequences to nested reference OTUs
+
+a query is compared with the representative sequences of every OTU at the
+lowest similarity level, then only with the OTUs nested in its best match at
+each higher level, so it's compared with a few OTUs per level instead of all
+of the OTUs at the highest level. the comparisons are estimated identities
+from MinHash sketches (see sketch_index), made for a batch of queries at a
+time.
+"""
+
+def representative(tree, node):
+    """returns the representative sequence id of an OTU node
+
+    the first member of each OTU is its representative (pick_rep_set.py -m
+    first), so it's the first tip below the node
+    """
+    while tree.first_child[node] != -1:
+        node = tree.first_child[node]
+    return tree.names[node]
+
+class ReferenceHierarchy(object):
+    """The OTUs of a NestedOTUTree, from low -> high similarity
+
+    levels[i] is the similarity of the i'th level. the OTUs of level i + 1 are
+    ordered by their parent at level i, so the OTUs nested in row j of level i
+    are rows child_offsets[i][j]:child_offsets[i][j + 1] of level i + 1.
+    otu_ids[i], rep_ids[i] and sketches[i] are per row.
+
+    ref_seqs holds the representative sequences, as FASTA or a sequence
+    store (see seq_store.get_reference_seqs)
+    """
+    def __init__(self, tree, ref_seqs, k=16, sketch_size=256):
+        # tree.levels go high -> low, and the root's children are the lowest
+        self.levels = list(reversed(tree.levels))
+        self.k = k
+        self.sketch_size = sketch_size
+        self.otu_ids = []
+        self.rep_ids = []
+        self.child_offsets = []
+        nodes = list(tree.children(tree.root))
+        for level_idx in range(len(self.levels)):
+            self.otu_ids.append(array([tree.otu_ids[n] for n in nodes],
+                                      dtype=str))
+            self.rep_ids.append(array([representative(tree, n)
+                                       for n in nodes], dtype=str))
+            if level_idx == len(self.levels) - 1:
+                break
+            children = [list(tree.children(n)) for n in nodes]
+            counts = array([0] + map(len, children), dtype=int64)
+            self.child_offsets.append(cumsum(counts))
+            nodes = [c for node_children in children for c in node_children]
+
+        self.sketches = self._sketch_reps(ref_seqs)
+
+    def _sketch_reps(self, ref_seqs):
+        """returns the sketches of the representatives at each level"""
+        needed = set()
+        for rep_ids in self.rep_ids:
+            needed.update(rep_ids.tolist())
+        seqs = get_reference_seqs(ref_seqs, needed)
+        missing = needed.difference(seqs)
+        if missing:
+            raise KeyError("Representative sequences missing from the "
+                           "reference sequences: %s" %
+                           ', '.join(sorted(missing)[:10]))
+
+        # the higher levels hold all the lower levels' representatives, so
+        # sketch each sequence once
+        rep_ids = sorted(needed)
+        all_sketches = concatenate(
+                [compute_sketches([seqs[rep_id] for rep_id in
+                                   rep_ids[i:i + 5000]],
+                                  self.k, self.sketch_size)
+                 for i in range(0, len(rep_ids), 5000)] or
+                [zeros((0, self.sketch_size), dtype=EMPTY.dtype)])
+        rep_ids = array(rep_ids, dtype=str)
+        return [all_sketches[searchsorted(rep_ids, level_rep_ids)]
+                for level_rep_ids in self.rep_ids]
+
+    def num_otus(self):
+        """returns the number of OTUs at each level, low -> high"""
+        return [len(otu_ids) for otu_ids in self.otu_ids]
+
+def jaccard_matrix(sketches, ref_sketches, max_cells=2 ** 24):
+    """returns the estimated Jaccard similarity of each of sketches (rows) to
+    each of ref_sketches (columns)
+
+    as sketch_index.estimate_jaccard, compared a block of rows at a time so
+    no more than max_cells sketch bins are compared at once
+    """
+    result = zeros((len(sketches), len(ref_sketches)))
+    if not len(sketches) or not len(ref_sketches):
+        return result
+    sketch_size = sketches.shape[1]
+    rows = max(1, max_cells // (len(ref_sketches) * sketch_size))
+    ref_empty = (ref_sketches == EMPTY)[None, :, :]
+    refs = ref_sketches[None, :, :]
+    for start in range(0, len(sketches), rows):
+        block = sketches[start:start + rows][:, None, :]
+        block_empty = block == EMPTY
+        matches = ((block == refs) & ~block_empty).sum(axis=2)
+        used = sketch_size - (block_empty & ref_empty).sum(axis=2)
+        used[used == 0] = 1
+        result[start:start + rows] = matches / used.astype(float)
+    return result
+
+def assign_batch(hierarchy, seqs):
+    """returns (assignments, num_comparisons) for a list of sequences
+
+    each sequence descends the hierarchy to its best matching OTU at every
+    level. it's assigned to the OTU at a level if that OTU's representative,
+    or the representative of an OTU nested in it further down the path, is at
+    least the level's similarity to it. assignments has a list per sequence of
+    (level_idx, row, identity) for the levels it's assigned at, from low ->
+    high similarity, where level_idx indexes hierarchy.levels, row indexes
+    hierarchy.otu_ids[level_idx] and identity is the best of those matches.
+    num_comparisons is the number of OTUs each sequence was compared with
+    """
+    if not seqs:
+        return [], []
+    sketches = compute_sketches(seqs, hierarchy.k, hierarchy.sketch_size)
+    num_levels = len(hierarchy.levels)
+    best_rows = zeros((len(seqs), num_levels), dtype=int64)
+    identities = zeros((len(seqs), num_levels))
+    num_comparisons = zeros(len(seqs), dtype=int64)
+
+    # (query indices, first row, end row) of the OTUs to compare each group
+    # of queries with. every query starts out at the top of the hierarchy
+    groups = [(arange(len(seqs)), 0, hierarchy.num_otus()[0])]
+    for level_idx in range(num_levels):
+        level_sketches = hierarchy.sketches[level_idx]
+        for queries, start, end in groups:
+            jaccard = jaccard_matrix(sketches[queries],
+                                     level_sketches[start:end])
+            num_comparisons[queries] += end - start
+            best = argmax(jaccard, axis=1)
+            best_rows[queries, level_idx] = start + best
+            identities[queries, level_idx] = \
+                    [jaccard_to_identity(j, hierarchy.k)
+                     for j in jaccard[arange(len(queries)), best]]
+
+        if level_idx == num_levels - 1:
+            break
+        # every OTU below the lowest level has a parent, so no group is empty
+        offsets = hierarchy.child_offsets[level_idx]
+        rows = best_rows[:, level_idx]
+        order = argsort(rows, kind='mergesort')
+        ordered = rows[order]
+        firsts = flatnonzero(concatenate([[True],
+                                          ordered[1:] != ordered[:-1]]))
+        groups = [(queries, offsets[rows[queries[0]]],
+                   offsets[rows[queries[0]] + 1])
+                  for queries in split(order, firsts[1:])]
+
+    # the best identity to a member of each OTU on the path
+    support = maximum.accumulate(identities[:, ::-1], axis=1)[:, ::-1]
+    assigned = support >= array(hierarchy.levels) / 100.
+    assignments = [[(level_idx, best_rows[query, level_idx],
+                     support[query, level_idx])
+                    for level_idx in flatnonzero(assigned[query])]
+                   for query in range(len(seqs))]
+    return assignments, num_comparisons.tolist()
+
+# the hierarchy of the worker processes, set by _init_worker
+_worker_hierarchy = None
+
+def _init_worker(hierarchy):
+    global _worker_hierarchy
+    _worker_hierarchy = hierarchy
+
+def _assign_batch_in_worker(seqs):
+    return assign_batch(_worker_hierarchy, seqs)
+
+def _iter_batches(fasta, batch_size, exact_index=None):
+    """yields (seq_ids, exact_rows, missed_seqs) for batch_size sequences at
+    a time
+
+    exact_rows has the exact_index row of each sequence, or -1 if it has to
+    be searched for, and missed_seqs are the sequences to search for
+    """
+    seq_ids = []
+    seqs = []
+    for seq_id, seq in parse_fasta(fasta):
+        seq_ids.append(seq_id.split()[0])
+        seqs.append(seq)
+        if len(seqs) == batch_size:
+            yield _split_exact_matches(seq_ids, seqs, exact_index)
+            seq_ids = []
+            seqs = []
+    if seqs:
+        yield _split_exact_matches(seq_ids, seqs, exact_index)
+
+def _split_exact_matches(seq_ids, seqs, exact_index):
+    if exact_index is None:
+        return seq_ids, full(len(seqs), -1, dtype=int64), seqs
+    exact_rows = exact_index.lookup_rows(seqs)
+    missed_seqs = [seqs[i] for i in flatnonzero(exact_rows == -1)]
+    return seq_ids, exact_rows, missed_seqs
+
+def assign_seqs(hierarchy, fasta, batch_size=1000, num_processes=1,
+                exact_index=None):
+    """yields (seq_id, [(level, otu_id, rep_id, identity)], num_comparisons)
+    for each sequence in fasta, in order
+
+    the assignments go from high -> low similarity (like
+    OTUMembershipIndex.ancestors) and only include the levels the sequence
+    was assigned at (see assign_batch). num_comparisons is the number of OTUs
+    the sequence was compared with.
+
+    if an exact_index.ExactMatchIndex of the same OTUs is passed as
+    exact_index, sequences identical to a reference sequence are assigned
+    to its OTUs at every level with an identity of 1.0 and 0 comparisons,
+    and only the rest are searched for.
+
+    with more than one process the batches are assigned in a process pool,
+    with no more than two batches per process read ahead of the output
+    """
+    batches = _iter_batches(fasta, batch_size, exact_index)
+    if num_processes <= 1:
+        results = ((seq_ids, exact_rows, assign_batch(hierarchy, seqs))
+                   for seq_ids, exact_rows, seqs in batches)
+        for result in _iter_assignments(hierarchy, results, exact_index):
+            yield result
+        return
+
+    pool = Pool(num_processes, _init_worker, (hierarchy,))
+    try:
+        for result in _iter_assignments(hierarchy, _iter_pooled(
+                pool, batches, 2 * num_processes), exact_index):
+            yield result
+    finally:
+        pool.terminate()
+
+def _iter_pooled(pool, batches, max_pending):
+    """yields (seq_ids, exact_rows, assign_batch result) for batches, in
+    order"""
+    pending = deque()
+    for seq_ids, exact_rows, seqs in batches:
+        pending.append((seq_ids, exact_rows, pool.apply_async(
+                _assign_batch_in_worker, (seqs,))))
+        if len(pending) == max_pending:
+            seq_ids, exact_rows, result = pending.popleft()
+            yield seq_ids, exact_rows, result.get()
+    while pending:
+        seq_ids, exact_rows, result = pending.popleft()
+        yield seq_ids, exact_rows, result.get()
+
+def _iter_assignments(hierarchy, results, exact_index):
+    for seq_ids, exact_rows, (assignments, num_comparisons) in results:
+        searched = iter(zip(assignments, num_comparisons))
+        for seq_id, exact_row in zip(seq_ids, exact_rows):
+            if exact_row != -1:
+                yield (seq_id, [e + (1.0,) for e in
+                                exact_index.assignments(exact_row)], 0)
+                continue
+            rows, num = searched.next()
+            yield (seq_id,
+                   [(hierarchy.levels[level_idx],
+                     str(hierarchy.otu_ids[level_idx][row]),
+                     str(hierarchy.rep_ids[level_idx][row]), identity)
+                    for level_idx, row, identity in reversed(rows)], num)
+
+def find_workflow_rep_set(output_dir, level):
+    """returns the path of the rep set for level written by
+    pick_nested_reference_otus to output_dir
+    """
+    rep_set_dir = join(output_dir, 'rep_set')
+    prefix = '%d_otus_' % level
+    for fn in sorted(listdir(rep_set_dir)):
+        if fn.startswith(prefix) and fn.endswith('.fasta'):
+            return join(rep_set_dir, fn)
+    raise ValueError("No %d rep set found in %s" % (level, rep_set_dir))
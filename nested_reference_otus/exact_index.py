@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+from hashlib import md5
+from string import maketrans
+from numpy import (arange, array, concatenate, empty, flatnonzero, frombuffer,
+                   full, int64, lexsort, uint64, unique, zeros)
+from nested_reference_otus.memory import input_size
+from nested_reference_otus.seq_store import iter_reference_seqs
+from nested_reference_otus.util import load_arrays, save_arrays
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Hash index of the reference sequences, for resolving exact matches
+
+each reference sequence is keyed by the md5 digest of its bases (ignoring
+case, gaps and U/T), and maps to its reference id and the OTU (and that OTU's
+representative) containing it at every level. the digests are stored in an
+open addressing hash table with linear probing, so a lookup is a few array
+reads no matter how many references there are.
+"""
+
+_u_to_t = maketrans('U', 'T')
+_gaps = '-.'
+
+def sequence_digests(seqs):
+    """returns a (len(seqs), 2) uint64 array of the digests of seqs"""
+    if not len(seqs):
+        return zeros((0, 2), dtype=uint64)
+    digests = ''.join([md5(seq.upper().translate(_u_to_t, _gaps)).digest()
+                       for seq in seqs])
+    return frombuffer(digests, dtype=uint64).reshape((len(seqs), 2))
+
+def _table_size(num_keys):
+    """the smallest power of 2 that's at least twice num_keys"""
+    size = 2
+    while size < 2 * num_keys:
+        size *= 2
+    return size
+
+def build_hash_table(keys):
+    """returns the slots of an open addressing table of keys
+
+    slot i holds the index into keys of the key stored there, or -1. a key
+    is stored in the first free slot from (key & (len(slots) - 1)). only the
+    first of equal keys can be found, so keys should be unique. all of the
+    keys that want a free slot claim it together, so this takes as many
+    rounds as the longest probe sequence
+    """
+    slots = full(_table_size(len(keys)), -1, dtype=int64)
+    mask = uint64(len(slots) - 1)
+    pending = arange(len(keys), dtype=int64)
+    positions = (keys & mask).astype(int64)
+    while len(pending):
+        free = slots[positions] == -1
+        # the first pending key at each free slot gets it
+        claimed, first = unique(positions[free], return_index=True)
+        slots[claimed] = pending[free][first]
+        placed = zeros(len(pending), dtype=bool)
+        placed[flatnonzero(free)[first]] = True
+        pending = pending[~placed]
+        positions = (positions[~placed] + 1) & int64(mask)
+    return slots
+
+def probe_hash_table(slots, stored_keys, keys):
+    """returns the index into stored_keys of each of keys, or -1
+
+    stored_keys are the keys the slots were built from
+    """
+    found = full(len(keys), -1, dtype=int64)
+    mask = int64(len(slots) - 1)
+    pending = arange(len(keys), dtype=int64)
+    positions = (keys & uint64(mask)).astype(int64)
+    while len(pending):
+        stored = slots[positions]
+        hit = stored != -1
+        hit[hit] = stored_keys[stored[hit]] == keys[pending[hit]]
+        found[pending[hit]] = stored[hit]
+        # stop at a hit or an empty slot
+        going = (stored != -1) & ~hit
+        pending = pending[going]
+        positions = (positions[going] + 1) & mask
+    return found
+
+def estimate_exact_index_memory(fasta):
+    """returns the estimated memory (in bytes) of build_exact_index holding
+    every sequence of fasta at once
+
+    python strings about double the size of the sequences on disk. fasta
+    that isn't a file (e.g. a sequence store) counts as 0
+    """
+    return 2 * input_size(fasta)
+
+def build_exact_index(tree, fasta, batch_size=None):
+    """returns {name: array} for the exact match index of the tips of a
+    NestedOTUTree
+
+    the sequences of the tips are taken from fasta (or a sequence store, see
+    seq_store.iter_reference_seqs), and tips that aren't in it aren't
+    indexed. if several tips have the same sequence, the first
+    one in fasta is indexed
+
+    by default every sequence is held until they're all digested. if
+    batch_size is given, they're digested batch_size bases at a time
+    instead, so only a batch and 16 bytes per digest are held
+    """
+    levels = list(tree.levels)
+    order = list(tree.preorder())
+    # the representative is the first tip below an OTU (see
+    # assign.representative)
+    node_rep = {}
+    for node in reversed(order):
+        first_child = tree.first_child[node]
+        if first_child == -1:
+            node_rep[node] = tree.names[node]
+        else:
+            node_rep[node] = node_rep[first_child]
+
+    tip_nodes = {}
+    for node in order:
+        if tree.first_child[node] == -1 and node != tree.root:
+            tip_nodes[tree.names[node]] = node
+
+    ref_ids = []
+    seqs = []
+    batches = []
+    num_bases = 0
+    for seq_id, seq in iter_reference_seqs(fasta):
+        seq_id = seq_id.split()[0]
+        if seq_id in tip_nodes:
+            ref_ids.append(seq_id)
+            seqs.append(seq)
+            num_bases += len(seq)
+            if batch_size is not None and num_bases >= batch_size:
+                batches.append(sequence_digests(seqs))
+                seqs = []
+                num_bases = 0
+    batches.append(sequence_digests(seqs))
+    digests = concatenate(batches)
+    del seqs, batches
+    # keep the first reference with each digest. the sort is stable, so the
+    # first of each run of equal digests is the first in fasta
+    order = lexsort((digests[:, 1], digests[:, 0]))
+    sorted_digests = digests[order]
+    repeated = zeros(len(order), dtype=bool)
+    repeated[1:] = (sorted_digests[1:] == sorted_digests[:-1]).all(axis=1)
+    first = order[~repeated]
+    first.sort()
+    digests = digests[first]
+    ref_ids = [ref_ids[i] for i in first]
+
+    otu_ids = empty((len(ref_ids), len(levels)), dtype=object)
+    rep_ids = empty((len(ref_ids), len(levels)), dtype=object)
+    for row, ref_id in enumerate(ref_ids):
+        node = tree.parent[tip_nodes[ref_id]]
+        while node != -1 and node != tree.root:
+            level_idx = tree.node_level[node]
+            otu_ids[row, level_idx] = tree.otu_ids[node]
+            rep_ids[row, level_idx] = node_rep[node]
+            node = tree.parent[node]
+
+    return {'levels': array(levels, dtype=int64),
+            'ref_ids': array(ref_ids, dtype=str),
+            'otu_ids': otu_ids.astype(str),
+            'rep_ids': rep_ids.astype(str),
+            'digests': digests,
+            'slots': build_hash_table(digests[:, 0])}
+
+def write_exact_index(tree, fasta, index_dir, batch_size=None):
+    """writes the exact match index of the tips of tree to index_dir"""
+    save_arrays(index_dir, build_exact_index(tree, fasta, batch_size))
+
+class ExactMatchIndex(object):
+    """Resolves sequences identical to a reference sequence"""
+    def __init__(self, index_dir, mmap_mode='r'):
+        arrays = load_arrays(index_dir, mmap_mode)
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.ref_ids)
+
+    def lookup_rows(self, seqs):
+        """returns the row of the reference identical to each of seqs, or -1"""
+        if not len(self):
+            return full(len(seqs), -1, dtype=int64)
+        digests = sequence_digests(seqs)
+        rows = probe_hash_table(self.slots, self.digests[:, 0], digests[:, 0])
+        # the first half of the digest found the row, the second confirms it
+        hits = flatnonzero(rows != -1)
+        mismatched = self.digests[rows[hits], 1] != digests[hits, 1]
+        rows[hits[mismatched]] = -1
+        return rows
+
+    def assignments(self, row):
+        """returns [(level, otu_id, rep_id)] for a row, high -> low"""
+        return [(int(level), str(otu_id), str(rep_id))
+                for level, otu_id, rep_id in zip(self.levels,
+                                                 self.otu_ids[row],
+                                                 self.rep_ids[row])]
+
+    def lookup(self, seq):
+        """returns (ref_id, assignments) for seq, or None if there's no
+        identical reference sequence
+        """
+        row = self.lookup_rows([seq])[0]
+        if row == -1:
+            return None
+        return str(self.ref_ids[row]), self.assignments(row)
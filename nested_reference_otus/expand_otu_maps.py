@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+from array import array
+from numpy import (arange, argsort, concatenate, diff, empty, flatnonzero,
+                   frombuffer, int32)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Expand nested OTU maps so every level lists the original sequences"""
+
+def expand_nested_otu_maps(otu_maps):
+    """yields the expanded OTU map of each level as [(otu_id, [seqids])]
+
+    expects otu_maps to go from high -> low similarity, as parsed by
+    unnest.parse_otu_map, where the members of each level are the reps of the
+    level before it. each level is only read once, so otu_maps can be a
+    generator that parses the files lazily.
+
+    every original sequence is coded as an integer and carries the index of
+    the OTU it is in at the current level. moving up a level remaps those
+    indices in one vectorized step (path compression across levels), so the
+    memory used is proportional to the number of sequences, not levels x
+    sequences. each yielded map should be consumed (e.g. written out) before
+    asking for the next one.
+
+    within an expanded OTU, the members are in the order you get by expanding
+    each member of the OTU map in turn, so the rep is always listed first.
+    """
+    seq_names = None
+    otu_ids = []
+    for level_idx, otu_map in enumerate(otu_maps):
+        num_old_otus = len(otu_ids)
+        otu_ids = []
+        if seq_names is None:
+            seq_names = []
+            assigned = array('i')
+            for otu_idx, (otu_id, seqids) in enumerate(otu_map):
+                otu_ids.append(otu_id)
+                seq_names.extend(seqids)
+                assigned.extend([otu_idx] * len(seqids))
+            assigned = frombuffer(assigned, dtype=int32).copy()
+            order = arange(len(seq_names), dtype=int32)
+        else:
+            # remap[i] is the new OTU of old OTU i, rank[i] is where old OTU
+            # i is listed in the new map
+            remap = empty(num_old_otus, dtype=int32)
+            remap.fill(-1)
+            rank = empty(num_old_otus, dtype=int32)
+            position = 0
+            for otu_idx, (otu_id, seqids) in enumerate(otu_map):
+                otu_ids.append(otu_id)
+                for id_ in seqids:
+                    if id_ not in rep_index:
+                        raise ValueError("%s in OTU %s of OTU map %d is not a "
+                                         "rep in the OTU map before it" % \
+                                         (id_, otu_id, level_idx + 1))
+                    remap[rep_index[id_]] = otu_idx
+                    rank[rep_index[id_]] = position
+                    position += 1
+            new_assigned = remap[assigned]
+            if (new_assigned == -1).any():
+                raise ValueError("OTU map %d does not contain every rep of "
+                                 "the OTU map before it" % (level_idx + 1))
+
+            # a stable sort on the rank of each sequence's old OTU puts the
+            # old OTUs in the order the new map lists them, and keeps the
+            # members of each old OTU in their already expanded order
+            order = order[argsort(rank[assigned[order]], kind='mergesort')]
+            assigned = new_assigned
+
+        # members of the same OTU are now contiguous in order, and the OTUs
+        # are in the order of the map
+        ordered_otus = assigned[order]
+        if len(order):
+            starts = concatenate(([0], flatnonzero(diff(ordered_otus)) + 1))
+            ends = concatenate((starts[1:], [len(order)]))
+        else:
+            starts = ends = []
+
+        rep_index = {}
+        expanded = []
+        for start, end in zip(starts, ends):
+            otu_idx = ordered_otus[start]
+            seqids = [seq_names[i] for i in order[start:end]]
+            rep_index[seqids[0]] = otu_idx
+            expanded.append((otu_ids[otu_idx], seqids))
+        yield expanded
+
+def format_otu_map(otu_map):
+    """yields the lines of an OTU map for [(otu_id, [seqids])]"""
+    for otu_id, seqids in otu_map:
+        yield '%s\t%s\n' % (otu_id, '\t'.join(seqids))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+from numpy import (arange, argsort, array, int16, int64, lexsort, searchsorted,
+                   zeros)
+from nested_reference_otus.util import load_arrays, save_arrays
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Index of which tips belong to which OTU in the unnested hierarchy"""
+
+def build_membership_index(tree):
+    """returns {name: array} indexing the OTUs of a NestedOTUTree
+
+    tips are numbered in preorder, so the tips under any OTU are a contiguous
+    run [start, end) of tip_names. the OTU rows are sorted by (level, OTU id)
+    for lookups by OTU, and otu_by_start gives the rows sorted by (level,
+    start) for lookups by tip. within a level the OTUs don't overlap, so both
+    lookups are a binary search.
+    """
+    num_nodes = len(tree)
+    start = zeros(num_nodes, dtype=int64)
+    count = zeros(num_nodes, dtype=int64)
+    tip_names = []
+    order = list(tree.preorder())
+    for node in order:
+        start[node] = len(tip_names)
+        if tree.first_child[node] == -1 and node != tree.root:
+            tip_names.append(tree.names[node])
+            count[node] = 1
+    for node in reversed(order):
+        parent = tree.parent[node]
+        if parent != -1:
+            count[parent] += count[node]
+
+    # preorder, so within each level these are already sorted by start
+    otu_nodes = array([node for node in order if tree.node_level[node] != -1],
+                      dtype=int64)
+    otu_level = tree.node_level[otu_nodes].astype(int16)
+    otu_ids = array([tree.otu_ids[node] for node in otu_nodes], dtype=str)
+    otu_start = start[otu_nodes]
+    otu_end = otu_start + count[otu_nodes]
+
+    by_id = lexsort((otu_ids, otu_level))
+    rank_by_id = zeros(len(by_id), dtype=int64)
+    rank_by_id[by_id] = arange(len(by_id))
+    # a stable sort on level keeps the preorder (start) order within a level
+    by_start = rank_by_id[argsort(otu_level, kind='mergesort')]
+
+    tip_names = array(tip_names, dtype=str)
+    sorted_tips = argsort(tip_names, kind='mergesort')
+
+    return {'levels': array(tree.levels, dtype=int64),
+            'tip_names': tip_names,
+            'sorted_tip_names': tip_names[sorted_tips],
+            'sorted_tip_ranks': sorted_tips.astype(int64),
+            'otu_level': otu_level[by_id],
+            'otu_ids': otu_ids[by_id],
+            'otu_start': otu_start[by_id],
+            'otu_end': otu_end[by_id],
+            'otu_by_start': by_start,
+            'sorted_otu_starts': otu_start[by_id][by_start]}
+
+def write_membership_index(tree, index_dir):
+    """writes the membership index of tree to index_dir"""
+    save_arrays(index_dir, build_membership_index(tree))
+
+class OTUMembershipIndex(object):
+    """Answers OTU membership queries from an index written by
+    write_membership_index
+
+    the index is memory-mapped, so opening it is cheap and the queries only
+    touch the pages they need: O(log n + k) for the k tips of an OTU, and
+    O(levels * log n) for the ancestors of a tip
+    """
+    def __init__(self, index_dir, mmap_mode='r'):
+        arrays = load_arrays(index_dir, mmap_mode)
+        for name, values in arrays.items():
+            setattr(self, name, values)
+        self._level_index = dict((int(level), idx)
+                                 for idx, level in enumerate(self.levels))
+
+    def _level_range(self, level_idx):
+        """returns the [lo, hi) OTU rows at level_idx"""
+        return (searchsorted(self.otu_level, level_idx, 'left'),
+                searchsorted(self.otu_level, level_idx, 'right'))
+
+    def tips(self, level, otu_id):
+        """returns the IDs of all tips under otu_id at level
+
+        raises KeyError if there is no such OTU
+        """
+        if level not in self._level_index:
+            raise KeyError("Unknown level: %s" % level)
+        lo, hi = self._level_range(self._level_index[level])
+        row = lo + searchsorted(self.otu_ids[lo:hi], otu_id)
+        if row == hi or self.otu_ids[row] != otu_id:
+            raise KeyError("Unknown OTU at level %s: %s" % (level, otu_id))
+        return self.tip_names[self.otu_start[row]:self.otu_end[row]]
+
+    def ancestors(self, seq_id):
+        """returns [(level, otu_id, rep)] for the OTUs containing seq_id
+
+        ordered from the highest similarity level to the lowest. raises
+        KeyError if seq_id is not a tip
+        """
+        idx = searchsorted(self.sorted_tip_names, seq_id)
+        if idx == len(self.sorted_tip_names) or \
+           self.sorted_tip_names[idx] != seq_id:
+            raise KeyError("Unknown sequence: %s" % seq_id)
+        rank = self.sorted_tip_ranks[idx]
+
+        result = []
+        for level_idx, level in enumerate(self.levels):
+            lo, hi = self._level_range(level_idx)
+            pos = lo + searchsorted(self.sorted_otu_starts[lo:hi], rank,
+                                    'right') - 1
+            if pos < lo:
+                continue
+            row = self.otu_by_start[pos]
+            if rank < self.otu_end[row]:
+                result.append((int(level), self.otu_ids[row],
+                               self.tip_names[self.otu_start[row]]))
+        return result
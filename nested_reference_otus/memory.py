@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains the memory budget behind the scripts' --max_memory option."""
+
+from optparse import make_option
+from os.path import getsize, isfile
+from nested_reference_otus.util import parse_size
+
+memory_option = make_option('--max_memory',
+        help='the amount of memory the run may use, in bytes or with a K, '
+        'M, G or T suffix (e.g. 16G). Steps that are estimated to need more '
+        'than this switch to slower algorithms that keep their data on disk, '
+        'and the choice is reported with -v [default: no limit]')
+
+def input_size(input_fp):
+    """Returns the size of input_fp in bytes, or 0 if it isn't a file.
+
+    Inputs passed as open files or lists of lines have no known size, so
+    they count as 0 towards footprint estimates.
+
+    Arguments:
+        input_fp - a filepath, or anything else the modules accept as input
+    """
+    if isinstance(input_fp, basestring) and isfile(input_fp):
+        return getsize(input_fp)
+    return 0
+
+def format_size(num_bytes):
+    """Returns num_bytes in the largest unit it's at least 1 of (e.g. 1.5G).
+
+    Arguments:
+        num_bytes - the size to format, in bytes
+    """
+    for unit in ['T', 'G', 'M', 'K']:
+        unit_size = parse_size('1' + unit)
+        if num_bytes >= unit_size:
+            return '%.1f%s' % (num_bytes / unit_size, unit)
+    return '%dB' % num_bytes
+
+class MemoryBudget(object):
+    """Chooses between in-memory and disk-backed algorithms.
+
+    Each step that has a disk-backed fallback estimates its in-memory
+    footprint from the sizes of its inputs and asks the budget whether it
+    fits:
+
+        budget = MemoryBudget(opts.max_memory, report)
+        if budget.fits('sort sequences', 2 * input_size(fasta_fp)):
+            ... sort in memory ...
+        else:
+            ... sort on disk ...
+
+    The estimates are rough upper bounds, so a step that fits should never
+    run out of memory, but a step that doesn't may have fit after all. Every
+    choice is passed to report (if provided) as a message, and recorded in
+    choices.
+    """
+
+    def __init__(self, max_memory=None, report=None):
+        """Initializes a budget.
+
+        Arguments:
+            max_memory - the maximum memory to use, in bytes or as a string
+                accepted by util.parse_size, or None for no limit
+            report - a function called with a message describing each choice
+                (e.g. a WorkflowLogger's write method), or None
+        """
+        if isinstance(max_memory, basestring):
+            max_memory = parse_size(max_memory)
+        self.max_memory = max_memory
+        self.report = report
+        self.choices = []
+
+    def fits(self, step, estimate, fallback='on disk'):
+        """Returns True if step should run in memory.
+
+        Arguments:
+            step - a short description of the step (e.g. 'sort sequences')
+            estimate - the estimated in-memory footprint of the step, in
+                bytes
+            fallback - a short description of what the step does instead if
+                it doesn't fit
+        """
+        in_memory = self.max_memory is None or estimate <= self.max_memory
+        self.choices.append((step, estimate, in_memory))
+        if self.report is not None:
+            if self.max_memory is None:
+                limit = 'no memory limit'
+            else:
+                limit = 'a %s limit' % format_size(self.max_memory)
+            self.report('%s: estimated %s in memory with %s, so running %s.' %
+                        (step, format_size(estimate), limit,
+                         'in memory' if in_memory else fallback))
+        return in_memory
@@ -13,19 +13,43 @@ __status__ = "Development"
 
 """Contains functions used in the nested_reference_workflow.py script."""
 
-from os.path import join, split, splitext
+from os.path import getsize, join, split, splitext
+from subprocess import Popen, PIPE, STDOUT
 from cogent.app.util import get_tmp_filename
-from cogent.parse.fasta import MinimalFastaParser
 from cogent.util.misc import remove_files
-from qiime.util import create_dir
+from qiime.util import create_dir, get_qiime_library_version
 from qiime.workflow.util import generate_log_fp, print_to_stdout, WorkflowLogger
+from nested_reference_otus.unnest import (parse_otu_map, NestedOTUTreeBuilder,
+        write_newick)
+from nested_reference_otus.membership_index import write_membership_index
+from nested_reference_otus.exact_index import (estimate_exact_index_memory,
+        write_exact_index)
+from nested_reference_otus.memory import MemoryBudget
+from nested_reference_otus.otu_collection import write_collection
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.profiling import PhaseProfiler
+from nested_reference_otus.progress import ProgressReporter, forward_progress
+from nested_reference_otus.sketch_index import write_sketch_index
+from nested_reference_otus.tree_cache import load_tree, tree_files
+from nested_reference_otus.util import open_output
+
+def get_command_version(command):
+    """Returns the output of a version command (e.g. 'uclust --version').
+
+    Returns an empty string if the command can't be run.
+    """
+    try:
+        proc = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+        return proc.communicate()[0].strip()
+    except OSError:
+        return ''
 
 def get_second_field(s):
     return s.split()[1]
 
-def rename_rep_seqs(inseqs,rename_f=get_second_field):
+def rename_rep_seqs(inseqs,rename_f=get_second_field,progress=None):
     """ """
-    for seq_id, seq in MinimalFastaParser(inseqs):
+    for seq_id, seq in parse_fasta(inseqs,progress=progress):
         yield rename_f(seq_id), seq
 
 ## Begin task-specific workflow functions
@@ -35,8 +59,67 @@ def pick_nested_reference_otus(input_fasta_fp,
                               run_id,
                               similarity_thresholds,
                               command_handler,
-                              status_update_callback=print_to_stdout):
+                              status_update_callback=print_to_stdout,
+                              build_unnested_tree=False,
+                              build_sketch_indexes=False,
+                              build_exact_index=False,
+                              write_otu_collection=False,
+                              stage_cache=None,
+                              max_memory=None,
+                              profiler=None):
+    """Picks nested reference OTUs at each of similarity_thresholds.
+
+    input_tree_fp can be a newick file or a tree cache directory (see
+    tree_cache.write_tree_cache), which skips parsing the tree. The tree is
+    loaded once and pruned to each threshold's representative sequences in
+    turn.
+
+    If build_unnested_tree is True, the unnested hierarchy is built up as
+    each threshold's OTU map is written, and the unnested tree
+    (unnested.ntree) and its OTU membership index (unnested_index) are
+    written to output_dir at the end, so unnest.py doesn't need to be run
+    separately.
+
+    If build_sketch_indexes is True, a MinHash sketch index of each
+    threshold's representative sequences is written to
+    output_dir/sketch_indexes/<threshold>_sketch_index. Querying these (see
+    sketch_index.SketchIndex) prefilters the reference OTUs a new sequence
+    could belong to, without comparing it against every one of them.
+
+    If build_exact_index is True, an exact match index of the input
+    sequences (exact_index) is written to output_dir, mapping each distinct
+    sequence to the OTUs containing it at every threshold.
+
+    If write_otu_collection is True, the OTU maps and rep sets of every
+    threshold are also written to a single collection file
+    (nested_otus.npz, see otu_collection) that holds each representative
+    sequence once.
+
+    If a stage_cache.StageCache is passed as stage_cache, the OTU map,
+    clusters and rep set of each threshold, and each filtered tree, are
+    taken from the cache when a previous run had the same input sequences
+    (or tree), threshold, commands and tool versions, and are added to the
+    cache otherwise. Rerunning with an extra, lower threshold only picks
+    OTUs for the new threshold.
+
+    If max_memory is provided (in bytes, or as a string such as '16G'),
+    steps that are estimated to need more memory switch to slower
+    algorithms that need less (currently, building the exact match index
+    digests the sequences in batches instead of all at once). Each choice
+    is written to the log.
 
+    The steps that run in this process (renaming each rep set, joining each
+    threshold's OTUs into the unnested hierarchy and writing the unnested
+    tree) report their progress every 10 seconds (see
+    progress.ProgressReporter) to the log and status_update_callback, so a
+    slow run can be told apart from a stuck one.
+
+    If a profiler.PhaseProfiler is passed as profiler, the steps for each
+    threshold are profiled as separate phases. The time spent in commands
+    shows up as child CPU time.
+    """
+    if profiler is None:
+        profiler = PhaseProfiler()
 
     # Prepare some variables for the later steps
     create_dir(output_dir)
@@ -50,16 +133,29 @@ def pick_nested_reference_otus(input_fasta_fp,
     if input_tree_fp:
         tree_dir = join(output_dir,'trees')
         create_dir(tree_dir)
+    if build_sketch_indexes:
+        sketch_dir = join(output_dir,'sketch_indexes')
+        create_dir(sketch_dir)
     commands = []
     files_to_remove = []
     
     logger = WorkflowLogger(generate_log_fp(output_dir))
+    memory_budget = MemoryBudget(max_memory, logger.write)
+    progress_callback = forward_progress(logger.write, status_update_callback)
     similarity_thresholds.sort()
     similarity_thresholds.reverse()
     
     current_inseqs_fp = input_fasta_fp
     current_tree_fp = input_tree_fp
+    current_tree = None
     previous_otu_map = None
+    build_tree = build_unnested_tree or build_exact_index
+    if stage_cache is not None:
+        tool_versions = {'qiime': get_qiime_library_version(),
+                         'uclust': get_command_version('uclust --version')}
+    if build_tree:
+        tree_builder = NestedOTUTreeBuilder()
+        last_level = 100
     for similarity_threshold in similarity_thresholds:
         current_inseqs_basename = splitext(split(current_inseqs_fp)[1])[0]
         
@@ -93,20 +189,83 @@ def pick_nested_reference_otus(input_fasta_fp,
           current_inseqs_fp)
         commands.append([('Pick Rep Set (%d)' % similarity_threshold,
                            pick_rep_set_cmd)])
-        command_handler(commands, status_update_callback, logger, close_logger_on_success=False)
-        commands = []
-        
-        # rename representative sequences
         rep_set_fp = '%s/%d_otus_%s.fasta' % (
           rep_set_dir,
           similarity_threshold,
           run_id)
-        logger.write('Renaming OTU representative sequences so OTU ids are reference sequence ids.')
-        rep_set_f = open(rep_set_fp,'w')
-        for e in rename_rep_seqs(open(temp_rep_set_fp,'U')):
-            rep_set_f.write('>%s\n%s\n' % e)
-        rep_set_f.close()
-        files_to_remove.append(temp_rep_set_fp)
+        otu_outputs = {'otu_map.txt':otu_fp,
+                       'clusters.uc':clusters_fp,
+                       'rep_set.fasta':rep_set_fp}
+        
+        cache_key = None
+        if stage_cache is not None:
+            with profiler.phase('check stage cache (%d)' %
+                                similarity_threshold):
+                params = dict(tool_versions)
+                params.update({'similarity':'%1.2f' % (similarity_threshold/100),
+                               'pick_otus':'pick_otus.py -m uclust -DBz',
+                               'pick_rep_set':'pick_rep_set.py -m first',
+                               'rename':'second field'})
+                cache_key = stage_cache.key('pick OTUs and rep set',
+                                            [current_inseqs_fp], params)
+                cache_hit = stage_cache.fetch(cache_key, otu_outputs)
+            if cache_hit:
+                logger.write('Using the cached %d OTU map and rep set (%s).' %
+                             (similarity_threshold, cache_key))
+                profiler.count('stage cache hits')
+                commands = []
+                files_to_remove = []
+            else:
+                profiler.count('stage cache misses')
+        
+        if commands:
+            with profiler.phase('pick OTUs and rep set (%d)' %
+                                similarity_threshold):
+                command_handler(commands, status_update_callback, logger, close_logger_on_success=False)
+            commands = []
+            
+            # rename representative sequences
+            logger.write('Renaming OTU representative sequences so OTU ids are reference sequence ids.')
+            with profiler.phase('rename rep set (%d)' % similarity_threshold):
+                progress = ProgressReporter('Renaming the %d rep set' %
+                        similarity_threshold, progress_callback,
+                        total_bytes=getsize(temp_rep_set_fp))
+                # replaced rather than overwritten, as a previous run's
+                # rep set may be hardlinked into the stage cache
+                rep_set_f = open_output(rep_set_fp)
+                for e in rename_rep_seqs(open(temp_rep_set_fp,'U'),
+                                         progress=progress):
+                    rep_set_f.write('>%s\n%s\n' % e)
+                rep_set_f.close()
+                progress.finish()
+            files_to_remove.append(temp_rep_set_fp)
+            
+            if cache_key is not None:
+                with profiler.phase('store in stage cache (%d)' %
+                                    similarity_threshold):
+                    stage_cache.store(cache_key, otu_outputs)
+        
+        if build_sketch_indexes:
+            logger.write('Sketching the %d OTU representative sequences.' %
+                         similarity_threshold)
+            with profiler.phase('sketch rep set (%d)' % similarity_threshold):
+                write_sketch_index(rep_set_fp, join(sketch_dir,
+                        '%d_sketch_index' % similarity_threshold),
+                        min_identity=similarity_threshold / 100.)
+        
+        # add this level to the unnested hierarchy while its OTU map is hot
+        if build_tree:
+            logger.write('Adding the %d OTUs to the unnested hierarchy.' %
+                         similarity_threshold)
+            with profiler.phase('unnest (%d)' % similarity_threshold):
+                progress = ProgressReporter('Joining the %d OTUs' %
+                        similarity_threshold, progress_callback)
+                tree_builder.add_level(
+                        progress.track(parse_otu_map(open(otu_fp,'U'))),
+                        float(last_level - similarity_threshold),
+                        similarity_threshold)
+                progress.finish()
+            last_level = similarity_threshold
         
         # filter the tree, if provided
         if current_tree_fp != None:
@@ -114,10 +273,43 @@ def pick_nested_reference_otus(input_fasta_fp,
               tree_dir,
               similarity_threshold,
               run_id)
-            tree_cmd = 'filter_tree.py -i %s -f %s -o %s' %\
-               (current_tree_fp,rep_set_fp,tree_fp)
-            commands.append([('Filter tree (%d)' % similarity_threshold,tree_cmd)])
-            command_handler(commands, status_update_callback, logger, close_logger_on_success=False)
+            cache_hit = False
+            if stage_cache is not None:
+                with profiler.phase('check stage cache (%d)' %
+                                    similarity_threshold):
+                    params = dict(tool_versions)
+                    params['filter_tree'] = 'prune, collapse unary nodes'
+                    cache_key = stage_cache.key('filter tree',
+                            tree_files(current_tree_fp) + [rep_set_fp],
+                            params)
+                    cache_hit = stage_cache.fetch(cache_key,
+                                                  {'tree.tre':tree_fp})
+                if cache_hit:
+                    logger.write('Using the cached %d tree (%s).' %
+                                 (similarity_threshold, cache_key))
+                    profiler.count('stage cache hits')
+                    # a later threshold is pruned from the cached tree
+                    current_tree = None
+                else:
+                    profiler.count('stage cache misses')
+            if not cache_hit:
+                if current_tree is None:
+                    logger.write('Loading the tree %s.' % current_tree_fp)
+                    with profiler.phase('load tree'):
+                        current_tree = load_tree(current_tree_fp)
+                logger.write('Filtering the tree to the %d OTU '
+                             'representative sequences.' % similarity_threshold)
+                with profiler.phase('filter tree (%d)' % similarity_threshold):
+                    current_tree = current_tree.prune(
+                        [seq_id.split()[0] for seq_id, _ in
+                         parse_fasta(open(rep_set_fp,'U'))])
+                    tree_f = open_output(tree_fp)
+                    current_tree.write_newick(tree_f)
+                    tree_f.close()
+                if stage_cache is not None:
+                    with profiler.phase('store in stage cache (%d)' %
+                                        similarity_threshold):
+                        stage_cache.store(cache_key, {'tree.tre':tree_fp})
             # prep for the next iteration
             current_tree_fp = tree_fp
         
@@ -127,5 +319,43 @@ def pick_nested_reference_otus(input_fasta_fp,
         commands = []
         files_to_remove = []
         current_inseqs_fp = rep_set_fp
+    
+    if build_tree:
+        with profiler.phase('build unnested tree'):
+            tree = tree_builder.build()
+    if build_unnested_tree:
+        logger.write('Writing the unnested tree and OTU membership index.')
+        with profiler.phase('write unnested tree and index'):
+            progress = ProgressReporter('Writing the unnested tree',
+                                        progress_callback,
+                                        total_records=len(tree))
+            tree_f = open_output(join(output_dir,'unnested.ntree'))
+            write_newick(tree, tree_f, progress=progress)
+            tree_f.close()
+            progress.finish()
+            write_membership_index(tree, join(output_dir,'unnested_index'))
+    if build_exact_index:
+        if memory_budget.fits('build exact index',
+                estimate_exact_index_memory(input_fasta_fp),
+                'with the sequences digested in batches'):
+            exact_index_batch_size = None
+        else:
+            exact_index_batch_size = memory_budget.max_memory // 4
+        logger.write('Writing the exact match index.')
+        with profiler.phase('write exact index'):
+            write_exact_index(tree, input_fasta_fp,
+                              join(output_dir,'exact_index'),
+                              exact_index_batch_size)
+    if write_otu_collection:
+        logger.write('Writing the nested OTU collection.')
+        with profiler.phase('write OTU collection'):
+            write_collection([(similarity_threshold,
+                               '%s/%d_otu_map.txt' % (otu_dir,
+                                                      similarity_threshold),
+                               '%s/%d_otus_%s.fasta' % (rep_set_dir,
+                                   similarity_threshold, run_id))
+                              for similarity_threshold in
+                              similarity_thresholds],
+                             join(output_dir,'nested_otus.npz'), run_id)
         
     logger.close()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+from os import makedirs
+from os.path import exists, join
+from numpy import array, int32, int64, load, savez
+from nested_reference_otus.assign import find_workflow_rep_set
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.seq_store import build_seq_store, SequenceStore
+from nested_reference_otus.unnest import (find_workflow_otu_maps,
+        iter_otu_map, load_otu_map, NestedOTUTreeBuilder)
+from nested_reference_otus.util import open_output
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Single file collection of the nested reference OTUs at every level
+
+pick_nested_reference_otus writes an OTU map and a rep set per level, but the
+rep set of each level is a subset of the one above it, so most sequences are
+written once per level. a collection holds the sequences once, packed as in
+seq_store, and encodes every level as a delta against the level above it:
+
+- centroid_rows are the rows of the sequence block in each level's rep set
+- the members of the OTUs at the highest level are tip_ids, and the members
+  of the OTUs at every other level are the OTUs of the level above, by index
+- otu_parent is the index of the OTU containing each OTU at the level below
+  (-1 at the lowest level), and tip_parent is the OTU of each tip at the
+  highest level
+
+levels go from high -> low similarity, and the OTUs of level i are
+otu_offsets[i]:otu_offsets[i + 1] of otu_ids, otu_reps, otu_parent and
+member_offsets. the collection is one numpy .npz file.
+"""
+
+_store_prefix = 'store_'
+
+def find_workflow_levels(output_dir):
+    """returns [(level, otu_map_fp, rep_set_fp)] from high -> low similarity
+
+    for the files written by pick_nested_reference_otus to output_dir
+    """
+    return [(level, otu_map_fp, find_workflow_rep_set(output_dir, level))
+            for level, otu_map_fp in find_workflow_otu_maps(output_dir)]
+
+def _run_id(rep_set_fp, level):
+    """returns the run id in the name of a workflow rep set"""
+    fn = rep_set_fp.split('/')[-1]
+    prefix = '%d_otus_' % level
+    if fn.startswith(prefix) and fn.endswith('.fasta'):
+        return fn[len(prefix):-len('.fasta')]
+    return ''
+
+def build_collection(levels, run_id=None):
+    """returns {name: array} for the collection of
+    [(level, otu_map_fp, rep_set_fp)]
+
+    levels go from high -> low similarity, as from find_workflow_levels.
+    the sequence block is the highest level's rep set, and the first member
+    of each OTU must be its representative (pick_rep_set.py -m first). if
+    run_id isn't given it's taken from the name of the first rep set
+    """
+    store = build_seq_store(levels[0][2])
+    seq_rows = dict((seq_id, row) for row, seq_id in
+                    enumerate(store['seq_ids'].tolist()))
+
+    def row_of(seq_id, level):
+        try:
+            return seq_rows[seq_id]
+        except KeyError:
+            raise ValueError("%s, a representative at level %d, isn't in "
+                             "the %d rep set" % (seq_id, level, levels[0][0]))
+
+    tip_ids = []
+    tip_parent = []
+    otu_ids = []
+    otu_reps = []
+    otu_parent = []
+    otu_offsets = [0]
+    members = []
+    member_offsets = [0]
+    centroid_rows = []
+    centroid_offsets = [0]
+    # the index of the OTU represented by each sequence at the level above
+    above = None
+    for level_idx, (level, otu_map_fp, rep_set_fp) in enumerate(levels):
+        index = {}
+        for otu_idx, (otu_id, seq_ids) in enumerate(
+                iter_otu_map(load_otu_map(otu_map_fp))):
+            otu_ids.append(otu_id)
+            otu_reps.append(row_of(seq_ids[0], level))
+            otu_parent.append(-1)
+            if above is None:
+                members.extend(range(len(tip_ids), len(tip_ids) +
+                                                   len(seq_ids)))
+                tip_ids.extend(seq_ids)
+                tip_parent.extend([otu_idx] * len(seq_ids))
+            else:
+                for seq_id in seq_ids:
+                    try:
+                        member = above[seq_id]
+                    except KeyError:
+                        raise ValueError("%s, a member of %s at level %d, "
+                                         "isn't a representative at level "
+                                         "%d" % (seq_id, otu_id, level,
+                                                 levels[level_idx - 1][0]))
+                    members.append(member)
+                    otu_parent[otu_offsets[-2] + member] = otu_idx
+            member_offsets.append(len(members))
+            index[seq_ids[0]] = otu_idx
+        otu_offsets.append(len(otu_ids))
+        above = index
+
+        for seq_id, seq in parse_fasta(rep_set_fp):
+            centroid_rows.append(row_of(seq_id.split()[0], level))
+        centroid_offsets.append(len(centroid_rows))
+
+    if run_id is None:
+        run_id = _run_id(levels[0][2], levels[0][0])
+
+    arrays = {'levels': array([level for level, _, _ in levels],
+                              dtype=int64),
+              'run_id': array(run_id, dtype=str),
+              'tip_ids': array(tip_ids, dtype=str),
+              'tip_parent': array(tip_parent, dtype=int32),
+              'otu_ids': array(otu_ids, dtype=str),
+              'otu_reps': array(otu_reps, dtype=int32),
+              'otu_parent': array(otu_parent, dtype=int32),
+              'otu_offsets': array(otu_offsets, dtype=int64),
+              'members': array(members, dtype=int32),
+              'member_offsets': array(member_offsets, dtype=int64),
+              'centroid_rows': array(centroid_rows, dtype=int32),
+              'centroid_offsets': array(centroid_offsets, dtype=int64)}
+    for name, values in store.items():
+        arrays[_store_prefix + name] = values
+    return arrays
+
+def write_collection(levels, collection_fp, run_id=None):
+    """writes the collection of levels (see build_collection) to
+    collection_fp"""
+    # savez adds .npz to a path that doesn't end in it, so give it the file
+    collection_f = open(collection_fp, 'wb')
+    savez(collection_f, **build_collection(levels, run_id))
+    collection_f.close()
+
+class NestedOTUCollection(object):
+    """Reads a collection written by write_collection"""
+    def __init__(self, collection_fp):
+        npz = load(collection_fp)
+        store_arrays = {}
+        for name in npz.files:
+            if name.startswith(_store_prefix):
+                store_arrays[name[len(_store_prefix):]] = npz[name]
+            else:
+                setattr(self, name, npz[name])
+        npz.close()
+        self.store = SequenceStore.from_arrays(store_arrays)
+        self.run_id = str(self.run_id)
+        self._level_index = dict((int(level), idx) for idx, level in
+                                 enumerate(self.levels))
+        self._otu_lookup = {}
+
+    def level_index(self, level):
+        """returns the index of level in levels"""
+        try:
+            return self._level_index[level]
+        except KeyError:
+            raise KeyError("Unknown level: %s" % level)
+
+    def _otu_range(self, level_idx):
+        return self.otu_offsets[level_idx], self.otu_offsets[level_idx + 1]
+
+    def num_otus(self, level):
+        """returns the number of OTUs at level"""
+        start, end = self._otu_range(self.level_index(level))
+        return int(end - start)
+
+    def otu_map(self, level):
+        """yields (otu_id, [member ids]) for each OTU at level, like
+        unnest.parse_otu_map"""
+        level_idx = self.level_index(level)
+        start, end = self._otu_range(level_idx)
+        if level_idx == 0:
+            member_ids = self.tip_ids
+        else:
+            above_start, above_end = self._otu_range(level_idx - 1)
+            member_ids = self.store.seq_ids[
+                    self.otu_reps[above_start:above_end]]
+        for otu in range(start, end):
+            members = self.members[self.member_offsets[otu]:
+                                   self.member_offsets[otu + 1]]
+            yield str(self.otu_ids[otu]), member_ids[members].tolist()
+
+    def centroid_ids(self, level):
+        """returns the ids of the rep set of level, in order"""
+        return self.store.seq_ids[self._centroid_rows(level)].tolist()
+
+    def _centroid_rows(self, level):
+        level_idx = self.level_index(level)
+        return self.centroid_rows[self.centroid_offsets[level_idx]:
+                                  self.centroid_offsets[level_idx + 1]]
+
+    def rep_set(self, level):
+        """yields (seq_id, seq) for the rep set of level, like parse_fasta"""
+        return self.store.iter_seqs(self._centroid_rows(level))
+
+    def sequence(self, seq_id):
+        """returns the representative sequence called seq_id
+
+        raises KeyError if there is no such sequence
+        """
+        return self.store.get(seq_id)
+
+    def _otu_index(self, level_idx, otu_id):
+        lookup = self._otu_lookup.get(level_idx)
+        if lookup is None:
+            start, end = self._otu_range(level_idx)
+            lookup = dict((o, start + i) for i, o in
+                          enumerate(self.otu_ids[start:end].tolist()))
+            self._otu_lookup[level_idx] = lookup
+        try:
+            return lookup[otu_id]
+        except KeyError:
+            raise KeyError("Unknown OTU at level %d: %s" %
+                           (self.levels[level_idx], otu_id))
+
+    def representative(self, level, otu_id):
+        """returns the representative sequence id of otu_id at level"""
+        otu = self._otu_index(self.level_index(level), otu_id)
+        return str(self.store.seq_ids[self.otu_reps[otu]])
+
+    def parent(self, level, otu_id):
+        """returns (level, otu_id) of the OTU containing otu_id at the next
+        lower level, or None at the lowest level"""
+        level_idx = self.level_index(level)
+        parent = self.otu_parent[self._otu_index(level_idx, otu_id)]
+        if parent == -1:
+            return None
+        start, end = self._otu_range(level_idx + 1)
+        return int(self.levels[level_idx + 1]), str(self.otu_ids[start +
+                                                                 parent])
+
+    def nested_tree(self):
+        """returns the unnest.NestedOTUTree of the collection"""
+        last_level = 100
+        builder = NestedOTUTreeBuilder()
+        for level in self.levels.tolist():
+            builder.add_level(self.otu_map(level), float(last_level - level),
+                              level)
+            last_level = level
+        return builder.build()
+
+def export_legacy_files(collection, output_dir, run_id=None):
+    """writes the per level files of a NestedOTUCollection to output_dir
+
+    as pick_nested_reference_otus writes them: otus/<level>_otu_map.txt and
+    rep_set/<level>_otus_<run_id>.fasta. run_id defaults to the run id of the
+    collection
+    """
+    if run_id is None:
+        run_id = collection.run_id
+    otu_dir = join(output_dir, 'otus')
+    rep_set_dir = join(output_dir, 'rep_set')
+    for dir_ in otu_dir, rep_set_dir:
+        if not exists(dir_):
+            makedirs(dir_)
+    for level in collection.levels.tolist():
+        otu_map_f = open_output(join(otu_dir, '%d_otu_map.txt' % level))
+        for otu_id, member_ids in collection.otu_map(level):
+            otu_map_f.write('\t'.join([otu_id] + member_ids) + '\n')
+        otu_map_f.close()
+
+        rep_set_f = open_output(join(rep_set_dir, '%d_otus_%s.fasta' %
+                                     (level, run_id)))
+        for seq_id, seq in collection.rep_set(level):
+            rep_set_f.write('>%s\n%s\n' % (seq_id, seq))
+        rep_set_f.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains lightweight parsers for FASTA, OTU map and taxonomy map files.
+
+These give the same results as the cogent and QIIME parsers that were used
+before, but are faster and don't require importing cogent or QIIME. Every
+parser accepts a filepath, an open file, or any other iterable of lines, and
+reads its input lazily, so whole files never need to be held in memory.
+"""
+
+from itertools import islice
+from nested_reference_otus.progress import track_lines
+
+tax_map_header = "ID Number\tGenBank Number\tNew Taxon String\tSource\n"
+
+# Sequence lines containing any of these need to be stripped (or may be
+# comments), so their records can't take the fast path in parse_fasta.
+_fasta_cleanup_chars = ' \t\r\x0b\x0c#'
+
+def parse_fasta(fasta, buffer_size=1048576, progress=None):
+    """Yields (label, sequence) for each record in FASTA format.
+
+    Gives the same results as cogent's MinimalFastaParser: labels have the
+    leading '>' and surrounding whitespace removed, sequence lines are
+    stripped and joined, and blank lines and lines starting with '#' are
+    ignored. A ValueError is raised for a label without any sequence or for
+    sequence data before the first label.
+
+    The input is read in large chunks and split into records wherever a line
+    starts with '>', so the sequence of a typical record is built with a
+    single replace() call instead of stripping and joining each line.
+
+    Arguments:
+        fasta - a filepath or an open file (read in chunks of buffer_size), or
+            a list (or other iterable) of lines in FASTA format
+        buffer_size - the number of bytes to read from fasta at a time
+        progress - a progress.ProgressReporter to count the records parsed
+            and the bytes read in, or None
+    """
+    pieces = []
+    for chunk in _iter_chunks(fasta, buffer_size):
+        if progress is not None:
+            progress.update(0, len(chunk))
+        if '\n>' not in chunk and not (pieces and
+                                       pieces[-1].endswith('\n') and
+                                       chunk.startswith('>')):
+            pieces.append(chunk)
+            continue
+        pieces.append(chunk)
+        text = ''.join(pieces)
+        # Everything up to the last label line is made of complete records.
+        end = text.rfind('\n>') + 1
+        for record in _track_records(_parse_fasta_block(text[:end]),
+                                     progress):
+            yield record
+        pieces = [text[end:]]
+    for record in _track_records(_parse_fasta_block(''.join(pieces)),
+                                 progress):
+        yield record
+
+def iter_fields(lines, delim='\t'):
+    """Yields (first field, list of remaining fields) for each line.
+
+    The lines are parsed the same way as qiime.parse.fields_to_dict (every
+    field is stripped of surrounding whitespace, and lines with an empty first
+    field are skipped), but one at a time. This is how OTU maps are parsed,
+    yielding (OTU ID, list of seq IDs) for each OTU.
+
+    Arguments:
+        lines - a filepath, an open file, or a list (or other iterable) of
+            lines
+        delim - the field delimiter
+    """
+    for line in iter_lines(lines):
+        fields = [field.strip() for field in line.split(delim)]
+        if fields[0]:
+            yield fields[0], fields[1:]
+
+def fields_to_dict(lines, delim='\t'):
+    """Returns a dictionary mapping first field to list of remaining fields.
+
+    A drop-in replacement for qiime.parse.fields_to_dict. If the same first
+    field appears on more than one line, the last line wins.
+
+    Arguments:
+        lines - a filepath, an open file, or a list (or other iterable) of
+            lines
+        delim - the field delimiter
+    """
+    return dict(iter_fields(lines, delim))
+
+def iter_taxonomy_map(tax_map_lines, seq_ids=None, progress=None):
+    """Yields the taxonomy of each row of a taxonomy mapping file.
+
+    Yields (seq ID, taxonomy string, list of taxonomic levels) for each row.
+    The list of levels is the taxonomy string split at each level, with empty
+    levels (i.e. ';;' or levels containing only whitespace) removed. A
+    ValueError is raised if the header is missing or corrupt, or if a row
+    doesn't have exactly 4 columns.
+
+    Arguments:
+        tax_map_lines - the taxonomy mapping file, including the header line,
+            as a filepath, an open file, or a list (or other iterable) of
+            lines. Only the first line is read before the header is
+            validated
+        seq_ids - a set (or other container supporting fast membership tests)
+            of the sequence IDs to parse. All other rows are skipped without
+            being split into fields. If None, all rows are parsed
+        progress - a progress.ProgressReporter to count the lines (including
+            skipped rows) and bytes read in, or None
+    """
+    tax_map_lines = track_lines(iter_lines(tax_map_lines), progress)
+    if next(tax_map_lines, None) != tax_map_header:
+        raise ValueError("The taxonomy map file appears to be invalid "
+                         "because it is either missing the header or has a "
+                         "corrupt header.")
+    if seq_ids is not None:
+        # The sequence ID is everything before the first tab, so the rows we
+        # don't need can be filtered out cheaply before any real parsing.
+        tax_map_lines = (line for line in tax_map_lines
+                         if line.split('\t', 1)[0].strip() in seq_ids)
+    for seq_id, seq_info in iter_fields(tax_map_lines):
+        if len(seq_info) != 3:
+            raise ValueError("The taxonomy map file appears to be invalid "
+                             "because it does not have exactly 4 columns.")
+        yield seq_id, seq_info[1], [level for level in seq_info[1].split(';')
+                                    if level.strip() != '']
+
+def iter_lines(source):
+    """Returns an iterator over the lines of source.
+
+    Arguments:
+        source - a filepath (which is opened in universal newlines mode, and
+            closed once all of its lines have been read), an open file, or a
+            list (or other iterable) of lines
+    """
+    if isinstance(source, basestring):
+        return _iter_file_lines(source)
+    return iter(source)
+
+def rereadable_lines(source):
+    """Returns source in a form that can be read more than once.
+
+    Functions that need to make more than one pass over their input use this
+    before the first pass. Filepaths are returned as they are, because
+    iter_lines reopens them for each pass, as are lists and tuples. Anything
+    else (e.g. an open file or a generator) can only be read once, so its
+    lines are read into a list.
+
+    Arguments:
+        source - a filepath, an open file, or a list (or other iterable) of
+            lines
+    """
+    if isinstance(source, (basestring, list, tuple)):
+        return source
+    return list(source)
+
+def _track_records(records, progress):
+    """Returns records, counting each one in progress (if provided)."""
+    if progress is None:
+        return records
+    return _count_records(records, progress)
+
+def _count_records(records, progress):
+    for record in records:
+        progress.update()
+        yield record
+
+def _iter_file_lines(fp):
+    f = open(fp, 'U')
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()
+
+def _iter_chunks(fasta, buffer_size, lines_per_chunk=10000):
+    """Yields chunks of text from a file or an iterable of lines."""
+    if isinstance(fasta, basestring):
+        fasta_f = open(fasta, 'U')
+        try:
+            for chunk in _iter_chunks(fasta_f, buffer_size):
+                yield chunk
+        finally:
+            fasta_f.close()
+    elif hasattr(fasta, 'read'):
+        while True:
+            chunk = fasta.read(buffer_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        lines = iter(fasta)
+        while True:
+            batch = list(islice(lines, lines_per_chunk))
+            if not batch:
+                return
+            # Lines don't always come with their newlines (e.g. lists of
+            # lines built by hand).
+            yield ''.join([line if line.endswith('\n') else line + '\n'
+                           for line in batch])
+
+def _parse_fasta_block(text):
+    """Yields the records in text, which must end with a complete record."""
+    records = ('\n' + text).split('\n>')
+    preamble = records[0]
+    if preamble.strip():
+        # Only blank lines and comments are allowed before the first label
+        # (or labels with leading whitespace, which the line parser handles).
+        for record in _parse_fasta_lines(preamble.split('\n')):
+            yield record
+    for record in records[1:]:
+        newline = record.find('\n')
+        if newline == -1:
+            label, body = record, ''
+        else:
+            label, body = record[:newline], record[newline + 1:]
+        # If removing the newlines and cleanup characters only removed the
+        # newlines, the sequence lines needed no stripping.
+        seq = body.translate(None, _fasta_cleanup_chars + '\n')
+        if seq and len(seq) + body.count('\n') == len(body):
+            yield label.strip(), seq
+        else:
+            for record in _parse_fasta_lines(['>' + label] +
+                                             body.split('\n')):
+                yield record
+
+def _parse_fasta_lines(lines):
+    """Parses FASTA lines one at a time, exactly as MinimalFastaParser does."""
+    label = None
+    seq = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('>'):
+            if label is not None:
+                yield _fasta_record(label, seq)
+            label = line[1:].strip()
+            seq = []
+        elif label is None:
+            raise ValueError("Found FASTA sequence data without a label "
+                             "line: %s" % line)
+        else:
+            seq.append(line)
+    if label is not None:
+        yield _fasta_record(label, seq)
+
+def _fasta_record(label, seq):
+    if not seq:
+        raise ValueError("Found FASTA label line without sequences: %s" %
+                         label)
+    return label, ''.join(seq)
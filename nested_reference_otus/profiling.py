@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains the phase profiler behind the scripts' --profile option."""
+
+import re
+from contextlib import contextmanager
+from optparse import make_option
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from time import time
+
+profile_modes = ['none', 'timers', 'cprofile', 'tracemalloc', 'all']
+
+profile_option = make_option('--profile', type='choice',
+        choices=profile_modes, default='none',
+        help='profile the main phases of the run and write a report next to '
+        'the output. "timers" records the wall-clock time, CPU time and peak '
+        'memory of each phase, "cprofile" also records cProfile stats, '
+        '"tracemalloc" also records the top memory allocations (if the '
+        'tracemalloc module is available), and "all" records everything. '
+        'Valid choices are: ' + ', '.join(profile_modes) +
+        ' [default: %default]')
+
+class _NullPhase(object):
+    """A do-nothing context manager used when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_phase = _NullPhase()
+
+class PhaseProfiler(object):
+    """Times the named phases of a run (e.g. parse, compute, sort, write).
+
+    Each phase is wrapped in a with statement:
+
+        profiler = PhaseProfiler(opts.profile)
+        with profiler.phase('parse'):
+            lines = open(fp, 'U').readlines()
+
+    When the mode is 'none', phase() returns a shared do-nothing context
+    manager, so leaving the hooks in place costs nothing. Phases with the
+    same name are accumulated. Phases can't be nested, because only one
+    cProfile profiler can be active at a time.
+
+    Counts of what the run did (e.g. how many sequences were resolved each
+    way) can be recorded with count(), and are reported after the phases.
+    """
+
+    def __init__(self, mode='none', top_n=20):
+        """Initializes a profiler.
+
+        Arguments:
+            mode - one of profile_modes
+            top_n - the number of functions (cProfile) and allocation sites
+                (tracemalloc) to report for each phase
+        """
+        if mode not in profile_modes:
+            raise ValueError("Invalid profile mode '%s'. Must be one of: %s" %
+                             (mode, ', '.join(profile_modes)))
+        self.enabled = mode != 'none'
+        self.use_cprofile = mode in ('cprofile', 'all')
+        self.top_n = top_n
+        self.tracemalloc = None
+        if mode in ('tracemalloc', 'all'):
+            self.tracemalloc = _import_tracemalloc()
+        self.tracemalloc_requested = mode in ('tracemalloc', 'all')
+
+        self.phases = []
+        self.wall_times = {}
+        self.cpu_times = {}
+        self.child_cpu_times = {}
+        self.peak_rss_kb = {}
+        self.profiles = {}
+        self.allocations = {}
+        self.counter_names = []
+        self.counts = {}
+        self._active = None
+
+    def phase(self, name):
+        """Returns a context manager that profiles the phase called name."""
+        if not self.enabled:
+            return _null_phase
+        return self._profile_phase(name)
+
+    def count(self, name, n=1):
+        """Adds n to the counter called name.
+
+        Counters are kept even when profiling is disabled, so callers can
+        report them some other way too.
+        """
+        if name not in self.counts:
+            self.counter_names.append(name)
+            self.counts[name] = 0
+        self.counts[name] += n
+
+    @contextmanager
+    def _profile_phase(self, name):
+        if self._active is not None:
+            raise ValueError("Cannot start phase '%s' inside phase '%s'." %
+                             (name, self._active))
+        self._active = name
+        if name not in self.wall_times:
+            self.phases.append(name)
+            self.wall_times[name] = 0.0
+            self.cpu_times[name] = 0.0
+            self.child_cpu_times[name] = 0.0
+
+        if self.tracemalloc is not None:
+            if not self.tracemalloc.is_tracing():
+                self.tracemalloc.start()
+            snapshot_before = self.tracemalloc.take_snapshot()
+        profile = None
+        if self.use_cprofile:
+            from cProfile import Profile
+            profile = self.profiles.setdefault(name, Profile())
+        self_before = _cpu_time(RUSAGE_SELF)
+        children_before = _cpu_time(RUSAGE_CHILDREN)
+        start = time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.wall_times[name] += time() - start
+            self.cpu_times[name] += _cpu_time(RUSAGE_SELF) - self_before
+            self.child_cpu_times[name] += \
+                    _cpu_time(RUSAGE_CHILDREN) - children_before
+            self.peak_rss_kb[name] = getrusage(RUSAGE_SELF).ru_maxrss
+            if self.tracemalloc is not None:
+                stats = self.tracemalloc.take_snapshot().compare_to(
+                        snapshot_before, 'lineno')
+                self.allocations[name] = [str(stat)
+                                          for stat in stats[:self.top_n]]
+            self._active = None
+
+    def format_report(self):
+        """Returns the lines of a human-readable report of all phases."""
+        lines = ['Phase\tWall time (s)\tCPU time (s)\tChild CPU time (s)\t'
+                 'Peak RSS (KB)\n']
+        for name in self.phases:
+            lines.append('%s\t%.3f\t%.3f\t%.3f\t%d\n' % (name,
+                    self.wall_times[name], self.cpu_times[name],
+                    self.child_cpu_times[name], self.peak_rss_kb[name]))
+        lines.append('Total\t%.3f\t%.3f\t%.3f\t%d\n' % (
+                sum(self.wall_times.values()), sum(self.cpu_times.values()),
+                sum(self.child_cpu_times.values()),
+                max(self.peak_rss_kb.values() or [0])))
+        if self.counter_names:
+            lines.append('\nCounter\tCount\n')
+            for name in self.counter_names:
+                lines.append('%s\t%d\n' % (name, self.counts[name]))
+
+        if self.tracemalloc_requested and self.tracemalloc is None:
+            lines.append('\nThe tracemalloc module is not available, so no '
+                         'memory allocations were recorded.\n')
+        for name in self.phases:
+            if name in self.profiles:
+                from pstats import Stats
+                from StringIO import StringIO
+                stats_f = StringIO()
+                stats = Stats(self.profiles[name], stream=stats_f)
+                stats.sort_stats('cumulative').print_stats(self.top_n)
+                lines.append('\ncProfile stats for phase %s:\n' % name)
+                lines.append(stats_f.getvalue())
+            if name in self.allocations:
+                lines.append('\nTop memory allocations in phase %s:\n' % name)
+                lines.extend([line + '\n' for line in self.allocations[name]])
+        return lines
+
+    def write(self, report_fp):
+        """Writes the report to report_fp.
+
+        If cProfile stats were recorded, the raw stats for each phase are
+        also written next to report_fp (as <report_fp>.<phase>.prof), so
+        that they can be loaded with pstats or other profile viewers. Does
+        nothing if profiling is disabled.
+        """
+        if not self.enabled:
+            return
+        report_f = open(report_fp, 'w')
+        report_f.writelines(self.format_report())
+        report_f.close()
+        for name, profile in self.profiles.items():
+            profile.dump_stats('%s.%s.prof' % (report_fp,
+                                               re.sub(r'\W+', '_', name)))
+
+def _cpu_time(who):
+    usage = getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def _import_tracemalloc():
+    # tracemalloc is in the standard library from Python 3.4. Older Pythons
+    # need the pytracemalloc backport (and a patched interpreter).
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
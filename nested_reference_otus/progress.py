@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains the progress reporter used by long-running loops."""
+
+from time import time
+from nested_reference_otus.memory import format_size
+
+class ProgressReporter(object):
+    """Reports how far a long-running loop has got.
+
+    The loop calls update() as it goes, and every interval seconds a message
+    with the number of records processed and bytes read, the current rate,
+    and (if the totals are known) the percentage done and estimated time
+    remaining is passed to callback:
+
+        progress = ProgressReporter('Parsing sequences', callback,
+                                    total_bytes=getsize(fasta_fp))
+        for seq_id, seq in parse_fasta(fasta_fp, progress=progress):
+            ...
+        progress.finish()
+
+    which reports messages like:
+
+        Parsing sequences: 1,200,000 records, 512.0M of 2.0G (25.0%),
+        40,000 records/s, 17.1M/s, ETA 0:01:29
+
+    (on one line). The rates are measured since the previous message, so
+    they show whether a run is still making progress, and the ETA assumes
+    the current byte rate (or record rate, if only total_records is known)
+    continues.
+
+    If callback is None, the reporter is disabled and update() only counts,
+    so the hooks can be left in place. The callback can be anything that
+    takes a message, such as a workflow's status_update_callback or a
+    WorkflowLogger's write method (see forward_progress).
+    """
+
+    def __init__(self, task, callback=None, total_records=None,
+                 total_bytes=None, interval=10.0, timer=time):
+        """Initializes a reporter, starting the clock.
+
+        Arguments:
+            task - a short description of the loop, which starts each message
+            callback - a function called with each message, or None to
+                disable reporting
+            total_records - the number of records the loop will process, if
+                known
+            total_bytes - the number of bytes the loop will read (or write),
+                if known
+            interval - the minimum number of seconds between messages
+            timer - a function returning the current time in seconds (for
+                testing)
+        """
+        self.task = task
+        self.callback = callback
+        self.total_records = total_records
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.records = 0
+        self.bytes = 0
+        self._timer = timer
+        self.start_time = self._last_time = timer()
+        self._last_records = 0
+        self._last_bytes = 0
+
+    def update(self, records=1, num_bytes=0):
+        """Counts records and bytes, reporting if interval has passed.
+
+        Arguments:
+            records - the number of records processed since the last update
+            num_bytes - the number of bytes read since the last update
+        """
+        self.records += records
+        self.bytes += num_bytes
+        if self.callback is None:
+            return
+        now = self._timer()
+        if now - self._last_time >= self.interval:
+            self.callback(self.message(now))
+            self._last_time = now
+            self._last_records = self.records
+            self._last_bytes = self.bytes
+
+    def track(self, items):
+        """Yields each of items, counting it as a record."""
+        for item in items:
+            self.update()
+            yield item
+
+    def finish(self):
+        """Reports the totals and overall rates of the finished loop."""
+        if self.callback is None:
+            return
+        now = self._timer()
+        elapsed = now - self.start_time
+        parts = [_format_count(self.records, 'record')]
+        if self.bytes:
+            parts.append(format_size(self.bytes))
+        parts.append('done in %s' % format_duration(elapsed))
+        if elapsed > 0:
+            parts.append('%s records/s' %
+                         _format_rate(self.records / elapsed))
+        self.callback('%s: %s' % (self.task, ', '.join(parts)))
+
+    def message(self, now=None):
+        """Returns the message describing the current progress.
+
+        Arguments:
+            now - the current time, as returned by timer. Defaults to now
+        """
+        if now is None:
+            now = self._timer()
+        elapsed = now - self._last_time
+        parts = [_format_count(self.records, 'record')]
+        if self.total_records and not self.total_bytes:
+            parts[-1] += ' of %s (%.1f%%)' % (
+                    _format_number(self.total_records),
+                    100 * self.records / self.total_records)
+        if self.total_bytes:
+            parts.append('%s of %s (%.1f%%)' % (format_size(self.bytes),
+                    format_size(self.total_bytes),
+                    100 * self.bytes / self.total_bytes))
+        elif self.bytes:
+            parts.append(format_size(self.bytes))
+
+        record_rate = byte_rate = None
+        if elapsed > 0:
+            record_rate = (self.records - self._last_records) / elapsed
+            parts.append('%s records/s' % _format_rate(record_rate))
+            if self.bytes:
+                byte_rate = (self.bytes - self._last_bytes) / elapsed
+                parts.append('%s/s' % format_size(byte_rate))
+
+        if self.total_bytes and byte_rate:
+            remaining = (self.total_bytes - self.bytes) / byte_rate
+        elif self.total_records and not self.total_bytes and record_rate:
+            remaining = (self.total_records - self.records) / record_rate
+        else:
+            remaining = None
+        if remaining is not None:
+            parts.append('ETA %s' % format_duration(max(remaining, 0)))
+        return '%s: %s' % (self.task, ', '.join(parts))
+
+def forward_progress(*callbacks):
+    """Returns a progress callback that passes messages to every callback.
+
+    Callbacks that are None are skipped, and if none are left, None is
+    returned (which disables reporting).
+
+    Arguments:
+        callbacks - functions that take a message, such as a workflow's
+            status_update_callback and its logger's write method
+    """
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if not callbacks:
+        return None
+
+    def callback(message):
+        for forward in callbacks:
+            forward(message)
+    return callback
+
+def track_lines(lines, progress):
+    """Yields lines, counting each one (and its length) in progress.
+
+    Arguments:
+        lines - an iterable of lines
+        progress - a ProgressReporter, or None to yield lines untouched
+    """
+    if progress is None:
+        for line in lines:
+            yield line
+        return
+    for line in lines:
+        progress.update(1, len(line))
+        yield line
+
+def format_duration(seconds):
+    """Returns seconds as H:MM:SS (e.g. 1:02:03).
+
+    Arguments:
+        seconds - a number of seconds, rounded to the nearest second
+    """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def _format_number(number):
+    return '{0:,}'.format(int(round(number)))
+
+def _format_rate(rate):
+    # Slow loops (e.g. over big OTUs) still show that they're moving.
+    if rate < 10:
+        return '%.1f' % rate
+    return _format_number(rate)
+
+def _format_count(count, noun):
+    return '%s %s%s' % (_format_number(count), noun,
+                        '' if count == 1 else 's')
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from os.path import isdir
+from numpy import (arange, argsort, array, concatenate, cumsum, flatnonzero,
+                   frombuffer, full, int64, searchsorted, uint8, zeros)
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.util import load_arrays, save_arrays
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""2-bit packed store of reference sequences
+
+the bases of all of the sequences are packed end to end, 4 to a byte, and
+sequence i is bases offsets[i]:offsets[i + 1]. sequences are stored in
+uppercase. A, C, G and T are packed as is, and anything else (N, IUPAC codes,
+gaps) is packed as A with the real character kept in a side table of
+exception positions. the store is memory-mapped read-only, so any number of
+processes can share one copy of it through the page cache, and sequences are
+only decoded when they're asked for.
+"""
+
+_bases = 'ACGT'
+_codes = full(256, 255, dtype=uint8)
+for _code, _base in enumerate(_bases):
+    _codes[ord(_base)] = _code
+_decode = frombuffer(_bases, dtype=uint8)
+_shifts = array([6, 4, 2, 0], dtype=uint8)
+
+def pack_codes(codes):
+    """returns codes (one 2-bit code per byte) packed 4 to a byte
+
+    the first code of each byte is in its high bits. the last byte is padded
+    with 0s
+    """
+    padded = zeros((len(codes) + 3) // 4 * 4, dtype=uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape((-1, 4))
+    return ((padded[:, 0] << 6) | (padded[:, 1] << 4) |
+            (padded[:, 2] << 2) | padded[:, 3]).astype(uint8)
+
+def unpack_codes(packed, start, end):
+    """returns the 2-bit codes of bases start:end of packed"""
+    chunk = packed[start // 4:(end + 3) // 4]
+    codes = ((chunk[:, None] >> _shifts) & 3).ravel()
+    offset = start % 4
+    return codes[offset:offset + end - start]
+
+def _iter_batches(fasta, batch_size):
+    """yields (seq_ids, seqs) for sequences totalling about batch_size
+    bases at a time"""
+    seq_ids = []
+    seqs = []
+    num_bases = 0
+    for seq_id, seq in parse_fasta(fasta):
+        seq_ids.append(seq_id.split()[0])
+        seqs.append(seq)
+        num_bases += len(seq)
+        if num_bases >= batch_size:
+            yield seq_ids, seqs
+            seq_ids = []
+            seqs = []
+            num_bases = 0
+    if seqs:
+        yield seq_ids, seqs
+
+def build_seq_store(fasta, batch_size=2 ** 24):
+    """returns {name: array} for the packed store of the sequences in fasta
+
+    the sequences are packed batch_size bases at a time, so building the
+    store takes about a quarter of a byte per base plus one batch
+    """
+    seq_ids = []
+    lengths = []
+    packed = []
+    exception_positions = []
+    exception_chars = []
+    # codes that didn't fill a byte, carried over to the next batch
+    leftover = zeros(0, dtype=uint8)
+    num_bases = 0
+    for batch_ids, seqs in _iter_batches(fasta, batch_size):
+        seq_ids.extend(batch_ids)
+        lengths.extend(map(len, seqs))
+        chars = frombuffer(''.join(seqs).upper(), dtype=uint8)
+        codes = _codes[chars]
+        exceptions = flatnonzero(codes == 255)
+        exception_positions.append(exceptions + num_bases)
+        exception_chars.append(chars[exceptions])
+        codes[exceptions] = 0
+        num_bases += len(codes)
+
+        codes = concatenate([leftover, codes])
+        full_bytes = len(codes) // 4 * 4
+        packed.append(pack_codes(codes[:full_bytes]))
+        leftover = codes[full_bytes:]
+    packed.append(pack_codes(leftover))
+
+    seq_ids = array(seq_ids, dtype=str)
+    id_order = argsort(seq_ids, kind='mergesort')
+    return {'seq_ids': seq_ids,
+            'sorted_seq_ids': seq_ids[id_order],
+            'sorted_seq_ranks': id_order.astype(int64),
+            'offsets': concatenate([zeros(1, dtype=int64),
+                                    cumsum(array(lengths, dtype=int64))]),
+            'packed': concatenate(packed),
+            'exception_positions': concatenate(
+                    exception_positions or [zeros(0, dtype=int64)]),
+            'exception_chars': concatenate(
+                    exception_chars or [zeros(0, dtype=uint8)])}
+
+def write_seq_store(fasta, store_dir):
+    """writes the packed store of the sequences in fasta to store_dir"""
+    save_arrays(store_dir, build_seq_store(fasta))
+
+class SequenceStore(object):
+    """Decodes sequences on demand from a store written by write_seq_store
+
+    a sequence is O(length) to decode by index, and O(log n + length) by
+    id. only the pages holding the sequence are read
+    """
+    def __init__(self, store_dir, mmap_mode='r'):
+        self._set_arrays(load_arrays(store_dir, mmap_mode))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """returns a store of the arrays returned by build_seq_store"""
+        store = cls.__new__(cls)
+        store._set_arrays(arrays)
+        return store
+
+    def _set_arrays(self, arrays):
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.seq_ids)
+
+    def __iter__(self):
+        return self.iter_seqs()
+
+    def index(self, seq_id):
+        """returns the index of seq_id, or -1"""
+        idx = searchsorted(self.sorted_seq_ids, seq_id)
+        if idx == len(self) or self.sorted_seq_ids[idx] != seq_id:
+            return -1
+        return int(self.sorted_seq_ranks[idx])
+
+    def sequence(self, idx):
+        """returns the sequence at index idx"""
+        start = self.offsets[idx]
+        end = self.offsets[idx + 1]
+        chars = _decode[unpack_codes(self.packed, start, end)]
+        lo = searchsorted(self.exception_positions, start)
+        hi = searchsorted(self.exception_positions, end)
+        if hi > lo:
+            chars[self.exception_positions[lo:hi] - start] = \
+                    self.exception_chars[lo:hi]
+        return chars.tostring()
+
+    def get(self, seq_id):
+        """returns the sequence called seq_id
+
+        raises KeyError if there is no such sequence
+        """
+        idx = self.index(seq_id)
+        if idx == -1:
+            raise KeyError("Unknown sequence: %s" % seq_id)
+        return self.sequence(idx)
+
+    def iter_seqs(self, indices=None):
+        """yields (seq_id, seq) for each of indices (default all), like
+        parse_fasta"""
+        if indices is None:
+            indices = arange(len(self))
+        for idx in indices:
+            yield str(self.seq_ids[idx]), self.sequence(idx)
+
+def _as_store(source):
+    """returns source as a SequenceStore if it is one or is the path of one,
+    otherwise None"""
+    if isinstance(source, SequenceStore):
+        return source
+    if isinstance(source, basestring) and isdir(source):
+        return SequenceStore(source)
+    return None
+
+def iter_reference_seqs(source):
+    """yields (seq_id, seq) from a SequenceStore, the directory of one, or
+    FASTA (anything parse_fasta takes)"""
+    store = _as_store(source)
+    if store is None:
+        return parse_fasta(source)
+    return iter(store)
+
+def get_reference_seqs(source, seq_ids):
+    """returns {seq_id: seq} for the seq_ids found in source
+
+    source is as for iter_reference_seqs. a store only decodes the
+    sequences asked for, where FASTA has to be read in full
+    """
+    seq_ids = set(seq_ids)
+    seqs = {}
+    store = _as_store(source)
+    if store is None:
+        for seq_id, seq in parse_fasta(source):
+            seq_id = seq_id.split()[0]
+            if seq_id in seq_ids:
+                seqs[seq_id] = seq
+    else:
+        for seq_id in seq_ids:
+            idx = store.index(seq_id)
+            if idx != -1:
+                seqs[seq_id] = store.sequence(idx)
+    return seqs
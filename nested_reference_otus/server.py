@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains a server that answers queries from reference data kept in memory.
+
+Parsing a large taxonomy map or loading a membership index takes much longer
+than answering a single query against it, so the server keeps everything it
+loads in memory (keyed by filepath) and only reloads a file when it changes.
+Clients talk to the server over a Unix socket, sending one JSON request per
+line and receiving one JSON response per line. The socket is only accessible
+by the user running the server, and clients can only query files under the
+server's reference directories.
+"""
+
+import json
+from os import chmod, listdir, remove, stat
+from os.path import abspath, exists, isdir, join, realpath, sep
+from socket import AF_UNIX, error as socket_error, SOCK_STREAM, socket
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from traceback import format_exc
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.sort_seqs import (compute_taxonomic_depths,
+                                             sort_seqs_by_taxonomic_depth)
+from nested_reference_otus.summarize_taxonomic_agreement import (
+        parse_taxonomic_information, summarize_taxonomic_agreement)
+
+default_unknown_keywords = ['Incertae_sedis', 'unidentified']
+
+class RequestError(ValueError):
+    """An error in a request, whose message is safe to send to the client."""
+    pass
+
+class ReferenceCache(object):
+    """Keeps parsed reference files in memory until they change on disk.
+
+    Each file is loaded by a loader function the first time it is requested,
+    and the result is reused for as long as the file's modification time and
+    size stay the same. Checking a file costs a single stat() call per
+    request, so edits to a reference file are picked up by the next request
+    that uses it without any polling in between. Directories (e.g. membership
+    indexes) are checked file by file.
+
+    The cache is safe to use from multiple threads. A file that is requested
+    by several threads while it is being loaded is only loaded once.
+
+    If reference_dirs is given, only files and directories inside them can
+    be loaded (after resolving symlinks and '..'), so a client can't make
+    the server read anything else it has access to.
+    """
+
+    def __init__(self, reference_dirs=None):
+        """Initializes an empty cache.
+
+        Arguments:
+            reference_dirs - a list of the directories whose files may be
+                loaded, or None to allow any file
+        """
+        if reference_dirs is None:
+            self.reference_dirs = None
+        else:
+            self.reference_dirs = [realpath(dir_) for dir_ in reference_dirs]
+        self._lock = Lock()
+        self._key_locks = {}
+        self._loaded = {}
+        self.num_loads = 0
+
+    def get(self, loader, fp, *args):
+        """Returns loader(fp, *args), loading it only if fp has changed.
+
+        Arguments:
+            loader - a function that takes fp (and args) and returns the
+                parsed contents of fp. The result must not be modified by
+                the caller, because it is shared between requests
+            fp - the path of the file or directory to load
+            args - any additional (hashable) arguments to pass to loader.
+                Each combination of loader, fp and args is cached separately
+
+        Raises a RequestError if fp isn't in one of reference_dirs.
+        """
+        fp = self.check_path(fp)
+        key = (loader, fp) + args
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+        with key_lock:
+            # The signature is taken before loading, so a file that changes
+            # while it is being loaded will be loaded again next time.
+            signature = _file_signature(fp)
+            loaded = self._loaded.get(key)
+            if loaded is None or loaded[0] != signature:
+                loaded = (signature, loader(fp, *args))
+                with self._lock:
+                    self._loaded[key] = loaded
+                    self.num_loads += 1
+            return loaded[1]
+
+    def check_path(self, fp):
+        """Returns the real path of fp, if it may be loaded.
+
+        Raises a RequestError if fp isn't in one of reference_dirs.
+        """
+        if not isinstance(fp, basestring):
+            raise RequestError("File paths must be strings.")
+        if self.reference_dirs is None:
+            return fp
+        real_fp = realpath(abspath(fp))
+        for dir_ in self.reference_dirs:
+            if real_fp == dir_ or real_fp.startswith(dir_.rstrip(sep) + sep):
+                return real_fp
+        raise RequestError("%s isn't in one of the server's reference "
+                           "directories." % fp)
+
+def answer_request(cache, request, error_f=None):
+    """Answers a single request, returning the response.
+
+    A request is a dictionary containing the name of the command and its
+    parameters. The response is a dictionary whose 'status' is 'ok' (along
+    with the results of the command) or 'error' (along with a 'message'
+    describing what went wrong). The commands are:
+
+        ping - does nothing
+        sort_seqs - sorts sequences by taxonomic depth and then by length
+            (see sort_seqs_by_taxonomic_depth). Takes taxonomy_fp, either
+            fasta (a string or list of lines) or fasta_fp (a FASTA file or
+            a sequence store directory), and optionally unknown_keywords.
+            Returns 'seqs', a list of [seq ID, taxonomic depth, length,
+            sequence]. Sequences that aren't in the taxonomy map have a
+            taxonomic depth of 0
+        summarize - summarizes taxonomic agreement (see
+            summarize_taxonomic_agreement). Takes taxonomy_fp, either otu_map
+            (a list of lines) or otu_map_fp, and optionally taxonomic_levels,
+            sample_size, size_cutoff and seed. Returns 'lines', the lines of
+            the summary (without a header)
+        tips - lists the sequences in an OTU. Takes index_dir, level and
+            otu_id. Returns 'tips', a list of seq IDs
+        ancestors - lists the OTUs containing a sequence. Takes index_dir and
+            seq_id. Returns 'ancestors', a list of [level, OTU ID, rep seq ID]
+        get_seqs - looks up sequences by ID. Takes store_dir (a sequence
+            store, see seq_store) and seq_ids. Returns 'seqs', a list of
+            [seq ID, sequence]
+
+    Only errors in the request itself (such as a missing parameter, a file
+    outside the reference directories or an unknown OTU) are described in
+    the message. Any other error, such as a reference file that can't be
+    read or parsed, gets a generic message, because the details could
+    reveal the contents of files the client can't read itself. Those
+    details are written to error_f instead.
+
+    Arguments:
+        cache - the ReferenceCache holding the reference files that have
+            already been loaded
+        request - the request dictionary (e.g. as parsed from JSON). Any
+            other value gets an error response
+        error_f - a file-like object (e.g. sys.stderr) to write the
+            traceback of any error other than a RequestError to, or None
+    """
+    command = None
+    try:
+        if not isinstance(request, dict):
+            raise RequestError("Requests must be JSON objects.")
+        command = _get_param(request, 'command')
+        if command not in _commands:
+            raise RequestError("Unknown command: %s" % command)
+        response = _commands[command](cache, request)
+    except RequestError, e:
+        return {'status': 'error', 'message': str(e)}
+    except Exception, e:
+        # A bad request (or reference file) shouldn't take down the server.
+        if error_f is not None:
+            error_f.write(format_exc())
+            error_f.flush()
+        return {'status': 'error',
+                'message': "The %s request failed (%s). See the server's "
+                           "error output for details." %
+                           (command, e.__class__.__name__)}
+    response['status'] = 'ok'
+    return response
+
+class ReferenceServer(ThreadingMixIn, UnixStreamServer):
+    """Serves requests on a Unix socket, each connection in its own thread.
+
+    Each line received on a connection is parsed as a JSON request and
+    answered with answer_request, so a client can send any number of
+    requests (one at a time) over a single connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_fp, cache=None, reference_dirs=None,
+                 error_f=None):
+        """Binds the server to socket_fp.
+
+        Raises a ValueError if another server is already listening on
+        socket_fp. A socket file left behind by a server that didn't shut
+        down cleanly is removed. The socket is made readable and writable
+        by its owner only.
+
+        Arguments:
+            socket_fp - the path of the Unix socket to listen on
+            cache - the ReferenceCache to load reference files into. If not
+                provided, a new (empty) cache is used
+            reference_dirs - the directories whose files clients may query,
+                if a new cache is created (see ReferenceCache)
+            error_f - a file-like object to write the details of failed
+                requests to (see answer_request), or None
+        """
+        _remove_stale_socket(socket_fp)
+        UnixStreamServer.__init__(self, socket_fp, _RequestHandler)
+        self.socket_fp = socket_fp
+        if cache is None:
+            cache = ReferenceCache(reference_dirs)
+        self.cache = cache
+        self.error_f = error_f
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        chmod(self.server_address, 0600)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if exists(self.socket_fp):
+            remove(self.socket_fp)
+
+def send_requests(socket_fp, requests):
+    """Sends requests to the server at socket_fp, returning the responses.
+
+    The requests are sent one at a time over a single connection.
+
+    Arguments:
+        socket_fp - the path of the server's Unix socket
+        requests - a list of request dictionaries (see answer_request)
+    """
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    sock.connect(socket_fp)
+    responses_f = sock.makefile('rb')
+    try:
+        responses = []
+        for request in requests:
+            sock.sendall(json.dumps(request) + '\n')
+            responses.append(json.loads(responses_f.readline()))
+        return responses
+    finally:
+        responses_f.close()
+        sock.close()
+
+def send_request(socket_fp, request):
+    """Sends a single request to the server at socket_fp.
+
+    Returns the response dictionary (see answer_request).
+    """
+    return send_requests(socket_fp, [request])[0]
+
+class _RequestHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'status': 'error',
+                            'message': "Invalid JSON request: %s" %
+                                       line.strip()}
+            else:
+                response = answer_request(self.server.cache, request,
+                                          self.server.error_f)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+def _ping(cache, request):
+    return {}
+
+def _sort_seqs(cache, request):
+    unknown_keywords = request.get('unknown_keywords',
+                                   default_unknown_keywords)
+    taxonomic_depths = cache.get(_load_taxonomic_depths,
+            _get_str_param(request, 'taxonomy_fp'),
+            tuple(_encode(unknown_keywords)))
+    if 'fasta_fp' in request:
+        seqs = cache.get(_load_fasta, _get_str_param(request, 'fasta_fp'))
+    else:
+        seqs = parse_fasta(_get_lines_param(request, 'fasta'))
+
+    # Unlike compute_sequence_stats, only the requested sequences are
+    # included. The taxonomy map is usually the whole reference, so its other
+    # sequences aren't missing from the query, just not part of it.
+    seq_stats = {}
+    for seq_id, seq in seqs:
+        seq_stats[seq_id] = [taxonomic_depths.get(seq_id, 0), len(seq), seq]
+    return {'seqs': sort_seqs_by_taxonomic_depth(seq_stats)}
+
+def _summarize(cache, request):
+    taxonomic_levels = request.get('taxonomic_levels', 8)
+    tax_map = cache.get(_load_tax_map,
+                        _get_str_param(request, 'taxonomy_fp'),
+                        taxonomic_levels)
+    if 'otu_map_fp' in request:
+        otu_map_lines = cache.get(_read_lines,
+                                  _get_str_param(request, 'otu_map_fp'))
+    else:
+        otu_map_lines = _get_lines_param(request, 'otu_map')
+    return {'lines': list(summarize_taxonomic_agreement(otu_map_lines, None,
+            taxonomic_levels, request.get('sample_size'),
+            request.get('size_cutoff'), request.get('seed', 0), tax_map))}
+
+def _tips(cache, request):
+    index = cache.get(_load_membership_index,
+                      _get_str_param(request, 'index_dir'))
+    try:
+        level = int(_get_param(request, 'level'))
+    except (TypeError, ValueError):
+        raise RequestError("level must be an integer.")
+    tips = _lookup(index.tips, level, _get_str_param(request, 'otu_id'))
+    return {'tips': [str(tip) for tip in tips]}
+
+def _ancestors(cache, request):
+    index = cache.get(_load_membership_index,
+                      _get_str_param(request, 'index_dir'))
+    ancestors = _lookup(index.ancestors, _get_str_param(request, 'seq_id'))
+    return {'ancestors': [[level, str(otu_id), str(rep)]
+                          for level, otu_id, rep in ancestors]}
+
+def _get_seqs(cache, request):
+    store = cache.get(_load_seq_store, _get_str_param(request, 'store_dir'))
+    return {'seqs': [[seq_id, _lookup(store.get, seq_id)] for seq_id in
+                     _encode(_get_param(request, 'seq_ids'))]}
+
+def _lookup(f, *args):
+    # The membership index and sequence store raise KeyErrors naming the
+    # unknown level, OTU or sequence, which came from the request.
+    try:
+        return f(*args)
+    except KeyError, e:
+        raise RequestError(str(e.args[0]))
+
+_commands = {'ping': _ping,
+             'sort_seqs': _sort_seqs,
+             'summarize': _summarize,
+             'tips': _tips,
+             'ancestors': _ancestors,
+             'get_seqs': _get_seqs}
+
+def _read_lines(fp):
+    return open(fp, 'U').readlines()
+
+def _load_taxonomic_depths(fp, unknown_keywords):
+    return compute_taxonomic_depths(fp, unknown_keywords)
+
+def _load_tax_map(fp, taxonomic_levels):
+    return parse_taxonomic_information(fp, taxonomic_levels)
+
+def _load_fasta(fp):
+    if isdir(fp):
+        return _load_seq_store(fp)
+    return list(parse_fasta(fp))
+
+def _load_seq_store(store_dir):
+    from nested_reference_otus.seq_store import SequenceStore
+
+    # Read into memory for the same reason as the membership index below. At
+    # 2 bits per base it's still a fraction of the size of the FASTA file.
+    return SequenceStore(store_dir, mmap_mode=None)
+
+def _load_membership_index(index_dir):
+    from nested_reference_otus.membership_index import OTUMembershipIndex
+
+    # The arrays are read into memory instead of being memory-mapped, so that
+    # rewriting the index while it is being served can't corrupt queries that
+    # are in progress.
+    return OTUMembershipIndex(index_dir, mmap_mode=None)
+
+def _file_signature(fp):
+    if isdir(fp):
+        return tuple([(name, _file_signature(join(fp, name)))
+                      for name in sorted(listdir(fp))])
+    info = stat(fp)
+    return info.st_mtime, info.st_size
+
+def _get_param(request, name):
+    if name not in request:
+        raise RequestError("Missing required parameter: %s" % name)
+    return request[name]
+
+def _get_str_param(request, name):
+    return _encode(_get_param(request, name))
+
+def _get_lines_param(request, name):
+    lines = _get_param(request, name)
+    if isinstance(lines, basestring):
+        lines = lines.splitlines(True)
+    return _encode(lines)
+
+def _encode(value):
+    # JSON strings are parsed as unicode, but the parsers work on bytes.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(e) for e in value]
+    return value
+
+def _remove_stale_socket(socket_fp):
+    if not exists(socket_fp):
+        return
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        sock.connect(socket_fp)
+    except socket_error:
+        remove(socket_fp)
+    else:
+        raise ValueError("A server is already listening on %s." % socket_fp)
+    finally:
+        sock.close()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+from math import exp, log
+from numpy import (arange, argsort, array, concatenate, cumsum, empty,
+                   flatnonzero, frombuffer, full, int64, minimum, searchsorted,
+                   uint8, uint64, zeros)
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.util import load_arrays, save_arrays
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""MinHash sketches of k-mers, indexed for fast approximate similarity
+
+each sequence is sketched with one-permutation MinHash: its k-mers are hashed,
+the hashes are split into sketch_size bins, and the smallest hash in each bin
+is kept. the fraction of bins in which two sketches agree estimates the
+Jaccard similarity of their k-mer sets, which is converted to an estimated
+identity with the Mash distance. for fast queries the sketches are also
+indexed with LSH banding: sequences whose sketches agree in every bin of at
+least one band are candidates, and only the candidates are compared in full.
+the number of rows per band is chosen from the lowest identity the index is
+meant to be queried at, so that matches at that identity are rarely missed
+while dissimilar sequences are rarely candidates.
+"""
+
+# marks a bin that no k-mer hashed to
+EMPTY = uint64(2 ** 64 - 1)
+
+# 2-bit codes for the nucleotides. anything else (N, gaps, IUPAC codes) is 4,
+# and k-mers containing it are skipped
+_codes = full(256, 4, dtype=uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for _base in _bases:
+        _codes[ord(_base)] = _code
+
+def _mix(x):
+    """the splitmix64 finalizer, vectorized over a uint64 array"""
+    x = x ^ (x >> uint64(30))
+    x = x * uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> uint64(27))
+    x = x * uint64(0x94d049bb133111eb)
+    return x ^ (x >> uint64(31))
+
+def _encode(seqs):
+    """returns (codes, starts) for seqs joined end to end
+
+    the sequences are separated by an invalid base so that no k-mer spans two
+    of them. starts[i] is the offset of sequence i in codes
+    """
+    joined = '\0'.join(seqs)
+    codes = _codes[frombuffer(joined, dtype=uint8)]
+    lengths = array([len(seq) + 1 for seq in seqs], dtype=int64)
+    starts = concatenate([zeros(1, dtype=int64), cumsum(lengths)[:-1]])
+    return codes, starts
+
+def kmer_hashes(codes, k):
+    """returns (positions, hashes) for every valid k-mer in codes
+
+    codes are 2-bit nucleotide codes (4 for anything else), and k must be at
+    most 32. positions are the start offsets of the k-mers
+    """
+    num_kmers = len(codes) - k + 1
+    if num_kmers < 1:
+        return zeros(0, dtype=int64), zeros(0, dtype=uint64)
+    # a k-mer is valid if its window holds no invalid codes
+    invalid = concatenate([zeros(1, dtype=int64),
+                           cumsum(codes == 4, dtype=int64)])
+    valid = invalid[k:] == invalid[:num_kmers]
+
+    kmers = zeros(num_kmers, dtype=uint64)
+    two = uint64(2)
+    for offset in range(k):
+        kmers <<= two
+        kmers |= (codes[offset:offset + num_kmers] & 3).astype(uint64)
+    positions = flatnonzero(valid)
+    return positions, _mix(kmers[positions])
+
+def compute_sketches(seqs, k=16, sketch_size=128):
+    """returns a (len(seqs), sketch_size) uint64 array of sketches
+
+    all of seqs are sketched at once, so pass them in batches of a few
+    thousand (see iter_sketches)
+    """
+    if not seqs:
+        return zeros((0, sketch_size), dtype=uint64)
+    codes, starts = _encode(seqs)
+    positions, hashes = kmer_hashes(codes, k)
+    seq_idx = searchsorted(starts, positions, 'right') - 1
+    keys = seq_idx * sketch_size + (hashes % uint64(sketch_size)).astype(int64)
+
+    # the minimum hash of each (sequence, bin)
+    order = argsort(keys, kind='mergesort')
+    keys = keys[order]
+    hashes = hashes[order]
+    firsts = flatnonzero(concatenate([[True], keys[1:] != keys[:-1]])) \
+            if len(keys) else zeros(0, dtype=int64)
+
+    sketches = full(len(seqs) * sketch_size, EMPTY, dtype=uint64)
+    if len(firsts):
+        sketches[keys[firsts]] = minimum.reduceat(hashes, firsts)
+    return sketches.reshape((len(seqs), sketch_size))
+
+def iter_sketches(fasta, k=16, sketch_size=128, batch_size=5000):
+    """yields (seq_ids, sketches) for batches of the sequences in fasta
+
+    fasta can be a filepath, an open file or a list of lines
+    """
+    seq_ids = []
+    seqs = []
+    for seq_id, seq in parse_fasta(fasta):
+        seq_ids.append(seq_id.split()[0])
+        seqs.append(seq)
+        if len(seqs) == batch_size:
+            yield seq_ids, compute_sketches(seqs, k, sketch_size)
+            seq_ids = []
+            seqs = []
+    if seqs:
+        yield seq_ids, compute_sketches(seqs, k, sketch_size)
+
+def band_keys(sketches, rows_per_band):
+    """returns a (num_bands, len(sketches)) uint64 array of LSH band keys
+
+    band b covers sketch columns [b * rows_per_band, (b + 1) * rows_per_band).
+    trailing columns that don't fill a band aren't banded
+    """
+    num_bands = sketches.shape[1] // rows_per_band
+    keys = empty((num_bands, len(sketches)), dtype=uint64)
+    for band in range(num_bands):
+        key = _mix(full(len(sketches), band + 1, dtype=uint64))
+        for column in range(band * rows_per_band,
+                            (band + 1) * rows_per_band):
+            key = _mix(key ^ sketches[:, column])
+        keys[band] = key
+    return keys
+
+def jaccard_to_identity(jaccard, k):
+    """the Mash estimate of sequence identity from k-mer Jaccard similarity"""
+    if jaccard <= 0:
+        return 0.0
+    return max(0.0, 1 + log(2 * jaccard / (1 + jaccard)) / k)
+
+def identity_to_jaccard(identity, k):
+    """the k-mer Jaccard similarity expected at identity (inverse of
+    jaccard_to_identity)"""
+    if identity <= 0:
+        return 0.0
+    shared = exp(-k * (1 - min(identity, 1.0)))
+    return shared / (2 - shared)
+
+def band_recall(identity, k, sketch_size, rows_per_band):
+    """the probability that a sequence at identity to a query shares at
+    least one band with it"""
+    jaccard = identity_to_jaccard(identity, k)
+    return 1 - (1 - jaccard ** rows_per_band) ** (sketch_size // rows_per_band)
+
+def choose_rows_per_band(min_identity, k=16, sketch_size=128,
+                         min_recall=0.97):
+    """returns the most rows per band that still find at least min_recall
+    of the matches at min_identity
+
+    more rows per band prune more: with k=16 and 128 bins, 1 row makes nearly
+    every 16S reference a candidate, as the conserved regions share k-mers.
+    this gives 3 rows at 97% identity, 2 at 94% and 1 at 90%
+    """
+    rows_per_band = 1
+    while rows_per_band < sketch_size and \
+            band_recall(min_identity, k, sketch_size,
+                        rows_per_band + 1) >= min_recall:
+        rows_per_band += 1
+    return rows_per_band
+
+def estimate_jaccard(sketch, sketches):
+    """returns the estimated Jaccard similarity of sketch to each of sketches
+
+    bins that are empty in both sketches are ignored
+    """
+    sketch_empty = sketch == EMPTY
+    matches = ((sketches == sketch) & ~sketch_empty).sum(axis=1)
+    both_empty = ((sketches == EMPTY) & sketch_empty).sum(axis=1)
+    used = sketches.shape[1] - both_empty
+    used[used == 0] = 1
+    return matches / used.astype(float)
+
+def build_sketch_index(fasta, k=16, sketch_size=128, rows_per_band=None,
+                       batch_size=5000, min_identity=0.97):
+    """returns {name: array} for the sketch index of the sequences in fasta
+
+    rows_per_band defaults to the choice of choose_rows_per_band for
+    min_identity, the lowest identity the index will be queried at. the band
+    keys are stored sorted within each band (band_order maps them
+    back to sequences), so a band is looked up with a binary search
+    """
+    if not 1 <= k <= 32:
+        raise ValueError("k must be between 1 and 32: %d" % k)
+    if rows_per_band is None:
+        rows_per_band = choose_rows_per_band(min_identity, k, sketch_size)
+    if not 1 <= rows_per_band <= sketch_size:
+        raise ValueError("rows_per_band must be between 1 and the sketch "
+                         "size: %d" % rows_per_band)
+    seq_ids = []
+    batches = []
+    for batch_ids, sketches in iter_sketches(fasta, k, sketch_size,
+                                             batch_size):
+        seq_ids.extend(batch_ids)
+        batches.append(sketches)
+    if batches:
+        sketches = concatenate(batches)
+    else:
+        sketches = zeros((0, sketch_size), dtype=uint64)
+
+    keys = band_keys(sketches, rows_per_band)
+    band_order = argsort(keys, axis=1, kind='mergesort')
+    sorted_keys = keys[arange(len(keys))[:, None], band_order]
+    return {'params': array([k, sketch_size, rows_per_band], dtype=int64),
+            'seq_ids': array(seq_ids, dtype=str),
+            'sketches': sketches,
+            'band_keys': sorted_keys,
+            'band_order': band_order.astype(int64)}
+
+def write_sketch_index(fasta, index_dir, k=16, sketch_size=128,
+                       rows_per_band=None, min_identity=0.97):
+    """writes the sketch index of the sequences in fasta to index_dir"""
+    save_arrays(index_dir, build_sketch_index(fasta, k, sketch_size,
+                                              rows_per_band,
+                                              min_identity=min_identity))
+
+class SketchIndex(object):
+    """Finds the indexed sequences that are similar to a query sequence
+
+    the index is memory-mapped, so opening it is cheap. a query looks up each
+    of its band keys (O(bands * log n)), and estimates the identity of the
+    candidates from their full sketches
+    """
+    def __init__(self, index_dir, mmap_mode='r'):
+        arrays = load_arrays(index_dir, mmap_mode)
+        for name, values in arrays.items():
+            setattr(self, name, values)
+        self.k, self.sketch_size, self.rows_per_band = \
+                [int(p) for p in self.params]
+
+    def __len__(self):
+        return len(self.seq_ids)
+
+    def sketch(self, seq):
+        """returns the sketch of seq, comparable with the indexed sketches"""
+        return compute_sketches([seq], self.k, self.sketch_size)[0]
+
+    def candidates(self, sketch):
+        """returns the indexes of the sequences sharing a band with sketch"""
+        keys = band_keys(sketch.reshape((1, len(sketch))),
+                         self.rows_per_band)[:, 0]
+        found = []
+        for band, key in enumerate(keys):
+            band_keys_ = self.band_keys[band]
+            lo = searchsorted(band_keys_, key, 'left')
+            hi = searchsorted(band_keys_, key, 'right')
+            if hi > lo:
+                found.append(self.band_order[band][lo:hi])
+        if not found:
+            return zeros(0, dtype=int64)
+        found = concatenate(found)
+        found.sort()
+        return found[concatenate([[True], found[1:] != found[:-1]])]
+
+    def query(self, seq, min_identity=0.97, use_bands=True):
+        """returns [(seq_id, estimated identity)] for the indexed sequences
+        estimated to be at least min_identity identical to seq
+
+        ordered by decreasing identity. with use_bands, only the sequences
+        sharing a band with seq are compared. this can miss distant matches,
+        more so with more rows per band (with 2 rows, about 2% of matches at
+        94% identity and half of those at 90% are missed), so min_identity
+        shouldn't be below the identity the index was built for. without it,
+        every indexed sketch is compared
+        """
+        sketch = self.sketch(seq)
+        if use_bands:
+            rows = self.candidates(sketch)
+        else:
+            rows = arange(len(self), dtype=int64)
+        if not len(rows):
+            return []
+        jaccard = estimate_jaccard(sketch, self.sketches[rows])
+        keep = flatnonzero(jaccard >= identity_to_jaccard(min_identity,
+                                                          self.k) - 1e-12)
+        rows = rows[keep]
+        jaccard = jaccard[keep]
+        order = argsort(-jaccard, kind='mergesort')
+        return [(str(self.seq_ids[rows[i]]),
+                 jaccard_to_identity(jaccard[i], self.k)) for i in order]
@@ -12,18 +12,67 @@ __status__ = "Development"
 
 """Contains functions used in the sort_seqs.py script."""
 
+from collections import OrderedDict
+from heapq import merge
+from marshal import dump, load
 from operator import itemgetter
-from cogent.parse.fasta import MinimalFastaParser
-from qiime.parse import fields_to_dict
+from os import fdopen, remove
+from tempfile import mkstemp
+from nested_reference_otus.memory import input_size
+from nested_reference_otus.parse import iter_taxonomy_map, parse_fasta
+from nested_reference_otus.progress import ProgressReporter
 
-def compute_sequence_stats(fasta_lines, tax_map_lines, unknown_keywords=None):
+def compute_taxonomic_depths(tax_map_lines, unknown_keywords=None,
+                             progress_callback=None):
+    """Computes the relevant taxonomic depth of each sequence.
+
+    Returns a dictionary with sequence ID as the key and the relevant
+    taxonomic depth (integer) as the value. See compute_sequence_stats for how
+    the relevant taxonomic depth is computed.
+
+    Arguments:
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        unknown_keywords - a list of strings corresponding to taxonomic level
+            strings that should be ignored when computing the relevant
+            taxonomic depth
+        progress_callback - a function that is periodically passed a
+            message describing the progress of parsing the taxonomy mapping
+            file (see progress.ProgressReporter), or None
+    """
+    taxonomic_depths = {}
+
+    # Empty levels and levels that contain only whitespace have already been
+    # removed.
+    progress = ProgressReporter('Parsing taxonomy', progress_callback,
+                                total_bytes=input_size(tax_map_lines))
+    for seq_id, taxonomy_str, taxonomy in iter_taxonomy_map(tax_map_lines,
+            progress=progress):
+        # Remove any 'unknown' taxonomy levels before computing the known
+        # taxonomy depth.
+        if unknown_keywords:
+            for unknown_keyword in unknown_keywords:
+                while unknown_keyword in taxonomy:
+                    taxonomy.remove(unknown_keyword)
+        taxonomic_depths[seq_id] = len(taxonomy)
+    progress.finish()
+    return taxonomic_depths
+
+def compute_sequence_stats(fasta_lines, tax_map_lines, unknown_keywords=None,
+                           progress_callback=None):
     """Generates statistics for the input sequences.
 
-    Returns a dictionary with sequence ID as the key, and a list of statistics
-    as the value. The statistics (in order of placement in the list) are:
+    Returns an ordered dictionary with sequence ID as the key, and a list of
+    statistics as the value. The statistics (in order of placement in the
+    list) are:
         relevant taxonomic depth (integer)
         sequence read length (integer)
         sequence data (string)
+
+    The sequences are in FASTA file order, followed by the IDs that are only
+    in the taxonomy mapping file (whose lists hold only the taxonomic
+    depth). If an ID appears more than once in the FASTA file, only its
+    first sequence is kept.
     
     For example, the relevant taxonomic depth for the taxonomy string 'A;B;C'
     would be 3. If unknown_keywords is supplied, any taxonomic level matching
@@ -32,58 +81,63 @@ def compute_sequence_stats(fasta_lines, tax_map_lines, unknown_keywords=None):
     an unknown keyword, the relevant taxonomic depth of 'A;B;Z;C' will be 3.
 
     Arguments:
-        fasta_lines - list of lines in FASTA format (the result of calling
-            readlines() on the open file handle)
-        tax_map_lines - list of lines from the taxonomy mapping file (the
-            result of calling readlines() on the open file handle)
+        fasta_lines - the sequences in FASTA format, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
         unknown_keywords - a list of strings corresponding to taxonomic level
             strings that should be ignored when computing the relevant
             taxonomic depth
+        progress_callback - a function that is periodically passed a
+            message describing the progress of parsing the input files (see
+            progress.ProgressReporter), or None
     """
-    seq_stats = {}
-
-    if tax_map_lines[0] != \
-            "ID Number\tGenBank Number\tNew Taxon String\tSource\n":
-        raise ValueError("The taxonomy map file appears to be invalid "
-                         "because it is either missing the header or has a "
-                         "corrupt header.")
-
-    # Record the taxonomy depths for each sequence.
-    for seq_id, seq_info in fields_to_dict(tax_map_lines[1:]).items():
-        if len(seq_info) != 3:
-            raise ValueError("The taxonomy map file appears to be invalid "
-                             "because it does not have exactly 4 columns.")
-        # Split at each level and remove any empty levels or levels that
-        # contain only whitespace.
-        taxonomy = [level for level in seq_info[1].split(';') \
-                    if level.strip() != '']
+    taxonomic_depths = compute_taxonomic_depths(tax_map_lines,
+                                                unknown_keywords,
+                                                progress_callback)
 
-        # Remove any 'unknown' taxonomy levels before computing the known
-        # taxonomy depth.
-        if unknown_keywords:
-            for unknown_keyword in unknown_keywords:
-                while unknown_keyword in taxonomy:
-                    taxonomy.remove(unknown_keyword)
-        seq_stats[seq_id] = [len(taxonomy)]
+    # Record the sequence data and sequence length for each sequence, in
+    # FASTA file order so that sort_seqs_by_taxonomic_depth keeps ties in
+    # that order.
+    seq_stats = OrderedDict()
+    progress = ProgressReporter('Parsing sequences', progress_callback,
+                                total_bytes=input_size(fasta_lines))
+    for seq_id, seq in parse_fasta(fasta_lines, progress=progress):
+        depth = _lookup_depth(seq_id, taxonomic_depths, seq_stats)
+        if depth is not None:
+            seq_stats[seq_id] = [depth, len(seq), seq]
+    progress.finish()
 
-    # Record the sequence data and sequence length for each sequence.
-    for seq_id, seq in MinimalFastaParser(fasta_lines):
-        if seq_id in seq_stats:
-            seq_stats[seq_id].extend([len(seq), seq])
-        else:
-            print ("Found sequence id '%s' in the FASTA file that wasn't in "
-                   "the taxonomy mapping file\n" % seq_id)
-            # Assign a taxonomic depth of 0 because we don't have any
-            # taxonomic information for the sequence.
-            seq_stats[seq_id] = [0, len(seq), seq]
+    for seq_id, depth in taxonomic_depths.items():
+        if seq_id not in seq_stats:
+            seq_stats[seq_id] = [depth]
     return seq_stats
 
+def _lookup_depth(seq_id, taxonomic_depths, seen_seq_ids):
+    """Returns the taxonomic depth of a FASTA record, or None to skip it.
+
+    Prints a warning for a duplicate ID (which is skipped) or an ID without
+    taxonomy (which gets a depth of 0).
+    """
+    if seq_id in seen_seq_ids:
+        print ("Found duplicate sequence id '%s' in the FASTA file; only "
+               "its first sequence is kept\n" % seq_id)
+        return None
+    if seq_id in taxonomic_depths:
+        return taxonomic_depths[seq_id]
+    print ("Found sequence id '%s' in the FASTA file that wasn't in the "
+           "taxonomy mapping file\n" % seq_id)
+    # Assign a taxonomic depth of 0 because we don't have any taxonomic
+    # information for the sequence.
+    return 0
+
 def sort_seqs_by_taxonomic_depth(seq_stats):
     """Sorts the input sequences by relevant taxonomic depth and read length.
 
     The sequences are sorted by relevant taxonomic depth (descending) and for
     sequences with the same taxonomic depth, the sequences are sorted by read
-    length (descending).
+    length (descending). Sequences that tie keep their order in seq_stats,
+    which is FASTA file order for the output of compute_sequence_stats.
 
     Returns a list of lists containing the following inner elements:
         sequence ID (string)
@@ -110,3 +164,119 @@ def sort_seqs_by_taxonomic_depth(seq_stats):
     # information first, with sequences having the same level of taxonomic
     # information ordered by decreasing length.
     return sorted(seq_stats_list, key=itemgetter(1, 2), reverse=True)
+
+def estimate_sort_memory(fasta_lines, tax_map_lines):
+    """Estimates the memory (in bytes) needed to sort sequences in memory.
+
+    compute_sequence_stats holds every sequence, and a dictionary entry per
+    taxonomy map row. Python string and list overhead roughly doubles the
+    size of the sequences, and a row's entry takes about as much memory as
+    the row does on disk. Inputs that aren't filepaths count as 0.
+
+    Arguments:
+        fasta_lines - the sequences in FASTA format, as passed to
+            compute_sequence_stats
+        tax_map_lines - the taxonomy mapping file, as passed to
+            compute_sequence_stats
+    """
+    return 2 * input_size(fasta_lines) + input_size(tax_map_lines)
+
+def sort_seqs_on_disk(fasta_lines, tax_map_lines, unknown_keywords=None,
+                      run_size=268435456, temp_dir=None,
+                      progress_callback=None):
+    """Sorts sequences as sort_seqs_by_taxonomic_depth does, using temporary
+    files instead of holding every sequence in memory.
+
+    This is an external merge sort: the sequences are read in runs of about
+    run_size bytes, each run is sorted and written to a temporary file, and
+    the runs are merged as the results are read. Only the taxonomic depth of
+    each sequence and the current run are kept in memory.
+
+    Yields the same lists as sort_seqs_by_taxonomic_depth does for the
+    output of compute_sequence_stats, in the same order (sequences that tie
+    are kept in FASTA file order, and only the first sequence of a
+    duplicate ID is kept), and prints the same warnings. The temporary files
+    are removed once every sequence has been yielded.
+
+    Arguments:
+        fasta_lines - the sequences in FASTA format, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        unknown_keywords - a list of strings corresponding to taxonomic level
+            strings that should be ignored when computing the relevant
+            taxonomic depth
+        run_size - the number of bytes of sequence data to sort in memory at
+            a time
+        temp_dir - the directory to write the runs to, or None for the
+            system's temporary directory
+        progress_callback - see compute_sequence_stats
+    """
+    taxonomic_depths = compute_taxonomic_depths(tax_map_lines,
+                                                unknown_keywords,
+                                                progress_callback)
+    seen_seq_ids = set()
+    run_fps = []
+    try:
+        run = []
+        run_bytes = 0
+        progress = ProgressReporter('Parsing and sorting sequences',
+                                    progress_callback,
+                                    total_bytes=input_size(fasta_lines))
+        for seq_idx, (seq_id, seq) in enumerate(parse_fasta(fasta_lines,
+                progress=progress)):
+            depth = _lookup_depth(seq_id, taxonomic_depths, seen_seq_ids)
+            if depth is None:
+                continue
+            seen_seq_ids.add(seq_id)
+            # Negated, so that an ascending sort (and merge) puts the deepest,
+            # longest sequences first, and ties stay in file order.
+            run.append((-depth, -len(seq), seq_idx, seq_id, seq))
+            run_bytes += len(seq) + len(seq_id)
+            if run_bytes >= run_size:
+                run_fps.append(_write_sorted_run(run, temp_dir))
+                run = []
+                run_bytes = 0
+        if run or not run_fps:
+            run_fps.append(_write_sorted_run(run, temp_dir))
+        run = None
+        progress.finish()
+
+        for seq_id in taxonomic_depths:
+            if seq_id not in seen_seq_ids:
+                print ("Found sequence id '%s' in the taxonomy mapping file "
+                       "that wasn't in the FASTA file\n" % seq_id)
+        taxonomic_depths = seen_seq_ids = None
+
+        for neg_depth, neg_len, _, seq_id, seq in merge(
+                *[_iter_sorted_run(run_fp) for run_fp in run_fps]):
+            yield [seq_id, -neg_depth, -neg_len, seq]
+    finally:
+        for run_fp in run_fps:
+            remove(run_fp)
+
+def _write_sorted_run(run, temp_dir):
+    """Sorts run and writes it to a new temporary file, returning its path."""
+    run.sort()
+    fd, run_fp = mkstemp(prefix='sort_seqs_run_', suffix='.bin', dir=temp_dir)
+    run_f = fdopen(fd, 'wb')
+    try:
+        # marshal round-trips IDs and sequences containing any characters
+        # (such as tabs and newlines), and is faster than pickle.
+        for entry in run:
+            dump(entry, run_f)
+    finally:
+        run_f.close()
+    return run_fp
+
+def _iter_sorted_run(run_fp):
+    """Yields the entries written by _write_sorted_run."""
+    run_f = open(run_fp, 'rb')
+    try:
+        while True:
+            try:
+                yield load(run_f)
+            except EOFError:
+                break
+    finally:
+        run_f.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains the content-addressed cache of workflow stage outputs."""
+
+from hashlib import sha1
+from os import link, listdir, makedirs, remove, rename, stat, utime
+from os.path import abspath, exists, getsize, isdir, join
+from shutil import copy2, rmtree
+from tempfile import mkdtemp
+
+class StageCache(object):
+    """Caches the output files of workflow stages across runs.
+
+    A stage's outputs are stored under a key computed from the stage name,
+    the contents of its input files and its parameters (e.g. the command it
+    runs and the version of the tool that runs it), so a rerun with the same
+    inputs gets the same outputs back no matter where the files live:
+
+        key = cache.key('pick otus', [input_fasta_fp], {'similarity': 0.97})
+        if not cache.fetch(key, {'otu_map': otu_map_fp}):
+            ... run the stage, writing otu_map_fp ...
+            cache.store(key, {'otu_map': otu_map_fp})
+
+    Files are hardlinked in and out of the cache when they're on the same
+    filesystem, and copied otherwise. Outputs must not be modified in place
+    after they're stored or fetched, because a hardlinked file is shared
+    with the cache: a stage that runs again must replace its outputs, by
+    writing them with util.open_output (which unlinks a hardlinked file
+    first) or by renaming a new file over them.
+
+    Each entry is a directory in cache_dir named by its key. An entry's
+    modification time is updated whenever it's fetched, and once the cache
+    holds more than max_size bytes the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """Initializes a cache, creating cache_dir if it doesn't exist.
+
+        Arguments:
+            cache_dir - the directory to keep the cache in. It can be shared
+                by any number of runs
+            max_size - the maximum size of the cache (in bytes), or None for
+                no limit
+        """
+        self.cache_dir = abspath(cache_dir)
+        self.max_size = max_size
+        if not exists(self.cache_dir):
+            makedirs(self.cache_dir)
+        # Digests of input files, keyed by (device, inode, size, mtime), so
+        # that a file isn't read again when it's the input of several stages
+        # (hardlinks to the same file share a digest).
+        self._digests = {}
+
+    def file_digest(self, fp, buffer_size=1048576):
+        """Returns the SHA-1 hex digest of the contents of fp."""
+        info = stat(fp)
+        memo_key = (info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            hasher = sha1()
+            f = open(fp, 'rb')
+            try:
+                data = f.read(buffer_size)
+                while data:
+                    hasher.update(data)
+                    data = f.read(buffer_size)
+            finally:
+                f.close()
+            digest = hasher.hexdigest()
+            self._digests[memo_key] = digest
+        return digest
+
+    def key(self, stage, input_fps, params=None):
+        """Returns the cache key of a stage.
+
+        Arguments:
+            stage - the name of the stage
+            input_fps - the paths of the stage's input files. Only their
+                contents (and order) matter, not their names
+            params - a dictionary of anything else that determines the
+                stage's outputs, such as its command and tool versions. Keys
+                and values are compared by their str()
+        """
+        hasher = sha1()
+        hasher.update('stage\t%s\n' % stage)
+        for fp in input_fps:
+            hasher.update('input\t%s\n' % self.file_digest(fp))
+        for name, value in sorted((params or {}).items()):
+            hasher.update('param\t%s\t%s\n' % (name, value))
+        return hasher.hexdigest()
+
+    def _entry_dir(self, key):
+        return join(self.cache_dir, key)
+
+    def fetch(self, key, output_fps):
+        """Places the cached outputs of key at output_fps.
+
+        Returns True if every output was found, and False (leaving nothing
+        behind at output_fps) otherwise.
+
+        Arguments:
+            key - the key returned by key()
+            output_fps - a dictionary mapping each output's name (as passed
+                to store()) to the path to place it at
+        """
+        entry_dir = self._entry_dir(key)
+        if not isdir(entry_dir):
+            return False
+        placed = []
+        try:
+            for name, fp in output_fps.items():
+                _link_or_copy(join(entry_dir, name), fp)
+                placed.append(fp)
+            # Mark the entry as the most recently used.
+            utime(entry_dir, None)
+        except (IOError, OSError):
+            # The entry is incomplete, or was evicted while it was fetched.
+            for fp in placed:
+                _remove_file(fp)
+            return False
+        return True
+
+    def store(self, key, output_fps):
+        """Adds the outputs of key to the cache, then evicts old entries.
+
+        The entry appears all at once, so other runs sharing the cache never
+        see a partial entry. If another run stored the same key first, its
+        entry is kept.
+
+        Arguments:
+            key - the key returned by key()
+            output_fps - a dictionary mapping a name for each output (a
+                valid file name) to its path
+        """
+        entry_dir = self._entry_dir(key)
+        if isdir(entry_dir):
+            return
+        temp_dir = mkdtemp(prefix='.incomplete_', dir=self.cache_dir)
+        try:
+            for name, fp in output_fps.items():
+                _link_or_copy(fp, join(temp_dir, name))
+            rename(temp_dir, entry_dir)
+        except OSError:
+            # Another run finished storing this key first.
+            rmtree(temp_dir, ignore_errors=True)
+            if not isdir(entry_dir):
+                raise
+        self.evict()
+
+    def entries(self):
+        """Returns [(last used time, size in bytes, key)] of every entry."""
+        result = []
+        for key in listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith('.') or not isdir(entry_dir):
+                continue
+            try:
+                size = sum([getsize(join(entry_dir, fn))
+                            for fn in listdir(entry_dir)])
+                result.append((stat(entry_dir).st_mtime, size, key))
+            except OSError:
+                # Evicted by another run while it was being measured.
+                continue
+        return result
+
+    def size(self):
+        """Returns the total size of the cached outputs (in bytes)."""
+        return sum([size for _, size, _ in self.entries()])
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in
+        max_size. Returns the keys of the removed entries."""
+        if self.max_size is None:
+            return []
+        entries = sorted(self.entries())
+        total = sum([size for _, size, _ in entries])
+        evicted = []
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+def _link_or_copy(source_fp, dest_fp):
+    """Hardlinks source_fp to dest_fp, or copies it across filesystems."""
+    _remove_file(dest_fp)
+    try:
+        link(source_fp, dest_fp)
+    except OSError:
+        if not exists(source_fp):
+            raise
+        copy2(source_fp, dest_fp)
+
+def _remove_file(fp):
+    if exists(fp):
+        remove(fp)
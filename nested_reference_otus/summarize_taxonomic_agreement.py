@@ -12,15 +12,27 @@ __status__ = "Development"
 
 """Contains functions used in the summarize_taxonomic_agreement.py script."""
 
-from qiime.parse import fields_to_dict
+from binascii import hexlify
+from hashlib import md5
+from itertools import islice
+from math import sqrt
+from random import Random
+import sqlite3
+from nested_reference_otus.memory import input_size
+from nested_reference_otus.parse import (fields_to_dict, iter_fields,
+                                         iter_lines, iter_taxonomy_map,
+                                         rereadable_lines)
+from nested_reference_otus.progress import ProgressReporter
 
 def summarize_taxonomic_agreement(otu_map_lines, tax_map_lines,
-                                  taxonomic_levels=8):
+                                  taxonomic_levels=8, sample_size=None,
+                                  size_cutoff=None, seed=0, tax_map=None,
+                                  on_disk=False, progress_callback=None):
     """Computes a summary of taxonomic agreement between ref and its seqs.
 
-    Returns a list of lines suitable for writing to an output file. Each line
-    is for a single OTU, and the OTUs are ordered the same as the input OTU
-    map. The columns are separated by tabs.
+    Yields lines suitable for writing to an output file. Each line is for a
+    single OTU, and the OTUs are ordered the same as the input OTU map. The
+    columns are separated by tabs.
     
     The first column is the OTU ID, followed by the OTU size (number of seqs,
     including the ref), followed by a comma-separated list of sequence
@@ -32,42 +44,385 @@ def summarize_taxonomic_agreement(otu_map_lines, tax_map_lines,
     taxonomic values that were encountered at that level, with the reference
     taxonomy listed first.
 
+    If sample_size is provided, the summary is approximate: large OTUs are
+    summarized from a random sample of their members (see
+    _estimate_otu_taxonomic_agreement), and a final column is added for each
+    taxonomic level containing the 95% confidence interval of the percent
+    agreement at that level (e.g. '91.20%-97.35%'). For OTUs that were not
+    sampled, the interval is just the exact percent agreement.
+
+    The OTU map is read twice: once to find the sequences whose taxonomy is
+    needed, and again to summarize the OTUs one at a time as their lines are
+    yielded. Neither the OTU map nor the summary is held in memory (unless the
+    OTU map is an open file or other iterable that can only be read once, in
+    which case its lines are read into a list first).
+
+    Arguments:
+        otu_map_lines - the OTU map, as a filepath, an open file, or a list
+            (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        taxonomic_levels - the number of taxonomic levels in the taxonomy
+            strings found in the taxonomy mapping file. All taxonomy strings
+            must have this number of levels to prevent inconsistent results in
+            the summary
+        sample_size - the number of non-reference members to sample from
+            each large OTU. If None (the default), all members of every OTU
+            are compared to the reference and the summary is exact
+        size_cutoff - only OTUs with more than this many members (including
+            the reference) are sampled. Defaults to sample_size + 1, which
+            samples every OTU that has more members than would be sampled
+        seed - the random seed. The members sampled from an OTU depend only
+            on the seed and the OTU's members, so results are reproducible
+        tax_map - the output of parse_taxonomic_information for the taxonomy
+            mapping file. If provided, tax_map_lines and taxonomic_levels are
+            ignored, so that a taxonomy mapping file that is summarized
+            against repeatedly only needs to be parsed once
+        on_disk - if True, the taxonomy is loaded into a temporary database
+            on disk instead of a dictionary, so memory use doesn't grow with
+            the size of the taxonomy mapping file (see
+            estimate_taxonomic_agreement_memory). Ignored if tax_map is
+            provided
+        progress_callback - a function that is periodically passed a
+            message describing the progress of parsing the taxonomy and
+            computing the agreement (see progress.ProgressReporter), or None
+    """
+    for otu_id, agreement_info in _compute_taxonomic_agreement(
+            _OTUMapReader(otu_map_lines), tax_map_lines, taxonomic_levels,
+            sample_size, size_cutoff, seed, tax_map, on_disk,
+            progress_callback):
+        yield _format_taxonomic_agreement(otu_id, agreement_info)
+
+def update_taxonomic_agreement_summary(otu_map_lines, tax_map_lines,
+                                       previous_otu_map_lines,
+                                       previous_summary_lines,
+                                       changed_seq_ids, taxonomic_levels=8,
+                                       on_disk=False, progress_callback=None):
+    """Updates a previous taxonomic agreement summary for a new OTU map.
+
+    Yields the same lines that summarize_taxonomic_agreement would yield for
+    otu_map_lines and tax_map_lines, but only recomputes the OTUs that may
+    have changed since previous_summary_lines was generated.
+
+    An OTU's previous summary line is reused if the previous OTU map contains
+    an OTU with exactly the same members (in the same order, so that the
+    reference is the same), and none of those members have had their
+    taxonomy changed. The OTU ID is allowed to differ between the two maps.
+    All other OTUs are recomputed, and taxonomy is only loaded for their
+    members.
+
+    Arguments:
+        otu_map_lines - the OTU map, as a filepath, an open file, or a list
+            (or other iterable) of lines
+        tax_map_lines - the (new) taxonomy mapping file, as a filepath, an
+            open file, or a list (or other iterable) of lines
+        previous_otu_map_lines - the OTU map that previous_summary_lines was
+            generated from (as a filepath, an open file, or a list of lines)
+        previous_summary_lines - the lines output by a previous call to
+            summarize_taxonomic_agreement, or the output file written by
+            summarize_taxonomic_agreement.py (including its header line) as a
+            filepath or an open file
+        changed_seq_ids - the sequence IDs whose taxonomy differs between the
+            taxonomy mapping file used to generate previous_summary_lines and
+            tax_map_lines. This includes sequences that were added or removed
+        taxonomic_levels - the number of taxonomic levels in the taxonomy
+            strings found in the taxonomy mapping file. Must be the same as
+            what was used to generate previous_summary_lines
+        on_disk, progress_callback - see summarize_taxonomic_agreement
+    """
+    previous_summary = {}
+    for line in iter_lines(previous_summary_lines):
+        if line.startswith('OTU_ID\t'):
+            continue
+        otu_id, summary = line.split('\t', 1)
+        if not summary.endswith('\n'):
+            summary += '\n'
+        previous_summary[otu_id] = summary
+
+    previous_otus = {}
+    for otu_id, seq_ids in fields_to_dict(previous_otu_map_lines).items():
+        if otu_id in previous_summary:
+            previous_otus[_hash_otu_membership(seq_ids)] = \
+                    previous_summary[otu_id]
+
+    changed_seq_ids = set(changed_seq_ids)
+    otu_map = _OTUMapReader(otu_map_lines)
+    otus_to_compute = {}
+    for otu_id, seq_ids in otu_map:
+        if _reuse_previous_summary(seq_ids, previous_otus,
+                                   changed_seq_ids) is None:
+            otus_to_compute[otu_id] = seq_ids
+    taxonomic_agreement = dict(_compute_taxonomic_agreement(
+            otus_to_compute.items(), tax_map_lines, taxonomic_levels,
+            on_disk=on_disk, progress_callback=progress_callback))
+
+    for otu_id, seq_ids in otu_map:
+        previous = _reuse_previous_summary(seq_ids, previous_otus,
+                                           changed_seq_ids)
+        if previous is None:
+            yield _format_taxonomic_agreement(otu_id,
+                                              taxonomic_agreement[otu_id])
+        else:
+            yield '%s\t%s' % (otu_id, previous)
+
+def summarize_taxonomic_agreement_arrays(otu_map_lines, tax_map_lines,
+                                         taxonomic_levels=8, on_disk=False,
+                                         progress_callback=None):
+    """Computes a summary of taxonomic agreement as columnar NumPy arrays.
+
+    This contains the same information as summarize_taxonomic_agreement, but
+    in a compact binary layout that is suitable for writing with
+    util.save_arrays and loading again (memory-mapped, without any parsing)
+    with util.load_arrays.
+
+    Returns a dictionary mapping array name to NumPy array. The OTUs are
+    ordered the same as the input OTU map. The arrays are:
+        otu_ids - the OTU IDs (string array)
+        sizes - the size of each OTU, including the ref (int64 array)
+        agreement - the percent agreement at each taxonomic level (float32
+            array with shape (number of OTUs, taxonomic_levels))
+        member_ids - the sequence IDs of all OTUs, flattened into a single
+            string array. Each OTU's reference sequence ID is listed first
+        member_offsets - the members of OTU i are
+            member_ids[member_offsets[i]:member_offsets[i + 1]] (int64 array)
+        encountered_values - the taxonomic values encountered at each level of
+            each OTU, flattened into a single string array. The reference
+            taxonomic value is listed first
+        encountered_offsets - the values encountered at level j of OTU i are
+            encountered_values[encountered_offsets[k]:
+            encountered_offsets[k + 1]], where k = i * taxonomic_levels + j
+            (int64 array)
+
     Arguments:
-        otu_map_lines - list of lines in the OTU map (the result of calling
-            readlines() on the open file handle)
-        tax_map_lines - list of lines from the taxonomy mapping file (the
-            result of calling readlines() on the open file handle)
+        otu_map_lines - the OTU map, as a filepath, an open file, or a list
+            (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
         taxonomic_levels - the number of taxonomic levels in the taxonomy
             strings found in the taxonomy mapping file. All taxonomy strings
             must have this number of levels to prevent inconsistent results in
             the summary
+        on_disk, progress_callback - see summarize_taxonomic_agreement
     """
-    taxonomic_agreement = _generate_taxonomic_agreement_summary(otu_map_lines,
-            tax_map_lines, taxonomic_levels)
-    # Build up our results file in the order of the original OTU map.
-    results = []
-    for line in otu_map_lines:
-        otu_id = line.split('\t')[0]
-        agreement_info = taxonomic_agreement[otu_id]
-
-        result_str = '%s\t%d\t' % (otu_id, agreement_info[0])
-
-        # We put explicit quotes around each seq ID since some of the IDs are
-        # numbers and this messes with programs like Excel, where they try to
-        # interpret them as a number with commas in it.
-        for idx, seq_id in enumerate(agreement_info[1]):
-            result_str += "'" + seq_id + "'"
-            if idx != len(agreement_info[1]) - 1:
-                result_str += ','
-        for level_agreement in agreement_info[2]:
-            result_str += '\t%.2f%%' % level_agreement
+    # NumPy is only needed here, so don't make every other caller import it.
+    from numpy import array, float32, int64
+
+    otu_ids = []
+    sizes = []
+    agreement = []
+    member_ids = []
+    member_offsets = [0]
+    encountered_values = []
+    encountered_offsets = [0]
+    for otu_id, agreement_info in _compute_taxonomic_agreement(
+            _OTUMapReader(otu_map_lines), tax_map_lines, taxonomic_levels,
+            on_disk=on_disk, progress_callback=progress_callback):
+        otu_ids.append(otu_id)
+        sizes.append(agreement_info[0])
+        member_ids.extend(agreement_info[1])
+        member_offsets.append(len(member_ids))
+        agreement.append(agreement_info[2])
         for levels_encountered in agreement_info[3]:
-            result_str += '\t' + ','.join(levels_encountered)
-        results.append(result_str + '\n')
-    return results
+            encountered_values.extend(levels_encountered)
+            encountered_offsets.append(len(encountered_values))
+
+    return {'otu_ids': array(otu_ids, dtype=str),
+            'sizes': array(sizes, dtype=int64),
+            'agreement': array(agreement, dtype=float32).reshape(
+                    (len(otu_ids), taxonomic_levels)),
+            'member_ids': array(member_ids, dtype=str),
+            'member_offsets': array(member_offsets, dtype=int64),
+            'encountered_values': array(encountered_values, dtype=str),
+            'encountered_offsets': array(encountered_offsets, dtype=int64)}
+
+def compute_taxonomic_agreement_statistics(otu_map_lines, tax_map_lines,
+                                           taxonomic_levels=8, num_bins=10,
+                                           agreement_threshold=100.0,
+                                           threshold_level=None,
+                                           on_disk=False,
+                                           progress_callback=None):
+    """Computes dataset-level statistics of taxonomic agreement.
+
+    The OTUs are summarized one at a time in a single pass over the OTU map
+    and only fixed-size aggregates are kept, so memory use does not depend on
+    the number of OTUs (beyond the taxonomy of the sequences that are in the
+    OTU map).
+
+    Returns a dictionary with the following keys:
+        num_otus - the number of OTUs
+        num_seqs - the number of sequences in all OTUs (including refs)
+        mean_agreement - list containing the mean percent agreement at each
+            taxonomic level
+        weighted_mean_agreement - list containing the mean percent agreement
+            at each taxonomic level, weighted by OTU size
+        histograms - list containing a histogram of the percent agreement of
+            the OTUs at each taxonomic level. Each histogram is a list of
+            num_bins counts for equal-width bins spanning 0-100% (the last bin
+            includes 100%)
+        agreement_threshold, threshold_level - the values used to compute
+            num_below_threshold
+        num_below_threshold - the number of OTUs with less than
+            agreement_threshold percent agreement at threshold_level
+
+    Arguments:
+        otu_map_lines - the OTU map, as a filepath, an open file, or a list
+            (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        taxonomic_levels - the number of taxonomic levels in the taxonomy
+            strings found in the taxonomy mapping file. All taxonomy strings
+            must have this number of levels to prevent inconsistent results in
+            the summary
+        num_bins - the number of histogram bins for each taxonomic level
+        agreement_threshold - the percent agreement that OTUs are counted as
+            being below
+        threshold_level - the (zero-based) index of the taxonomic level that
+            agreement_threshold applies to. Defaults to the second to last
+            level, which is genus in the standard eight-level taxonomy
+        on_disk, progress_callback - see summarize_taxonomic_agreement
+    """
+    if num_bins < 1:
+        raise ValueError("The number of histogram bins must be at least 1.")
+    if threshold_level is None:
+        threshold_level = max(taxonomic_levels - 2, 0)
+    if not 0 <= threshold_level < taxonomic_levels:
+        raise ValueError("The threshold level must be between 0 and %d." %
+                         (taxonomic_levels - 1))
+
+    # We only need the IDs from the OTU map to load the taxonomy, so the first
+    # pass doesn't keep anything per OTU.
+    otu_map_lines = rereadable_lines(otu_map_lines)
+    needed_seq_ids = set()
+    total_otus = 0
+    for otu_id, seq_ids in iter_fields(otu_map_lines):
+        needed_seq_ids.update(seq_ids)
+        total_otus += 1
+    tax_map = _parse_taxonomic_information(tax_map_lines, taxonomic_levels,
+                                           needed_seq_ids, on_disk,
+                                           progress_callback)
+    needed_seq_ids = None
+    progress = ProgressReporter('Computing taxonomic agreement',
+                                progress_callback, total_records=total_otus)
+
+    num_otus = 0
+    num_seqs = 0
+    agreement_sums = [0.0] * taxonomic_levels
+    weighted_agreement_sums = [0.0] * taxonomic_levels
+    histograms = [[0] * num_bins for level_idx in range(taxonomic_levels)]
+    num_below_threshold = 0
+    for otu_id, seq_ids in iter_fields(otu_map_lines):
+        agreement_info = _compute_otu_taxonomic_agreement(seq_ids, tax_map)
+        otu_size = agreement_info[0]
+        num_otus += 1
+        num_seqs += otu_size
+        for level_idx, level_agreement in enumerate(agreement_info[2]):
+            agreement_sums[level_idx] += level_agreement
+            weighted_agreement_sums[level_idx] += level_agreement * otu_size
+            bin_idx = min(int(level_agreement * num_bins / 100), num_bins - 1)
+            histograms[level_idx][bin_idx] += 1
+        if agreement_info[2][threshold_level] < agreement_threshold:
+            num_below_threshold += 1
+        progress.update()
+    progress.finish()
+    if on_disk:
+        tax_map.close()
+
+    if num_otus > 0:
+        mean_agreement = [agreement_sum / num_otus
+                          for agreement_sum in agreement_sums]
+        weighted_mean_agreement = [agreement_sum / num_seqs
+                                   for agreement_sum in weighted_agreement_sums]
+    else:
+        mean_agreement = [0.0] * taxonomic_levels
+        weighted_mean_agreement = [0.0] * taxonomic_levels
+
+    return {'num_otus': num_otus,
+            'num_seqs': num_seqs,
+            'mean_agreement': mean_agreement,
+            'weighted_mean_agreement': weighted_mean_agreement,
+            'histograms': histograms,
+            'agreement_threshold': agreement_threshold,
+            'threshold_level': threshold_level,
+            'num_below_threshold': num_below_threshold}
+
+def format_taxonomic_agreement_statistics(stats, level_names=None):
+    """Formats the output of compute_taxonomic_agreement_statistics.
+
+    Returns a list of lines suitable for writing to an output file. The first
+    lines are comments containing the OTU and sequence counts and the number
+    of OTUs below the agreement threshold. These are followed by a
+    tab-separated table with a row for each taxonomic level, containing the
+    mean and size-weighted mean percent agreement and the histogram counts.
+
+    Arguments:
+        stats - the dictionary returned by
+            compute_taxonomic_agreement_statistics
+        level_names - list of names for the taxonomic levels. Defaults to
+            'Level 1', 'Level 2', etc.
+    """
+    num_levels = len(stats['histograms'])
+    if level_names is None:
+        level_names = ['Level %d' % (level_idx + 1)
+                       for level_idx in range(num_levels)]
+    num_bins = len(stats['histograms'][0]) if num_levels > 0 else 0
+    bin_width = 100 / num_bins if num_bins > 0 else 0
+
+    lines = ['# Number of OTUs: %d\n' % stats['num_otus'],
+             '# Number of sequences: %d\n' % stats['num_seqs'],
+             '# OTUs below %.2f%% agreement at %s: %d\n' % (
+                 stats['agreement_threshold'],
+                 level_names[stats['threshold_level']],
+                 stats['num_below_threshold'])]
+    header = 'Level\tMean agreement\tSize-weighted mean agreement'
+    for bin_idx in range(num_bins):
+        header += '\t%g-%g%%' % (bin_idx * bin_width, (bin_idx + 1) * bin_width)
+    lines.append(header + '\n')
+    for level_idx in range(num_levels):
+        line = '%s\t%.2f%%\t%.2f%%' % (level_names[level_idx],
+                stats['mean_agreement'][level_idx],
+                stats['weighted_mean_agreement'][level_idx])
+        for count in stats['histograms'][level_idx]:
+            line += '\t%d' % count
+        lines.append(line + '\n')
+    return lines
+
+def parse_taxonomic_information(tax_map_lines, taxonomic_levels=8):
+    """Parses a taxonomy mapping file to return mapping of seq ID to taxonomy.
+
+    Returns a dictionary with sequence ID as the key and a list containing the
+    taxonomy at each level, which can be passed to
+    summarize_taxonomic_agreement as tax_map. All rows are parsed and
+    validated.
+
+    Arguments:
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        taxonomic_levels - the number of taxonomic levels in the taxonomy
+            strings found in the taxonomy mapping file. All taxonomy strings
+            must have this number of levels (excluding empty taxonomic levels)
+    """
+    return _parse_taxonomic_information(tax_map_lines, taxonomic_levels)
+
+def estimate_taxonomic_agreement_memory(tax_map_lines):
+    """Estimates the memory (in bytes) needed to hold the taxonomy in memory.
+
+    Each loaded row of the taxonomy mapping file becomes a dictionary entry
+    holding a list of a string per taxonomic level, which takes about four
+    times as much memory as the row does on disk. At most every row is
+    loaded, so this is an upper bound. Inputs that aren't filepaths count as
+    0. If the estimate is too large, pass on_disk=True to keep the taxonomy
+    in a temporary database instead.
+
+    Arguments:
+        tax_map_lines - the taxonomy mapping file, as passed to
+            summarize_taxonomic_agreement
+    """
+    return 4 * input_size(tax_map_lines)
 
 def _generate_taxonomic_agreement_summary(otu_map_lines, tax_map_lines,
-                                         taxonomic_levels=8):
+                                         taxonomic_levels=8, sample_size=None,
+                                         size_cutoff=None, seed=0,
+                                         tax_map=None):
     """Computes a summary of taxonomic agreement between ref and its seqs.
 
     Returns a dictionary with OTU ID as the key. The value is a four-element
@@ -83,79 +438,369 @@ def _generate_taxonomic_agreement_summary(otu_map_lines, tax_map_lines,
     always be the same length (taxonomic_levels) because they each contain
     information for each taxonomic level.
 
+    If sample_size is provided, large OTUs are summarized from a sample of
+    their members and each value has a fifth element containing confidence
+    intervals (see _compute_taxonomic_agreement).
+
     Arguments:
-        otu_map_lines - list of lines in the OTU map (the result of calling
-            readlines() on the open file handle)
-        tax_map_lines - list of lines from the taxonomy mapping file (the
-            result of calling readlines() on the open file handle)
+        otu_map_lines - the OTU map, as a filepath, an open file, or a list
+            (or other iterable) of lines
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
         taxonomic_levels - the number of taxonomic levels in the taxonomy
             strings found in the taxonomy mapping file. All taxonomy strings
             must have this number of levels to prevent inconsistent results in
             the summary
+        sample_size, size_cutoff, seed, tax_map - see
+            summarize_taxonomic_agreement
+    """
+    return dict(_compute_taxonomic_agreement(_OTUMapReader(otu_map_lines),
+            tax_map_lines, taxonomic_levels, sample_size, size_cutoff, seed,
+            tax_map))
+
+def _compute_taxonomic_agreement(otu_map, tax_map_lines, taxonomic_levels=8,
+                                 sample_size=None, size_cutoff=None, seed=0,
+                                 tax_map=None, on_disk=False,
+                                 progress_callback=None):
+    """Computes a summary of taxonomic agreement for each OTU in otu_map.
+
+    Yields (OTU ID, agreement info) for each OTU, in the order of otu_map,
+    where agreement info is the value described in
+    _generate_taxonomic_agreement_summary. If sample_size is provided, each
+    value has a fifth element containing the confidence intervals described
+    in _estimate_otu_taxonomic_agreement (for OTUs that weren't sampled, each
+    interval is the exact percent agreement).
+
+    Unless tax_map is provided, otu_map is iterated over twice: first to find
+    the sequences whose taxonomy needs to be loaded, then to compute the
+    agreement of each OTU as it is yielded.
+
+    Arguments:
+        otu_map - an iterable of (OTU ID, list of the sequence IDs in the
+            OTU) pairs, with the reference sequence ID listed first, that can
+            be iterated over more than once (e.g. a list or an _OTUMapReader)
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
+        taxonomic_levels - the number of taxonomic levels in the taxonomy
+            strings found in the taxonomy mapping file
+        sample_size, size_cutoff, seed, tax_map, on_disk,
+            progress_callback - see summarize_taxonomic_agreement
+    """
+    if sample_size is not None:
+        if sample_size < 1:
+            raise ValueError("The sample size must be at least 1.")
+        if size_cutoff is None:
+            size_cutoff = sample_size + 1
+
+    samples = []
+    total_otus = None
+    owns_tax_map = tax_map is None
+    if owns_tax_map:
+        # Only load the taxonomy for sequences that are actually in the OTU
+        # map. Low-threshold OTU maps reference only a small fraction of the
+        # sequences in the taxonomy map, so there is no need to parse the rest
+        # of it.
+        needed_seq_ids = set()
+        total_otus = 0
+        for otu_id, seq_ids in otu_map:
+            total_otus += 1
+            if _is_sampled(seq_ids, sample_size, size_cutoff):
+                samples.append(_sample_otu_members(seq_ids, sample_size, seed))
+                needed_seq_ids.add(seq_ids[0])
+                needed_seq_ids.update(samples[-1])
+            else:
+                needed_seq_ids.update(seq_ids)
+        tax_map = _parse_taxonomic_information(tax_map_lines,
+                                               taxonomic_levels,
+                                               needed_seq_ids, on_disk,
+                                               progress_callback)
+        needed_seq_ids = None
+
+    # The samples taken in the first pass are in the same order as the OTUs,
+    # so each OTU is only sampled once.
+    samples = iter(samples)
+    progress = ProgressReporter('Computing taxonomic agreement',
+                                progress_callback, total_records=total_otus)
+    try:
+        for otu_id, seq_ids in otu_map:
+            if _is_sampled(seq_ids, sample_size, size_cutoff):
+                sampled_seq_ids = next(samples, None) or \
+                        _sample_otu_members(seq_ids, sample_size, seed)
+                agreement_info = _estimate_otu_taxonomic_agreement(seq_ids,
+                        sampled_seq_ids, tax_map)
+            else:
+                agreement_info = _compute_otu_taxonomic_agreement(seq_ids,
+                                                                  tax_map)
+                if sample_size is not None:
+                    agreement_info.append([(level_agreement, level_agreement)
+                            for level_agreement in agreement_info[2]])
+            progress.update()
+            yield otu_id, agreement_info
+        progress.finish()
+    finally:
+        # The temporary database is removed as soon as it's closed.
+        if owns_tax_map and on_disk:
+            tax_map.close()
+
+def _is_sampled(seq_ids, sample_size, size_cutoff):
+    """Returns True if an OTU is large enough to be summarized from a sample."""
+    return sample_size is not None and len(seq_ids) > size_cutoff and \
+           len(seq_ids) - 1 > sample_size
+
+def _compute_otu_taxonomic_agreement(seq_ids, tax_map):
+    """Computes taxonomic agreement between a single OTU's ref and its seqs.
+
+    Returns the four-element list described in
+    _generate_taxonomic_agreement_summary.
+
+    Arguments:
+        seq_ids - list of sequence IDs in the OTU, with the reference
+            sequence ID listed first
+        tax_map - dictionary mapping sequence ID to a list containing the
+            taxonomy at each level (the output of _parse_taxonomic_information)
+    """
+    otu_size = len(seq_ids)
+    agreement_info = [otu_size, seq_ids, [], []]
+
+    # The reference sequence is always the first sequence listed in the OTU
+    # map.
+    ref_seq_id = seq_ids[0]
+    ref_seq_tax = tax_map[ref_seq_id]
+
+    # Calculate percent agreement for each taxonomic level. If the OTU only
+    # contains a reference sequence, the percent agreement will be 100%.
+    # Also keep track of all unique taxonomic values that are encountered
+    # for each level (with the reference's taxonomic value listed first).
+    for level_idx, ref_level in enumerate(ref_seq_tax):
+        agreement_count = 0
+        encountered_levels = []
+        for seq_id in seq_ids:
+            seq_level = tax_map[seq_id][level_idx]
+            if ref_level == seq_level:
+                agreement_count += 1
+            if seq_level not in encountered_levels:
+                encountered_levels.append(seq_level)
+        agreement_info[2].append((agreement_count / otu_size) * 100)
+        agreement_info[3].append(encountered_levels)
+    return agreement_info
+
+def _estimate_otu_taxonomic_agreement(seq_ids, sampled_seq_ids, tax_map,
+                                      z=1.96):
+    """Estimates taxonomic agreement for an OTU from a sample of its members.
+
+    Returns the same four-element list as _compute_otu_taxonomic_agreement,
+    with the size and sequence identifiers of the whole OTU, plus a fifth
+    element containing a (lower, upper) confidence interval for the percent
+    agreement at each taxonomic level.
+
+    The reference always agrees with itself, so only the non-reference members
+    are sampled. If a fraction p of the sampled members agree with the
+    reference at a given level, the estimated percent agreement for an OTU of
+    size n is (1 + p * (n - 1)) / n * 100. The confidence interval is the
+    Wilson score interval for p, transformed the same way. It ignores the
+    finite population correction, so it is slightly conservative.
+
+    The encountered taxonomic values are the reference's value followed by
+    every other value seen in the sample (no matter how rare), in the order the
+    sampled members appear in the OTU map. Values that were not sampled are
+    not reported.
+
+    Arguments:
+        seq_ids - list of sequence IDs in the OTU, with the reference
+            sequence ID listed first
+        sampled_seq_ids - the sampled non-reference sequence IDs (the output of
+            _sample_otu_members)
+        tax_map - dictionary mapping sequence ID to a list containing the
+            taxonomy at each level (the output of _parse_taxonomic_information)
+        z - the standard normal quantile for the confidence level (1.96 gives
+            a 95% interval)
+    """
+    otu_size = len(seq_ids)
+    sample_size = len(sampled_seq_ids)
+    agreement_info = [otu_size, seq_ids, [], [], []]
+
+    to_percent = lambda x: (1 + x * (otu_size - 1)) / otu_size * 100
+    ref_seq_tax = tax_map[seq_ids[0]]
+    for level_idx, ref_level in enumerate(ref_seq_tax):
+        agreement_count = 0
+        encountered_levels = [ref_level]
+        for seq_id in sampled_seq_ids:
+            seq_level = tax_map[seq_id][level_idx]
+            if ref_level == seq_level:
+                agreement_count += 1
+            if seq_level not in encountered_levels:
+                encountered_levels.append(seq_level)
+        p = agreement_count / sample_size
+
+        denominator = 1 + z ** 2 / sample_size
+        center = (p + z ** 2 / (2 * sample_size)) / denominator
+        half_width = z * sqrt(p * (1 - p) / sample_size +
+                              z ** 2 / (4 * sample_size ** 2)) / denominator
+        lower = max(0.0, center - half_width)
+        upper = min(1.0, center + half_width)
+
+        agreement_info[2].append(to_percent(p))
+        agreement_info[3].append(encountered_levels)
+        agreement_info[4].append((to_percent(lower), to_percent(upper)))
+    return agreement_info
+
+def _sample_otu_members(seq_ids, sample_size, seed=0):
+    """Reservoir samples sample_size of an OTU's non-reference members.
+
+    Returns the sampled sequence IDs in the order they appear in seq_ids. The
+    random number generator is seeded from seed and the OTU's members, so the
+    same OTU is always sampled the same way regardless of its ID or of the
+    other OTUs in the map.
+
+    Arguments:
+        seq_ids - list of sequence IDs in the OTU, with the reference
+            sequence ID listed first
+        sample_size - the number of non-reference members to sample
+        seed - the random seed
+    """
+    rng = Random(int(hexlify(md5('%d\t' % seed +
+            _hash_otu_membership(seq_ids)).digest()), 16))
+    reservoir = []
+    for idx, seq_id in enumerate(islice(seq_ids, 1, None)):
+        if idx < sample_size:
+            reservoir.append((idx, seq_id))
+        else:
+            replace_idx = rng.randint(0, idx)
+            if replace_idx < sample_size:
+                reservoir[replace_idx] = (idx, seq_id)
+    reservoir.sort()
+    return [seq_id for idx, seq_id in reservoir]
+
+def _format_taxonomic_agreement(otu_id, agreement_info):
+    """Formats a single OTU's taxonomic agreement as a line of output.
+
+    Arguments:
+        otu_id - the OTU ID
+        agreement_info - the list computed for the OTU by
+            _compute_otu_taxonomic_agreement (or
+            _estimate_otu_taxonomic_agreement, in which case the confidence
+            intervals are written as additional columns)
     """
-    tax_map = _parse_taxonomic_information(tax_map_lines, taxonomic_levels)
-    otu_map = fields_to_dict(otu_map_lines)
-
-    taxonomic_agreement = {}
-    for otu_id, seq_ids in otu_map.items():
-        otu_size = len(seq_ids)
-        taxonomic_agreement[otu_id] = [otu_size, seq_ids, [], []]
-
-        # The reference sequence is always the first sequence listed in the OTU
-        # map.
-        ref_seq_id = seq_ids[0]
-        ref_seq_tax = tax_map[ref_seq_id]
-
-        # Calculate percent agreement for each taxonomic level. If the OTU only
-        # contains a reference sequence, the percent agreement will be 100%.
-        # Also keep track of all unique taxonomic values that are encountered
-        # for each level (with the reference's taxonomic value listed first).
-        for level_idx, ref_level in enumerate(ref_seq_tax):
-            agreement_count = 0
-            encountered_levels = []
-            for seq_id in seq_ids:
-                seq_level = tax_map[seq_id][level_idx]
-                if ref_level == seq_level:
-                    agreement_count += 1
-                if seq_level not in encountered_levels:
-                    encountered_levels.append(seq_level)
-            taxonomic_agreement[otu_id][2].append(
-                    (agreement_count / otu_size) * 100)
-            taxonomic_agreement[otu_id][3].append(encountered_levels)
-    return taxonomic_agreement
-
-def _parse_taxonomic_information(tax_map_lines, taxonomic_levels=8):
+    result_str = '%s\t%d\t' % (otu_id, agreement_info[0])
+
+    # We put explicit quotes around each seq ID since some of the IDs are
+    # numbers and this messes with programs like Excel, where they try to
+    # interpret them as a number with commas in it.
+    for idx, seq_id in enumerate(agreement_info[1]):
+        result_str += "'" + seq_id + "'"
+        if idx != len(agreement_info[1]) - 1:
+            result_str += ','
+    for level_agreement in agreement_info[2]:
+        result_str += '\t%.2f%%' % level_agreement
+    for levels_encountered in agreement_info[3]:
+        result_str += '\t' + ','.join(levels_encountered)
+    if len(agreement_info) > 4:
+        for lower, upper in agreement_info[4]:
+            result_str += '\t%.2f%%-%.2f%%' % (lower, upper)
+    return result_str + '\n'
+
+def _reuse_previous_summary(seq_ids, previous_otus, changed_seq_ids):
+    """Returns an OTU's previous summary if it can be reused, or None."""
+    previous = previous_otus.get(_hash_otu_membership(seq_ids))
+    if previous is not None and changed_seq_ids.isdisjoint(seq_ids):
+        return previous
+    return None
+
+class _OTUMapReader(object):
+    """Parses an OTU map each time it is iterated over.
+
+    Yields (OTU ID, list of seq IDs) for each OTU, so that the OTU map can be
+    read more than once without keeping it in memory.
+    """
+
+    def __init__(self, otu_map_lines):
+        self.otu_map_lines = rereadable_lines(otu_map_lines)
+
+    def __iter__(self):
+        return iter_fields(self.otu_map_lines)
+
+def _hash_otu_membership(seq_ids):
+    """Returns a digest identifying an OTU's (ordered) list of members."""
+    return md5('\t'.join(seq_ids)).digest()
+
+def _parse_taxonomic_information(tax_map_lines, taxonomic_levels=8,
+                                 seq_ids=None, on_disk=False,
+                                 progress_callback=None):
     """Parses a taxonomy mapping file to return mapping of seq ID to taxonomy.
     
     Returns a dictionary with sequence ID as the key and a list containing the
     taxonomy at each level. Empty taxonomic levels (i.e. ';;' or levels
     containing only whitespace) are ignored.
 
+    If seq_ids is provided, only the rows for those sequence IDs are parsed,
+    validated, and returned. All other rows are skipped without being split
+    into fields.
+
     Arguments:
-        tax_map_lines - list of lines from the taxonomy mapping file (the
-            result of calling readlines() on the open file handle)
+        tax_map_lines - the taxonomy mapping file, as a filepath, an open
+            file, or a list (or other iterable) of lines
         taxonomic_levels - the number of taxonomic levels in the taxonomy
             strings found in the taxonomy mapping file. All taxonomy strings
             must have this number of levels (excluding empty taxonomic levels)
+        seq_ids - a set (or other container supporting fast membership tests)
+            of the sequence IDs to load. If None, all rows are loaded
+        on_disk - if True, a _DiskTaxonomyMap is returned instead of a
+            dictionary. The caller must close it when it is done with it
+        progress_callback - see summarize_taxonomic_agreement
     """
-    tax_info = {}
-
-    if tax_map_lines[0] != \
-            "ID Number\tGenBank Number\tNew Taxon String\tSource\n":
-        raise ValueError("The taxonomy map file appears to be invalid "
-                         "because it is either missing the header or has a "
-                         "corrupt header.")
-    for seq_id, seq_info in fields_to_dict(tax_map_lines[1:]).items():
-        if len(seq_info) != 3:
-            raise ValueError("The taxonomy map file appears to be invalid "
-                             "because it does not have exactly 4 columns.")
-        # Split at each level and remove any empty levels or levels that
-        # contain only whitespace.
-        taxonomy = [level for level in seq_info[1].split(';') \
-                    if level.strip() != '']
+    tax_info = _DiskTaxonomyMap() if on_disk else {}
+
+    progress = ProgressReporter('Parsing taxonomy', progress_callback,
+                                total_bytes=input_size(tax_map_lines))
+    for seq_id, taxonomy_str, taxonomy in iter_taxonomy_map(tax_map_lines,
+                                                            seq_ids, progress):
         if len(taxonomy) != taxonomic_levels:
             raise ValueError("Encountered invalid taxonomy '%s'. Valid "
                     "taxonomy strings must have %d levels separated by "
-                    "semicolons." % (seq_info[1], taxonomic_levels))
+                    "semicolons." % (taxonomy_str, taxonomic_levels))
         tax_info[seq_id] = taxonomy
+    progress.finish()
     return tax_info
+
+class _DiskTaxonomyMap(object):
+    """Maps sequence ID to a list of taxonomic levels, like a dictionary.
+
+    The taxonomy is kept in a private temporary SQLite database, which SQLite
+    stores on disk once it outgrows a small page cache, and deletes when it
+    is closed. Lookups are slower than a dictionary's, but memory use doesn't
+    grow with the number of sequences.
+    """
+
+    def __init__(self):
+        # An empty filename is SQLite's private temporary on-disk database.
+        self._db = sqlite3.connect('')
+        # Sequence IDs and taxonomies are byte strings, not unicode.
+        self._db.text_factory = str
+        self._db.execute('CREATE TABLE taxonomy (seq_id TEXT PRIMARY KEY, '
+                         'levels TEXT) WITHOUT ROWID')
+
+    def __setitem__(self, seq_id, taxonomy):
+        # Taxonomy strings come from tab-separated fields, so tab is a safe
+        # separator.
+        self._db.execute('INSERT OR REPLACE INTO taxonomy VALUES (?, ?)',
+                         (seq_id, '\t'.join(taxonomy)))
+
+    def _lookup(self, seq_id):
+        return self._db.execute('SELECT levels FROM taxonomy WHERE seq_id = ?',
+                                (seq_id,)).fetchone()
+
+    def __getitem__(self, seq_id):
+        row = self._lookup(seq_id)
+        if row is None:
+            raise KeyError(seq_id)
+        return row[0].split('\t')
+
+    def __contains__(self, seq_id):
+        return self._lookup(seq_id) is not None
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM taxonomy').fetchone()[0]
+
+    def close(self):
+        """Closes (and deletes) the database."""
+        self._db.close()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+import re
+from array import array as typed_array
+from os import listdir
+from os.path import isdir, join
+from numpy import (arange, argsort, array, bincount, concatenate, cumsum,
+                   flatnonzero, float64, full, int32, isnan, maximum, nan,
+                   searchsorted, zeros)
+from nested_reference_otus.unnest import _newick_label
+from nested_reference_otus.util import load_arrays, save_arrays
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+"""Preorder array representation of a reference tree
+
+node i has name names[i], branch length lengths[i] (nan if it has none) and
+parent parent[i] (-1 for the root, which is node 0). nodes are numbered in
+preorder, so the subtree of node i is nodes i:subtree_end[i], and node i is
+a tip if subtree_end[i] == i + 1. the tips are indexed by name
+(sorted_tip_names / sorted_tip_nodes).
+
+a tree is parsed from newick once and saved as arrays (see write_tree_cache),
+which are memory-mapped when it's loaded again. pruning to a set of tips is
+array masking plus one pass over the kept nodes, so filtering a big tree to
+each level's rep set doesn't parse newick at all.
+"""
+
+_token_re = re.compile(r"""\s*(?:(\[[^\]]*\])|('(?:[^']|'')*')|([(),:;])|"""
+                       r"""([^\s()\[\]',:;]+))""")
+
+def _unescape_label(token):
+    """returns the node name of a newick label, without quotes"""
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    return token
+
+def parse_newick(newick):
+    """returns (parent, names, lengths) lists of the nodes of newick, in
+    preorder
+
+    newick is a string or an iterable of lines. the tree is parsed without
+    recursion, so any depth is fine. quoted labels are unquoted, so they
+    match sequence ids, and unquoted labels are kept as is (as cogent does)
+    """
+    if not isinstance(newick, basestring):
+        newick = ''.join(newick)
+    parent = typed_array('i')
+    names = []
+    lengths = typed_array('d')
+    stack = []
+    # the node that a label or length applies to, or None before a tip
+    last = None
+    expect_length = False
+    for match in _token_re.finditer(newick):
+        comment, quoted, punctuation, label = match.groups()
+        if comment is not None:
+            continue
+        if expect_length:
+            lengths[last] = float(label)
+            expect_length = False
+            continue
+        if punctuation == '(':
+            parent.append(stack[-1] if stack else -1)
+            names.append(None)
+            lengths.append(nan)
+            stack.append(len(names) - 1)
+            last = None
+        elif punctuation in (',', ')', ':'):
+            if last is None:
+                # an unnamed tip
+                parent.append(stack[-1] if stack else -1)
+                names.append(None)
+                lengths.append(nan)
+                last = len(names) - 1
+            if punctuation == ',':
+                last = None
+            elif punctuation == ')':
+                last = stack.pop()
+            else:
+                expect_length = True
+        elif punctuation == ';':
+            break
+        else:
+            name = _unescape_label(quoted or label)
+            if last is None:
+                parent.append(stack[-1] if stack else -1)
+                names.append(name)
+                lengths.append(nan)
+                last = len(names) - 1
+            else:
+                names[last] = name
+    if stack:
+        raise ValueError("Unbalanced parentheses in newick")
+    return parent, names, lengths
+
+def _subtree_ends(parent):
+    """returns the end of the preorder subtree of each node"""
+    ends = arange(1, len(parent) + 1, dtype=int32)
+    # children follow their parents, so one pass backwards finishes every
+    # subtree before its parent's
+    for node in xrange(len(parent) - 1, 0, -1):
+        p = parent[node]
+        if ends[node] > ends[p]:
+            ends[p] = ends[node]
+    return ends
+
+def tree_arrays(parent, names, lengths):
+    """returns {name: array} for a preorder tree"""
+    parent = array(parent, dtype=int32)
+    subtree_end = _subtree_ends(parent)
+    names = array(['' if name is None else name for name in names],
+                  dtype=str)
+    tips = flatnonzero(subtree_end == arange(1, len(parent) + 1))
+    tip_order = argsort(names[tips], kind='mergesort')
+    return {'parent': parent,
+            'names': names,
+            'lengths': array(lengths, dtype=float64),
+            'subtree_end': subtree_end,
+            'sorted_tip_names': names[tips][tip_order],
+            'sorted_tip_nodes': tips[tip_order].astype(int32)}
+
+def write_tree_cache(newick, cache_dir):
+    """writes the preorder arrays of newick (see parse_newick) to cache_dir"""
+    save_arrays(cache_dir, tree_arrays(*parse_newick(newick)))
+
+class PreorderTree(object):
+    """A tree stored as preorder arrays, written by write_tree_cache"""
+    def __init__(self, cache_dir, mmap_mode='r'):
+        self._set_arrays(load_arrays(cache_dir, mmap_mode))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """returns a tree of the arrays returned by tree_arrays"""
+        tree = cls.__new__(cls)
+        tree._set_arrays(arrays)
+        return tree
+
+    def _set_arrays(self, arrays):
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def tips(self):
+        """returns the tip nodes, in preorder"""
+        return flatnonzero(self.subtree_end == arange(1, len(self) + 1))
+
+    def tip_nodes(self, tip_names):
+        """returns the node of each of tip_names, or -1"""
+        tip_names = array(tip_names, dtype=str)
+        if not len(tip_names) or not len(self.sorted_tip_names):
+            return full(len(tip_names), -1, dtype=int32)
+        idx = searchsorted(self.sorted_tip_names, tip_names)
+        idx[idx == len(self.sorted_tip_names)] = 0
+        found = self.sorted_tip_names[idx] == tip_names
+        nodes = full(len(tip_names), -1, dtype=int32)
+        nodes[found] = self.sorted_tip_nodes[idx[found]]
+        return nodes
+
+    def prune(self, tip_names):
+        """returns the tree of only the tips in tip_names (which aren't in
+        the tree are ignored) and any unnamed tips
+
+        gives the same tree, byte for byte once written, as qiime's
+        filter_tree (PhyloNode.removeDeleted then PhyloNode.prune): internal
+        nodes with one remaining child are removed, their lengths are added
+        to their child's, and the child moves after its new siblings. the
+        root is always kept
+        """
+        n = len(self)
+        keep_tip = zeros(n, dtype=bool)
+        nodes = self.tip_nodes(tip_names)
+        keep_tip[nodes[nodes != -1]] = True
+        # filter_tree only removes named tips
+        tips = self.tips()
+        keep_tip[tips[self.names[tips] == '']] = True
+        # a node is kept if any tip in its subtree is
+        kept_tips = concatenate([[0], cumsum(keep_tip)])
+        keep = kept_tips[self.subtree_end] > kept_tips[:n]
+        keep[0] = True
+
+        parent = self.parent
+        non_root = keep.copy()
+        non_root[0] = False
+        num_children = bincount(parent[non_root], minlength=n)
+        unary = keep & (num_children == 1)
+        unary[0] = False
+
+        # one pass over the kept nodes in preorder, so a removed node's
+        # nearest kept ancestor (and the length it passes down) is known
+        # before its children are seen
+        lengths = self.lengths
+        ancestor = {}
+        extra = {}
+        new_up = {}
+        new_lengths = {}
+        # PhyloNode.prune reattaches the child of a removed node at the end
+        # of its new parent's children, so those come after the others
+        direct_children = {}
+        moved_children = {}
+        for node in flatnonzero(keep).tolist():
+            p = int(parent[node])
+            if p != -1 and unary[p]:
+                up, up_length = ancestor[p], extra[p]
+            else:
+                up, up_length = p, None
+            length = float(lengths[node])
+            if up_length is not None:
+                length = _add_lengths(length, up_length)
+            if unary[node]:
+                ancestor[node] = up
+                extra[node] = length
+                continue
+            new_up[node] = up
+            new_lengths[node] = length
+            if up != -1:
+                children = direct_children if up == p else moved_children
+                children.setdefault(up, []).append(node)
+
+        order = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            children = (direct_children.get(node, []) +
+                        moved_children.get(node, []))
+            stack.extend(reversed(children))
+        new_index = dict((node, i) for i, node in enumerate(order))
+        new_parent = typed_array('i', [new_index.get(new_up[node], -1)
+                                       for node in order])
+        return PreorderTree.from_arrays(tree_arrays(new_parent,
+                self.names[order].tolist(),
+                typed_array('d', [new_lengths[node] for node in order])))
+
+    def write_newick(self, out_f, with_distances=True, buffer_size=65536):
+        """streams the tree to out_f as newick, as unnest.write_newick
+
+        tokens are written buffer_size at a time
+        """
+        n = len(self)
+        if not n:
+            out_f.write(';')
+            return
+        parent = self.parent
+        last_child = full(n, -1, dtype=int32)
+        if n > 1:
+            maximum.at(last_child, parent[1:], arange(1, n, dtype=int32))
+
+        def label(node):
+            name = self.names[node]
+            result = _newick_label(name or None)
+            if with_distances and not isnan(self.lengths[node]):
+                result = "%s:%s" % (result, float(self.lengths[node]))
+            return result
+
+        tokens = []
+        for node in xrange(n):
+            if last_child[node] != -1:
+                tokens.append('(')
+                continue
+            tokens.append(label(node))
+            # close every subtree this tip finishes
+            while node and last_child[parent[node]] == node:
+                node = parent[node]
+                tokens.append(')' + label(node))
+            if node:
+                tokens.append(',')
+            if len(tokens) >= buffer_size:
+                out_f.write(''.join(tokens))
+                tokens = []
+        tokens.append(';')
+        out_f.write(''.join(tokens))
+
+def _add_lengths(child, node):
+    """adds the length of a removed node to its child's, as PhyloNode.prune
+    does (a missing length is nan)"""
+    if isnan(child) or isnan(node):
+        # child.Length or node.Length
+        return child if not isnan(child) and child else node
+    return child + node
+
+def load_tree(source):
+    """returns a PreorderTree from a tree cache directory or newick file"""
+    if isdir(source):
+        return PreorderTree(source)
+    return PreorderTree.from_arrays(tree_arrays(
+            *parse_newick(open(source, 'U'))))
+
+def tree_files(source):
+    """returns the files holding the tree at source, a tree cache
+    directory or newick file"""
+    if isdir(source):
+        return [join(source, fn) for fn in sorted(listdir(source))
+                if fn.endswith('.npy')]
+    return [source]
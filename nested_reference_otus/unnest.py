@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
-from cogent.core.tree import PhyloNode
+import re
+from array import array
+from itertools import imap, izip
+from multiprocessing import Pool
+from os import listdir
+from os.path import basename, dirname, getsize, isabs, join
+from nested_reference_otus.progress import ProgressReporter
+from nested_reference_otus.util import open_output
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, The QIIME project"
@@ -21,6 +28,8 @@ def parse_otu_map(maplines):
 
 def make_nodes(otu_map, length, level):
     """returns nodes that have been created outta the map"""
+    # cogent is slow to import, and only the PhyloNode code paths need it
+    from cogent.core.tree import PhyloNode
     nodedist = length / 2.0
     nodes = []
     lookup = {}
@@ -45,6 +54,7 @@ def join_nodes(parsed):
 
     99, 97, 94, ...
     """
+    from cogent.core.tree import PhyloNode
     last_lookup, last_nodes = parsed[0]
 
     for lookup, nodes in parsed[1:]:
@@ -72,6 +82,379 @@ def join_nodes(parsed):
 
     return root
 
+class NestedOTUTree(object):
+    """Array-backed representation of the unnested OTU hierarchy
+
+    Node i has name names[i] and parent parent[i]. Its children are
+    first_child[i], next_sibling[first_child[i]], ... in the order they were
+    listed in the OTU maps. -1 means no such node. All nodes share a small
+    table of branch lengths (one per level): node i has length
+    lengths[length_index[i]], or no length if length_index[i] is -1.
+
+    The cluster nodes made from the OTU maps also know which OTU they are:
+    node i is OTU otu_ids[i] at similarity levels[node_level[i]]. For tips
+    and the root, node_level[i] is -1 and otu_ids[i] is None.
+    """
+    def __init__(self, names, parent, first_child, next_sibling,
+                 length_index, lengths, root, levels, node_level, otu_ids):
+        self.names = names
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.length_index = length_index
+        self.lengths = lengths
+        self.root = root
+        self.levels = levels
+        self.node_level = node_level
+        self.otu_ids = otu_ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def length(self, node):
+        """returns the branch length of node, or None"""
+        idx = self.length_index[node]
+        if idx == -1:
+            return None
+        return float(self.lengths[idx])
+
+    def children(self, node):
+        """yields the children of node in order"""
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def preorder(self):
+        """yields node indices in preorder without recursion"""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(list(self.children(node))))
+
+    def tips(self):
+        """yields tip indices in preorder"""
+        for node in self.preorder():
+            if self.first_child[node] == -1:
+                yield node
+
+    def to_phylonode(self):
+        """returns an equivalent PhyloNode tree (as join_nodes would make)"""
+        from cogent.core.tree import PhyloNode
+        nodes = [None] * len(self.names)
+        for node in self.preorder():
+            nodes[node] = PhyloNode(Name=self.names[node],
+                                    Length=self.length(node))
+            parent = self.parent[node]
+            if parent != -1:
+                nodes[parent].append(nodes[node])
+        return nodes[self.root]
+
+class NestedOTUTreeBuilder(object):
+    """Builds a NestedOTUTree one level at a time
+
+    Levels must be added from high -> low similarity (as join_nodes expects).
+    Joining a level only remaps the previous level's clusters by integer
+    index, so no nodes are ever deleted or re-created.
+    """
+    def __init__(self):
+        self.names = []
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.length_index = array('h')
+        self.lengths = []
+        self.levels = []
+        self.node_level = array('h')
+        self.otu_ids = []
+        self._last_child = array('i')
+        self._lookup = None
+        self._top = []
+
+    def _add_node(self, name, length_idx, level_idx=-1, otu_id=None):
+        self.names.append(name)
+        self.parent.append(-1)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.length_index.append(length_idx)
+        self.node_level.append(level_idx)
+        self.otu_ids.append(otu_id)
+        self._last_child.append(-1)
+        return len(self.names) - 1
+
+    def _append_child(self, parent, child):
+        self.parent[child] = parent
+        last = self._last_child[parent]
+        if last == -1:
+            self.first_child[parent] = child
+        else:
+            self.next_sibling[last] = child
+        self._last_child[parent] = child
+
+    def add_level(self, otu_map, length, level):
+        """adds the clusters of otu_map as the next level up
+
+        otu_map, length and level are as passed to make_nodes
+        """
+        self.lengths.append(length / 2.0)
+        self.levels.append(level)
+        length_idx = len(self.lengths) - 1
+        lookup = {}
+        top = []
+
+        for clusterid, seqids in otu_map:
+            rep = seqids[0]
+            parent = self._add_node("_".join(map(str, [level,clusterid,rep])),
+                                    -1, length_idx, clusterid)
+            for id_ in seqids:
+                if self._lookup is None:
+                    child = self._add_node(id_, length_idx)
+                else:
+                    child = self._lookup[id_]
+                    self.length_index[child] = length_idx
+                self._append_child(parent, child)
+            lookup[rep] = parent
+            top.append(parent)
+
+        self._lookup = lookup
+        self._top = top
+
+    def build(self):
+        """returns the NestedOTUTree, rooted above the last level added
+
+        should only be called once, after all levels have been added
+        """
+        from numpy import asarray, float64, frombuffer, int16, int32
+        root = self._add_node(None, -1)
+        for node in self._top:
+            self._append_child(root, node)
+
+        return NestedOTUTree(self.names,
+                             frombuffer(self.parent, dtype=int32).copy(),
+                             frombuffer(self.first_child, dtype=int32).copy(),
+                             frombuffer(self.next_sibling, dtype=int32).copy(),
+                             frombuffer(self.length_index, dtype=int16).copy(),
+                             asarray(self.lengths, dtype=float64),
+                             root,
+                             self.levels,
+                             frombuffer(self.node_level, dtype=int16).copy(),
+                             self.otu_ids)
+
+def _newick_label(name):
+    """returns name escaped the same way as PhyloNode.getNewick"""
+    if name is None:
+        return ''
+    name = str(name)
+    if name.startswith("'") and name.endswith("'"):
+        return name
+    if re.search("""[]['"(),:;_]""", name):
+        return "'%s'" % name.replace("'","''")
+    return name.replace(' ','_')
+
+def write_newick(tree, out_f, with_distances=True, buffer_size=65536,
+                 progress=None):
+    """streams tree to out_f as newick
+
+    gives the same result as tree.to_phylonode().getNewick(with_distances),
+    but walks the tree with an explicit stack (so deep trees can't hit the
+    recursion limit) and writes as it goes instead of building one string.
+    out_f can be any file-like object, e.g. from util.open_output.
+
+    if progress (a progress.ProgressReporter) is given, the nodes and bytes
+    written are counted in it every buffer_size bytes
+    """
+    def label(node):
+        result = _newick_label(tree.names[node])
+        if with_distances:
+            length = tree.length(node)
+            if length is not None:
+                result = "%s:%s" % (result, length)
+        return result
+
+    tokens = []
+    buffered = 0
+    written_nodes = 0
+    # ('(', node) opens node, (')', node) closes it, (',', None) separates
+    stack = [('(', tree.root)]
+    while stack:
+        action, node = stack.pop()
+        if action == '(':
+            children = list(tree.children(node))
+            if children:
+                tokens.append('(')
+                stack.append((')', node))
+                for idx in range(len(children) - 1, -1, -1):
+                    stack.append(('(', children[idx]))
+                    if idx:
+                        stack.append((',', None))
+            else:
+                tokens.append(label(node))
+                written_nodes += 1
+        elif action == ')':
+            tokens.append(')' + label(node))
+            written_nodes += 1
+        else:
+            tokens.append(',')
+
+        buffered += len(tokens[-1])
+        if buffered >= buffer_size:
+            out_f.write(''.join(tokens))
+            if progress is not None:
+                progress.update(written_nodes, buffered)
+            tokens = []
+            buffered = 0
+            written_nodes = 0
+    tokens.append(';')
+    out_f.write(''.join(tokens))
+    if progress is not None:
+        progress.update(written_nodes, buffered + 1)
+
+def build_nested_tree(parsed):
+    """returns a NestedOTUTree from [(otu_map, length, level), ...]
+
+    expects parsed to go from high -> low similarity, ie:
+
+    99, 97, 94, ...
+    """
+    builder = NestedOTUTreeBuilder()
+    for otu_map, length, level in parsed:
+        builder.add_level(otu_map, length, level)
+    return builder.build()
+
+def load_otu_map(otu_map_fp):
+    """returns (otu_ids, members, offsets) for the OTU map at otu_map_fp
+
+    the members of OTU i are members[offsets[i]:offsets[i + 1]]. this is a
+    lot cheaper to pickle than a list of lists, so it's what the loader
+    workers send back
+    """
+    otu_ids = []
+    members = []
+    offsets = array('i', [0])
+    for l in open(otu_map_fp, 'U'):
+        fields = l.strip().split('\t')
+        otu_ids.append(fields[0])
+        members.extend(fields[1:])
+        offsets.append(len(members))
+    return otu_ids, members, offsets
+
+def iter_otu_map(loaded):
+    """yields (clusterid, seqids) from the result of load_otu_map"""
+    otu_ids, members, offsets = loaded
+    for idx, otu_id in enumerate(otu_ids):
+        yield otu_id, members[offsets[idx]:offsets[idx + 1]]
+
+def load_otu_maps(otu_map_fps, num_processes=1):
+    """yields load_otu_map(fp) for each of otu_map_fps, in order
+
+    with more than one process the maps are parsed concurrently in a
+    process pool, so later maps are being parsed while earlier ones are
+    used
+    """
+    if num_processes <= 1 or len(otu_map_fps) <= 1:
+        for loaded in imap(load_otu_map, otu_map_fps):
+            yield loaded
+        return
+
+    pool = Pool(min(num_processes, len(otu_map_fps)))
+    try:
+        for loaded in pool.imap(load_otu_map, otu_map_fps):
+            yield loaded
+    finally:
+        pool.terminate()
+
+def estimate_unnest_memory(otu_map_fps, num_processes=1):
+    """returns the estimated peak memory (in bytes) of loading otu_map_fps
+    with num_processes and building their tree
+
+    the tree holds every member of every map, at about 4x the size of the
+    maps on disk, and a loaded map is about 3x its size. one process only
+    holds the map being added, but a pool can get ahead of the builder and
+    hold every loaded map at once
+    """
+    sizes = [getsize(fp) for fp in otu_map_fps]
+    if not sizes:
+        return 0
+    if num_processes <= 1 or len(sizes) <= 1:
+        loaded = max(sizes)
+    else:
+        loaded = sum(sizes)
+    return 4 * sum(sizes) + 3 * loaded
+
+def level_from_filename(otu_map_fp):
+    """returns the similarity level in the name of otu_map_fp
+
+    the level is the first field of the file name (split on _) that is a
+    number, e.g. 97 for gg_97_otu_map.txt or 97_otu_map.txt
+    """
+    for field in basename(otu_map_fp).split('_'):
+        if field.isdigit():
+            return int(field)
+    raise ValueError("Can't find a level in %s" % otu_map_fp)
+
+def parse_level_manifest(lines, base_dir=''):
+    """returns [(level, otu_map_fp)] from high -> low similarity
+
+    each line is a level and the path of its OTU map, seperated by a tab.
+    relative paths are taken relative to base_dir. blank lines and lines
+    starting with # are ignored
+    """
+    levels = []
+    for l in lines:
+        l = l.strip()
+        if not l or l.startswith('#'):
+            continue
+        level, otu_map_fp = l.split('\t')
+        if not isabs(otu_map_fp):
+            otu_map_fp = join(base_dir, otu_map_fp)
+        levels.append((int(level), otu_map_fp))
+    levels.sort(reverse=True)
+    return levels
+
+def read_level_manifest(manifest_fp):
+    """returns parse_level_manifest for the manifest at manifest_fp"""
+    return parse_level_manifest(open(manifest_fp, 'U'), dirname(manifest_fp))
+
+def find_workflow_otu_maps(output_dir):
+    """returns [(level, otu_map_fp)] from high -> low similarity
+
+    finds the otus/<level>_otu_map.txt files written by
+    pick_nested_reference_otus to output_dir
+    """
+    otu_dir = join(output_dir, 'otus')
+    levels = []
+    for fn in listdir(otu_dir):
+        level, sep, suffix = fn.partition('_')
+        if suffix == 'otu_map.txt' and level.isdigit():
+            levels.append((int(level), join(otu_dir, fn)))
+    if not levels:
+        raise ValueError("No OTU maps found in %s" % otu_dir)
+    levels.sort(reverse=True)
+    return levels
+
+def build_nested_tree_from_files(levels, num_processes=1,
+                                 progress_callback=None):
+    """returns a NestedOTUTree from [(level, otu_map_fp)]
+
+    expects levels to go from high -> low similarity. the maps are loaded
+    with load_otu_maps. if progress_callback is given, it's periodically
+    passed a message with how many of each level's OTUs have been joined
+    (see progress.ProgressReporter)
+    """
+    last_level = 100
+    builder = NestedOTUTreeBuilder()
+    loaded_maps = load_otu_maps([fp for level, fp in levels], num_processes)
+    for (level, otu_map_fp), loaded in izip(levels, loaded_maps):
+        progress = ProgressReporter('Joining the %d OTUs' % level,
+                                    progress_callback,
+                                    total_records=len(loaded[0]))
+        builder.add_level(progress.track(iter_otu_map(loaded)),
+                          float(last_level - level), level)
+        progress.finish()
+        last_level = level
+    return builder.build()
+
 if __name__ == '__main__':
     from sys import argv
 
@@ -79,21 +462,10 @@ if __name__ == '__main__':
     # gg_99_otu_map.txt,gg_97_otu_map.txt,gg_94_otu_map.txt,...
     otus_in_order = argv[1].split(',')
 
-    last_level = 100
-    nodes = []
-    for otus in otus_in_order:
-        tmp1,level,tmp2,tmp3 = otus.split('_')
-
-        level = int(level)
-        length = float(last_level - level)
-        otu_map = parse_otu_map(open(otus))
-       
-        nodes.append(make_nodes(otu_map, length, level))
-        
-        last_level = level
+    levels = [(level_from_filename(otus), otus) for otus in otus_in_order]
+    tree = build_nested_tree_from_files(levels)
 
-    tree = join_nodes(nodes)
-    f = open(argv[2],'w')
-    f.write(tree.getNewick(with_distances=True))
+    f = open_output(argv[2])
+    write_newick(tree, f)
     f.close()
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Contains utility functions shared by the nested_reference_otus modules."""
+
+import re
+from gzip import GzipFile
+from os import listdir, lstat, makedirs, remove
+from os.path import exists, join, splitext
+from stat import S_ISREG
+
+def open_output(output_fp, buffer_size=1048576):
+    """Opens output_fp for writing, gzip-compressed if it ends with .gz.
+
+    Returns a buffered file-like object.
+
+    If output_fp is a regular file with other hardlinks to it (such as a
+    file fetched from a stage_cache.StageCache), it is unlinked first, so
+    the new output replaces it instead of overwriting the other links'
+    contents.
+
+    Arguments:
+        output_fp - the path of the file to write
+        buffer_size - the size of the write buffer (in bytes). Ignored for
+            gzip output, which is buffered by the compressor
+    """
+    try:
+        info = lstat(output_fp)
+    except OSError:
+        info = None
+    if info is not None and S_ISREG(info.st_mode) and info.st_nlink > 1:
+        remove(output_fp)
+
+    if output_fp.endswith('.gz'):
+        return GzipFile(output_fp, 'wb')
+    return open(output_fp, 'w', buffer_size)
+
+def save_arrays(output_dir, arrays):
+    """Writes each array to its own .npy file in output_dir.
+
+    The arrays are written in NumPy's .npy format so that they can be
+    memory-mapped and used without copying when they are loaded again with
+    load_arrays. output_dir will be created if it doesn't already exist.
+
+    Arguments:
+        output_dir - the directory to write the arrays to
+        arrays - a dictionary mapping array name (used as the file name,
+            without the .npy extension) to NumPy array
+    """
+    from numpy import save
+
+    if not exists(output_dir):
+        makedirs(output_dir)
+    for name, array in arrays.items():
+        save(join(output_dir, name + '.npy'), array)
+
+def load_arrays(input_dir, mmap_mode='r'):
+    """Loads all arrays written by save_arrays from input_dir.
+
+    Returns a dictionary mapping array name to NumPy array. By default the
+    arrays are memory-mapped read-only, so no data is read from disk until it
+    is accessed.
+
+    Arguments:
+        input_dir - the directory containing the .npy files
+        mmap_mode - passed through to numpy.load. Use None to read the
+            arrays fully into memory
+    """
+    from numpy import load
+
+    arrays = {}
+    for fn in listdir(input_dir):
+        name, ext = splitext(fn)
+        if ext == '.npy':
+            arrays[name] = load(join(input_dir, fn), mmap_mode=mmap_mode)
+    return arrays
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+def parse_size(size):
+    """Returns the number of bytes in a size such as 500M, 20G or 1048576.
+
+    Sizes are case-insensitive, may end in B (e.g. 20GB), and use binary
+    units (1K is 1024 bytes). Fractional sizes such as 1.5G are allowed.
+
+    Arguments:
+        size - the size to parse, as a string or number of bytes
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([KMGT]?)B?\s*$',
+                     str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size '%s'. Expected a number of bytes, "
+                         "optionally followed by K, M, G or T." % size)
+    number, unit = match.groups()
+    return int(float(number) * _size_units[unit.upper()])
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.assign import (assign_seqs, find_workflow_rep_set,
+        ReferenceHierarchy)
+from nested_reference_otus.exact_index import ExactMatchIndex
+from nested_reference_otus.otu_collection import NestedOTUCollection
+from nested_reference_otus.unnest import (level_from_filename,
+        read_level_manifest, find_workflow_otu_maps,
+        build_nested_tree_from_files)
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+from nested_reference_otus.util import open_output
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Assign sequences to nested reference OTUs"""
+script_info['script_description'] = """
+Assigns each query sequence to an OTU at every level of a set of nested
+reference OTUs by descending the hierarchy: a query is compared with the
+representative sequences of the OTUs at the lowest similarity level, then only
+with the OTUs nested in its best match at each higher level. This takes a few
+comparisons per level instead of a comparison with every OTU at the highest
+level, as closed-reference assignment against the highest level would.
+
+A query is assigned to the OTU on its path at a level if it is estimated to be
+at least the level's similarity to the OTU's representative sequence, or to
+the representative of an OTU nested in it further down the path. Identities
+are estimated from MinHash sketches of the sequences' k-mers.
+
+With an exact match index (see build_exact_index.py), query sequences that are
+identical to a reference sequence are assigned to its OTUs with a single
+lookup, and only the rest are searched for. The number of sequences resolved
+each way is printed with -v and reported with --profile.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Assign to the workflow output",
+"Assign the sequences in seqs.fasta to the OTUs written by "
+"nested_reference_workflow.py to nested_otus, with 4 processes",
+"%prog -f seqs.fasta -w nested_otus -o assignments.txt -O 4"))
+script_info['script_usage'].append(("Resolve exact matches first",
+"Assign sequences identical to a reference sequence with the exact match "
+"index written by nested_reference_workflow.py -e, and search for the rest",
+"%prog -f seqs.fasta -w nested_otus -e nested_otus/exact_index -o "
+"assignments.txt"))
+script_info['script_usage'].append(("Assign to a nested OTU collection",
+"Take the OTUs and representative sequences from a single collection file "
+"(see build_nested_otu_collection.py)",
+"%prog -f seqs.fasta -c nested_otus.npz -o assignments.txt"))
+script_info['script_usage'].append(("Assign to a manifest of OTU maps",
+"Take the levels and OTU maps from a manifest (as for unnest.py) and the "
+"representative sequences from the full reference FASTA file",
+"%prog -f seqs.fasta -m otu_maps.txt -r gg_otus.fasta -o assignments.txt"))
+script_info['output_description']= """
+One line per query sequence and level it was assigned at, containing the query
+sequence ID, level, OTU ID, representative sequence ID and estimated identity
+separated by tabs, from high to low similarity. The IDs of the query sequences
+that couldn't be assigned at any level are written to the failures file.
+"""
+
+script_info['required_options'] = [
+    make_option('-f','--input_fasta_fp',
+        help="The query sequences to assign"),
+    options_lookup['output_fp']
+]
+script_info['optional_options'] = [
+    make_option('-i','--input_otu_maps',
+        help="The nested OTU maps, as a comma seperated list from high to "
+        "low similarity (see unnest.py) [default: %default]"),
+    make_option('-m','--manifest_fp',
+        help="A file listing the level and OTU map path of each level, "
+        "seperated by a tab (see unnest.py) [default: %default]"),
+    make_option('-w','--workflow_output_dir',
+        help="The output directory of nested_reference_workflow.py. The OTU "
+        "maps are taken from its otus directory and the representative "
+        "sequences from its highest level rep set [default: %default]"),
+    make_option('-c','--collection_fp',
+        help="A nested OTU collection, as written by "
+        "build_nested_otu_collection.py or nested_reference_workflow.py -c, "
+        "holding both the OTUs and the representative sequences "
+        "[default: %default]"),
+    make_option('-r','--reference_fasta_fp',
+        help="A FASTA file or sequence store (see build_seq_store.py) "
+        "containing the representative sequences of all of the OTUs. "
+        "Required unless -w or -c is provided [default: %default]"),
+    make_option('-e','--exact_index_dir',
+        help="An exact match index of the same OTUs, as written by "
+        "build_exact_index.py or nested_reference_workflow.py -e "
+        "[default: %default]"),
+    make_option('-u','--failures_fp',
+        help="The filepath to write unassigned sequence IDs to "
+        "[default: the output filepath with .failures.txt appended]"),
+    make_option('-k','--kmer_size',type='int',default=16,
+        help="The k-mer length of the sketches, at most 32 "
+        "[default: %default]"),
+    make_option('-n','--sketch_size',type='int',default=256,
+        help="The number of MinHash bins per sketch [default: %default]"),
+    make_option('-b','--batch_size',type='int',default=1000,
+        help="The number of query sequences to compare at a time "
+        "[default: %default]"),
+    make_option('-O','--jobs_to_start',type='int',default=1,
+        help="The number of processes to assign batches of query sequences "
+        "in [default: %default]"),
+    profile_option
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    sources = [opts.input_otu_maps, opts.manifest_fp, opts.workflow_output_dir,
+               opts.collection_fp]
+    if len([source for source in sources if source]) != 1:
+        option_parser.error("Exactly one of --input_otu_maps, --manifest_fp, "
+                            "--workflow_output_dir and --collection_fp must "
+                            "be provided")
+    if not (opts.reference_fasta_fp or opts.workflow_output_dir or
+            opts.collection_fp):
+        option_parser.error("--reference_fasta_fp must be provided unless "
+                            "--workflow_output_dir or --collection_fp is")
+    if not 1 <= opts.kmer_size <= 32:
+        option_parser.error("--kmer_size must be between 1 and 32")
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1")
+
+    if opts.input_otu_maps:
+        levels = [(level_from_filename(otus), otus)
+                  for otus in opts.input_otu_maps.split(',')]
+    elif opts.manifest_fp:
+        levels = read_level_manifest(opts.manifest_fp)
+    elif opts.workflow_output_dir:
+        levels = find_workflow_otu_maps(opts.workflow_output_dir)
+    failures_fp = opts.failures_fp or opts.output_fp + '.failures.txt'
+
+    profiler = PhaseProfiler(opts.profile)
+
+    with profiler.phase('load and sketch references'):
+        if opts.collection_fp:
+            collection = NestedOTUCollection(opts.collection_fp)
+            tree = collection.nested_tree()
+            reference_fasta_fp = opts.reference_fasta_fp or collection.store
+        else:
+            tree = build_nested_tree_from_files(levels, opts.jobs_to_start)
+            reference_fasta_fp = opts.reference_fasta_fp or \
+                find_workflow_rep_set(opts.workflow_output_dir, levels[0][0])
+        try:
+            hierarchy = ReferenceHierarchy(tree, reference_fasta_fp,
+                                           opts.kmer_size, opts.sketch_size)
+        except KeyError, e:
+            option_parser.error(e.args[0])
+        del tree
+        if opts.exact_index_dir:
+            exact_index = ExactMatchIndex(opts.exact_index_dir)
+        else:
+            exact_index = None
+
+    with profiler.phase('assign and write'):
+        output_f = open_output(opts.output_fp)
+        failures_f = open_output(failures_fp)
+        for seq_id, assignments, num in assign_seqs(hierarchy,
+                opts.input_fasta_fp, opts.batch_size, opts.jobs_to_start,
+                exact_index):
+            for assignment in assignments:
+                output_f.write('%s\t%d\t%s\t%s\t%1.4f\n' %
+                               ((seq_id,) + assignment))
+            # only exact matches are assigned without a comparison
+            if num == 0:
+                profiler.count('resolved by exact match')
+            else:
+                profiler.count('searched')
+                if assignments:
+                    profiler.count('assigned by search')
+                else:
+                    profiler.count('unassigned')
+                    failures_f.write('%s\n' % seq_id)
+            profiler.count('OTU comparisons', num)
+        output_f.close()
+        failures_f.close()
+
+    if opts.verbose:
+        counts = profiler.counts
+        num_seqs = counts.get('resolved by exact match', 0) + \
+                counts.get('searched', 0)
+        print "Resolved %d of %d sequences by exact match" % (
+                counts.get('resolved by exact match', 0), num_seqs)
+        print "Searched for %d sequences: %d assigned, %d unassigned" % (
+                counts.get('searched', 0), counts.get('assigned by search', 0),
+                counts.get('unassigned', 0))
+        print "Compared them with %d OTUs (%d with every OTU at the %d "\
+              "level)" % (counts.get('OTU comparisons', 0),
+                          counts.get('searched', 0) *
+                          hierarchy.num_otus()[-1], hierarchy.levels[-1])
+    profiler.write(opts.output_fp + '.profile.txt')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.exact_index import write_exact_index
+from nested_reference_otus.unnest import (level_from_filename,
+        read_level_manifest, find_workflow_otu_maps,
+        build_nested_tree_from_files)
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Build an exact match index of reference sequences"""
+script_info['script_description'] = """
+Writes a hash index from the digest of each reference sequence to its ID and
+the OTU containing it at every level of a set of nested OTU maps. Query
+sequences identical to a reference sequence can then be assigned with a
+single lookup (see assign_to_nested_otus.py -e) instead of a similarity
+search. Sequences are compared ignoring case, gaps and U/T.
+
+nested_reference_workflow.py writes this index itself when it's run with -e.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Index the workflow output",
+"Index the sequences the nested OTUs in nested_otus were picked from",
+"%prog -w nested_otus -r seqs.fasta -o exact_index"))
+script_info['output_description']= """
+The index directory, holding one .npy file per array.
+"""
+
+script_info['required_options'] = [
+    make_option('-r','--reference_fasta_fp',
+        help="The sequences the OTUs were picked from, as a FASTA file or "
+        "sequence store (see build_seq_store.py). Sequences that aren't in "
+        "the OTU maps aren't indexed"),
+    make_option('-o','--output_dir',
+        help="The index directory to write")
+]
+script_info['optional_options'] = [
+    make_option('-i','--input_otu_maps',
+        help="The nested OTU maps, as a comma seperated list from high to "
+        "low similarity (see unnest.py) [default: %default]"),
+    make_option('-m','--manifest_fp',
+        help="A file listing the level and OTU map path of each level, "
+        "seperated by a tab (see unnest.py) [default: %default]"),
+    make_option('-w','--workflow_output_dir',
+        help="The output directory of nested_reference_workflow.py. The OTU "
+        "maps are taken from its otus directory [default: %default]"),
+    make_option('-O','--jobs_to_start',type='int',default=1,
+        help="The number of OTU maps to parse concurrently "
+        "[default: %default]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    sources = [opts.input_otu_maps, opts.manifest_fp, opts.workflow_output_dir]
+    if len([source for source in sources if source]) != 1:
+        option_parser.error("Exactly one of --input_otu_maps, --manifest_fp "
+                            "and --workflow_output_dir must be provided")
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1")
+
+    if opts.input_otu_maps:
+        levels = [(level_from_filename(otus), otus)
+                  for otus in opts.input_otu_maps.split(',')]
+    elif opts.manifest_fp:
+        levels = read_level_manifest(opts.manifest_fp)
+    else:
+        levels = find_workflow_otu_maps(opts.workflow_output_dir)
+
+    tree = build_nested_tree_from_files(levels, opts.jobs_to_start)
+    write_exact_index(tree, opts.reference_fasta_fp, opts.output_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.otu_collection import (find_workflow_levels,
+        write_collection)
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Consolidate nested reference OTUs into a single file"""
+script_info['script_description'] = """
+Writes the OTU maps and rep sets of every level written by
+nested_reference_workflow.py to a single collection file. Each level's rep set
+is a subset of the level above it, so the collection holds every
+representative sequence once (2-bit packed, see build_seq_store.py) and
+describes each level by which sequences are its centroids and which OTUs of
+the level above its OTUs contain, rather than by sequence IDs.
+
+The collection can be used in place of the workflow output directory by
+assign_to_nested_otus.py (-c), and the per level files can be written back
+out with export_nested_otu_collection.py.
+
+nested_reference_workflow.py writes the collection itself when it's run with
+-c.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Consolidate the workflow output",
+"Write the nested OTUs in nested_otus to nested_otus.npz",
+"%prog -w nested_otus -o nested_otus.npz"))
+script_info['output_description']= """
+The collection, as a single NumPy .npz file.
+"""
+
+script_info['required_options'] = [
+    make_option('-w','--workflow_output_dir',
+        help="The output directory of nested_reference_workflow.py. The OTU "
+        "maps are taken from its otus directory and the rep sets from its "
+        "rep_set directory"),
+    options_lookup['output_fp']
+]
+script_info['optional_options'] = [
+    make_option('-r','--run_id',
+        help="The run id to name exported rep sets with [default: the run "
+        "id of the workflow's rep sets]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    try:
+        levels = find_workflow_levels(opts.workflow_output_dir)
+    except (OSError, ValueError), e:
+        option_parser.error(str(e))
+    write_collection(levels, opts.output_fp, opts.run_id)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.seq_store import write_seq_store
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Pack reference sequences into a shared sequence store"""
+script_info['script_description'] = """
+Packs the sequences in a FASTA file into a sequence store: the bases packed 2
+bits each, with a side table for ambiguous bases and gaps. The store is
+memory-mapped read-only, so any number of processes can share one copy of it,
+and sequences are only decoded when they're used. Sequences are stored in
+uppercase.
+
+The store directory can be passed wherever reference sequences are read by
+assign_to_nested_otus.py and build_exact_index.py (-r), and as the fasta_fp
+of a reference_server.py query.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Pack a reference",
+"Pack the reference sequences in gg_otus.fasta",
+"%prog -i gg_otus.fasta -o gg_otus_store"))
+script_info['output_description']= """
+The store directory, holding one .npy file per array.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--input_fasta_fp',
+        help="The sequences to pack"),
+    make_option('-o','--output_dir',
+        help="The store directory to write")
+]
+script_info['optional_options'] = []
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+    write_seq_store(opts.input_fasta_fp, opts.output_dir)
+
+if __name__ == "__main__":
+    main()
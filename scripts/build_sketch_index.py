@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.sketch_index import write_sketch_index
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Build a MinHash sketch index of reference sequences"""
+script_info['script_description'] = """
+Computes a MinHash sketch of the k-mers of each sequence in a FASTA file and
+writes them, with an LSH band index over them, to an index directory. The
+index answers "which reference sequences are estimated to be at least X%
+identical to this sequence" (see query_sketch_index.py) without comparing the
+sequence against every reference sequence, so it can be used to prefilter the
+candidates before an exact comparison.
+
+Larger sketches give more accurate identity estimates. More rows per band make
+queries more selective, but make it more likely that distant matches are
+missed. By default the number of rows per band is chosen so that about 97% of
+the matches at the minimum identity are found (3 rows at 97%, 2 at 94% and 1
+at 90% with the default k-mer and sketch sizes), so build the index for the
+lowest identity it will be queried at.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Build an index",
+"Sketch the 97% OTU representative sequences",
+"%prog -i rep_set/97_otus.fasta -o 97_sketch_index"))
+script_info['output_description']= """
+The index directory, holding one .npy file per array.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--input_fasta_fp',
+        help="The reference sequences to index"),
+    make_option('-o','--output_dir',
+        help="The index directory to write")
+]
+script_info['optional_options'] = [
+    make_option('-k','--kmer_size',type='int',default=16,
+        help="The k-mer length, at most 32 [default: %default]"),
+    make_option('-n','--sketch_size',type='int',default=128,
+        help="The number of MinHash bins per sketch [default: %default]"),
+    make_option('-s','--min_identity',type='float',default=0.97,
+        help="The lowest identity the index will be queried at "
+        "[default: %default]"),
+    make_option('-b','--rows_per_band',type='int',default=None,
+        help="The number of sketch bins per LSH band [default: chosen from "
+        "--min_identity]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    try:
+        write_sketch_index(opts.input_fasta_fp, opts.output_dir,
+                           opts.kmer_size, opts.sketch_size,
+                           opts.rows_per_band, opts.min_identity)
+    except ValueError, e:
+        option_parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.tree_cache import write_tree_cache
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Convert a newick tree to a tree cache"""
+script_info['script_description'] = """
+Parses a newick tree once and writes it as preorder arrays of parent
+indices, branch lengths and names, with an index of the tip names. The arrays
+are memory-mapped when they're loaded, so passing the cache directory to
+nested_reference_workflow.py -t in place of the newick file skips parsing the
+tree on every run. Pruning the tree to each threshold's rep set works on the
+arrays directly.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Convert a tree",
+"Write the tree cache of gg_otus.tre to gg_otus_tree",
+"%prog -i gg_otus.tre -o gg_otus_tree"))
+script_info['output_description']= """
+The tree cache directory, holding one .npy file per array.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--input_tree_fp',
+        help="The newick tree to convert"),
+    options_lookup['output_dir']
+]
+script_info['optional_options'] = []
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    try:
+        write_tree_cache(open(opts.input_tree_fp, 'U'), opts.output_dir)
+    except ValueError, e:
+        option_parser.error("Can't parse %s: %s" % (opts.input_tree_fp, e))
+
+if __name__ == "__main__":
+    main()
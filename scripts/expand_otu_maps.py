@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from os.path import basename, join, splitext
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option,
+                        create_dir)
+from nested_reference_otus.unnest import parse_otu_map
+from nested_reference_otus.expand_otu_maps import (expand_nested_otu_maps,
+        format_otu_map)
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Expand nested OTU maps to the original sequences"""
+script_info['script_description'] = """
+Each lower similarity OTU map from pick_nested_reference_otus lists the reps of
+the level before it. This script writes an expanded OTU map for every level
+that instead lists all of the original input sequences in each OTU (with the
+OTU's rep listed first).
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Expand the OTU maps",
+"Expand the nested OTU maps, writing 99_otu_map_expanded.txt, "
+"97_otu_map_expanded.txt and 94_otu_map_expanded.txt to expanded/",
+"%prog -i 99_otu_map.txt,97_otu_map.txt,94_otu_map.txt -o expanded"))
+script_info['output_description']= """
+An expanded OTU map for each input OTU map, named after the input OTU map with
+_expanded added.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--input_otu_maps',
+        help="The input OTU maps. This should be a comma seperated list of "
+        "the OTU maps from high to low similarity"),
+    options_lookup['output_dir']
+]
+script_info['optional_options'] = [profile_option]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    otus_in_order = opts.input_otu_maps.split(',')
+    create_dir(opts.output_dir)
+
+    profiler = PhaseProfiler(opts.profile)
+
+    otu_maps = (parse_otu_map(open(otus,'U')) for otus in otus_in_order)
+    expanded_maps = expand_nested_otu_maps(otu_maps)
+    for otus in otus_in_order:
+        # each map is only parsed when it is needed for expanding
+        with profiler.phase('parse and expand'):
+            expanded = expanded_maps.next()
+        with profiler.phase('write'):
+            output_fp = join(opts.output_dir,
+                             splitext(basename(otus))[0] + '_expanded.txt')
+            f = open(output_fp,'w')
+            f.writelines(format_otu_map(expanded))
+            f.close()
+    profiler.write(join(opts.output_dir, 'profile.txt'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.otu_collection import (export_legacy_files,
+        NestedOTUCollection)
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Write the per level files of a nested OTU collection"""
+script_info['script_description'] = """
+Writes the OTU map and rep set of every level in a collection written by
+build_nested_otu_collection.py, named and laid out as
+nested_reference_workflow.py writes them, for tools that read the per level
+files.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Export a collection",
+"Write the OTU maps and rep sets in nested_otus.npz to exported",
+"%prog -i nested_otus.npz -o exported"))
+script_info['output_description']= """
+An otus directory holding <level>_otu_map.txt and a rep_set directory holding
+<level>_otus_<run_id>.fasta for each level.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--collection_fp',
+        help="The collection written by build_nested_otu_collection.py"),
+    options_lookup['output_dir']
+]
+script_info['optional_options'] = [
+    make_option('-r','--run_id',
+        help="The run id to name the rep sets with [default: the run id "
+        "stored in the collection]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    collection = NestedOTUCollection(opts.collection_fp)
+    export_legacy_files(collection, opts.output_dir, opts.run_id)
+
+if __name__ == "__main__":
+    main()
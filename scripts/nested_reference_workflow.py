@@ -13,6 +13,7 @@ __status__ = "Development"
 
 import gzip
 from os import makedirs
+from os.path import join
 from subprocess import Popen, PIPE, STDOUT
 from optparse import make_option
 from cogent import LoadTree
@@ -24,6 +25,10 @@ from qiime.workflow.util import (print_commands,
 
 from nested_reference_otus.nested_reference_workflow import (get_second_field,
         rename_rep_seqs, pick_nested_reference_otus)
+from nested_reference_otus.memory import memory_option
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+from nested_reference_otus.stage_cache import StageCache
+from nested_reference_otus.util import parse_size
 
 options_lookup = get_options_lookup()
 
@@ -42,7 +47,40 @@ script_info['optional_options'] = [
  make_option('-w','--print_only',action='store_true',\
         dest='print_only',help='Print the commands but don\'t call them -- '+\
         'useful for debugging [default: %default]',default=False),\
- make_option('-t','--input_tree_fp',help='the full tree to filter to otu trees'),
+ make_option('-t','--input_tree_fp',help='the full tree to filter to otu '+\
+        'trees, as a newick file or a tree cache directory written by '+\
+        'build_tree_cache.py (which skips parsing the tree)'),
+ make_option('-u','--build_unnested_tree',action='store_true',
+        help='also write the unnested tree (unnested.ntree) and its OTU '+\
+        'membership index (unnested_index) to the output dir, built as '+\
+        'each threshold is picked [default: %default]',default=False),
+ make_option('-x','--build_sketch_indexes',action='store_true',
+        help='also write a MinHash sketch index of each threshold\'s '+\
+        'representative sequences to the sketch_indexes directory in the '+\
+        'output dir, for fast candidate OTU queries (see '+\
+        'query_sketch_index.py) [default: %default]',default=False),
+ make_option('-e','--build_exact_index',action='store_true',
+        help='also write an exact match index of the input sequences '+\
+        '(exact_index) to the output dir, so assign_to_nested_otus.py can '+\
+        'assign sequences identical to a reference sequence without '+\
+        'searching [default: %default]',default=False),
+ make_option('-c','--write_otu_collection',action='store_true',
+        help='also write the OTU maps and rep sets of every threshold to a '+\
+        'single collection file (nested_otus.npz) in the output dir, which '+\
+        'holds each representative sequence once (see '+\
+        'build_nested_otu_collection.py) [default: %default]',default=False),
+ make_option('--cache_dir',
+        help='a directory to cache the OTU maps, rep sets and filtered '+\
+        'trees of each threshold in. A later run with the same input '+\
+        'sequences (or tree), threshold and tool versions reuses the cached '+\
+        'files instead of picking OTUs again. The directory can be shared '+\
+        'between runs [default: no cache]'),
+ make_option('--cache_max_size',default='20G',
+        help='the maximum size of the cache, in bytes or with a K, M, G or '+\
+        'T suffix. The least recently used files are removed once the '+\
+        'cache is larger [default: %default]'),
+ memory_option,
+ profile_option,
 ]
 script_info['version'] = __version__
 
@@ -59,6 +97,20 @@ def main():
     verbose = opts.verbose
     print_only = opts.print_only
     
+    if opts.cache_dir and not print_only:
+        try:
+            cache_max_size = parse_size(opts.cache_max_size)
+        except ValueError, e:
+            option_parser.error(str(e))
+        stage_cache = StageCache(opts.cache_dir, cache_max_size)
+    else:
+        stage_cache = None
+    if opts.max_memory:
+        try:
+            parse_size(opts.max_memory)
+        except ValueError, e:
+            option_parser.error(str(e))
+
     try:
         makedirs(output_dir)
     except OSError:
@@ -76,6 +128,7 @@ def main():
     else:
         status_update_callback = no_status_updates
 
+    profiler = PhaseProfiler(opts.profile)
     pick_nested_reference_otus(
      input_fasta_fp=input_fasta_fp,
      input_tree_fp=input_tree_fp,
@@ -83,7 +136,15 @@ def main():
      run_id=run_id,
      similarity_thresholds=similarity_thresholds,
      command_handler=command_handler,
-     status_update_callback=status_update_callback)
+     status_update_callback=status_update_callback,
+     build_unnested_tree=opts.build_unnested_tree and not print_only,
+     build_sketch_indexes=opts.build_sketch_indexes and not print_only,
+     build_exact_index=opts.build_exact_index and not print_only,
+     write_otu_collection=opts.write_otu_collection and not print_only,
+     stage_cache=stage_cache,
+     max_memory=opts.max_memory,
+     profiler=profiler)
+    profiler.write(join(output_dir,'profile.txt'))
 
 
 if __name__ == "__main__":
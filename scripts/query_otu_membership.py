@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from sys import stdout
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.membership_index import OTUMembershipIndex
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Query the OTU membership index"""
+script_info['script_description'] = """
+Query an OTU membership index written by unnest.py for all tips that are
+associated with a particular OTU, or for the OTUs at every level that contain
+a particular sequence.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Tips of an OTU",
+"List all sequences in OTU 42 at the 94% level",
+"%prog -i unnested_index -l 94 -u 42"))
+script_info['script_usage'].append(("OTUs of a sequence",
+"List the OTU (and its representative sequence) containing sequence 1234 at "
+"every level",
+"%prog -i unnested_index -s 1234"))
+script_info['output_description']= """
+For an OTU query, one sequence ID per line. For a sequence query, one line per
+level containing the level, OTU ID and representative sequence ID separated by
+tabs.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--index_dir',
+        help="The OTU membership index directory, as written by unnest.py")
+]
+script_info['optional_options'] = [
+    make_option('-l','--level',type='int',
+        help="The level of the OTU to query. Must be used with -u "
+        "[default: %default]"),
+    make_option('-u','--otu_id',
+        help="The ID of the OTU to query, as listed in the OTU map "
+        "[default: %default]"),
+    make_option('-s','--seq_id',
+        help="The ID of the sequence to query [default: %default]"),
+    make_option('-o','--output_fp',
+        help="The output filepath [default: write to stdout]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    otu_query = opts.level is not None or opts.otu_id is not None
+    if otu_query and (opts.level is None or opts.otu_id is None):
+        option_parser.error("-l and -u must be used together.")
+    if otu_query == (opts.seq_id is not None):
+        option_parser.error("Exactly one of -u or -s must be provided.")
+
+    index = OTUMembershipIndex(opts.index_dir)
+    try:
+        if otu_query:
+            lines = ['%s\n' % tip for tip in index.tips(opts.level,
+                                                        opts.otu_id)]
+        else:
+            lines = ['%d\t%s\t%s\n' % e for e in index.ancestors(opts.seq_id)]
+    except KeyError, e:
+        option_parser.error(e.args[0])
+
+    if opts.output_fp:
+        f = open(opts.output_fp,'w')
+    else:
+        f = stdout
+    f.writelines(lines)
+    if opts.output_fp:
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+from sys import stdout
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.parse import parse_fasta
+from nested_reference_otus.sketch_index import SketchIndex
+from nested_reference_otus.util import open_output
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Find candidate reference sequences with a sketch index"""
+script_info['script_description'] = """
+For each sequence in a FASTA file, lists the reference sequences in a sketch
+index (as written by build_sketch_index.py, or nested_reference_workflow.py
+with -x) that are estimated to be at least a given identity to it. The
+identities are estimates from the MinHash sketches, so the candidates should
+be confirmed with an exact comparison.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Candidate OTUs",
+"List the 97% OTUs estimated to be at least 97% identical to each query "
+"sequence",
+"%prog -i 97_sketch_index -f seqs.fasta -s 0.97 -o candidates.txt"))
+script_info['output_description']= """
+One line per candidate containing the query sequence ID, reference sequence ID
+and estimated identity separated by tabs. The candidates of each query are
+listed in order of decreasing identity.
+"""
+
+script_info['required_options'] = [
+    make_option('-i','--index_dir',
+        help="The sketch index directory"),
+    make_option('-f','--input_fasta_fp',
+        help="The sequences to query")
+]
+script_info['optional_options'] = [
+    make_option('-s','--min_identity',type='float',default=0.97,
+        help="The minimum estimated identity [default: %default]"),
+    make_option('-a','--all',action='store_true',default=False,
+        help="Compare each query against every reference sketch instead of "
+        "only those sharing an LSH band with it. Slower, but doesn't miss "
+        "distant matches [default: %default]"),
+    make_option('-o','--output_fp',
+        help="The output filepath [default: write to stdout]")
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    index = SketchIndex(opts.index_dir)
+    if opts.output_fp:
+        f = open_output(opts.output_fp)
+    else:
+        f = stdout
+    for seq_id, seq in parse_fasta(opts.input_fasta_fp):
+        seq_id = seq_id.split()[0]
+        for ref_id, identity in index.query(seq, opts.min_identity,
+                                            not opts.all):
+            f.write('%s\t%s\t%1.4f\n' % (seq_id, ref_id, identity))
+    if opts.output_fp:
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+from os import getcwd
+from sys import stderr
+from qiime.util import (parse_command_line_parameters,
+                        get_options_lookup,
+                        make_option)
+from nested_reference_otus.server import ReferenceServer
+
+options_lookup = get_options_lookup()
+
+script_info = {}
+script_info['brief_description'] = """Serves sort, summary and OTU membership queries from memory"""
+script_info['script_description'] = """
+This script starts a long-running server on a local Unix socket that answers
+taxonomic-depth sorting, taxonomic agreement summary and OTU membership
+queries. Each taxonomy map, FASTA file, OTU map and membership index is parsed
+the first time a query needs it and then kept in memory, so later queries
+against the same reference files don't pay the cost of parsing them again.
+Files that change on disk are reloaded by the next query that uses them.
+Queries are answered concurrently, one thread per connection.
+
+Only the user running the server can connect to the socket, and queries can
+only name files inside the reference directories given with -r (the current
+directory by default). Errors caused by a reference file, rather than by the
+query, are reported to the client without details, which are written to
+standard error instead.
+
+Clients send one JSON object per line and receive one JSON object per line in
+response. From Python, use send_request or send_requests in
+nested_reference_otus.server, e.g.:
+
+send_request('ref.sock', {'command': 'tips', 'index_dir': 'unnested_index',
+'level': 94, 'otu_id': '42'})
+
+See answer_request in nested_reference_otus.server for the available commands
+and their parameters.
+"""
+script_info['script_usage'] = []
+script_info['script_usage'].append(("Start a server",
+"Serve queries on the socket ref.sock until the server is interrupted.",
+"%prog -s ref.sock"))
+script_info['script_usage'].append(("Limit the reference files",
+"Only allow queries against files in the gg_otus and nested_otus "
+"directories.",
+"%prog -s ref.sock -r gg_otus,nested_otus"))
+script_info['output_description']= """
+The script doesn't write any output files. The socket file is removed when the
+server exits.
+"""
+
+script_info['required_options'] = [
+    make_option('-s','--socket_fp',
+        help='the path of the Unix socket to listen on')
+]
+script_info['optional_options'] = [
+    make_option('-r','--reference_dirs',default=getcwd(),
+        help='a comma-separated list of the directories whose files can be '
+        'queried [default: the current directory]')
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    try:
+        server = ReferenceServer(opts.socket_fp,
+                reference_dirs=opts.reference_dirs.split(','),
+                error_f=stderr)
+    except ValueError, e:
+        option_parser.error(str(e))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
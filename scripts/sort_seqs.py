@@ -13,8 +13,13 @@ __status__ = "Development"
 from qiime.util import (parse_command_line_parameters,
                         get_options_lookup,
                         make_option)
+from nested_reference_otus.memory import MemoryBudget, memory_option
 from nested_reference_otus.sort_seqs import (compute_sequence_stats,
-                                             sort_seqs_by_taxonomic_depth)
+                                             estimate_sort_memory,
+                                             sort_seqs_by_taxonomic_depth,
+                                             sort_seqs_on_disk)
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+from nested_reference_otus.progress import ProgressReporter
 
 options_lookup = get_options_lookup()
 
@@ -34,6 +39,12 @@ script_info['script_usage'].append(("Sort sequences by taxonomic depth and "
 "then sorts sequences within each taxonomic depth by decreasing length so "
 "that longer reads come first.",
 "%prog -i input.fasta -t taxonomy_map.txt -o sorted_seqs.fasta"))
+script_info['script_usage'].append(("Sort sequences in limited memory",
+"Sorts the sequences as above, but if sorting them in memory is estimated to "
+"need more than 4G, the sequences are sorted in runs that are written to "
+"temporary files and merged instead. -v reports which sort was used.",
+"%prog -i input.fasta -t taxonomy_map.txt -o sorted_seqs.fasta "
+"--max_memory 4G -v"))
 script_info['output_description']= """
 The script creates a single output FASTA file containing the sorted sequences.
 """
@@ -46,23 +57,58 @@ script_info['required_options'] = [
         'string, and source string separated by a tab'),
     options_lookup['output_fp']
 ]
-script_info['optional_options'] = []
+script_info['optional_options'] = [memory_option, profile_option]
 script_info['version'] = __version__
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    seq_stats = compute_sequence_stats(
-            open(opts.input_fasta_fp, 'U').readlines(),
-            open(opts.input_taxonomy_map, 'U').readlines(),
-            ['Incertae_sedis', 'unidentified'])
-    seq_stats_sorted = sort_seqs_by_taxonomic_depth(seq_stats)
+    profiler = PhaseProfiler(opts.profile)
+    unknown_keywords = ['Incertae_sedis', 'unidentified']
+
+    def report(message):
+        if opts.verbose:
+            print message
+    try:
+        budget = MemoryBudget(opts.max_memory, report)
+    except ValueError, e:
+        option_parser.error(str(e))
+    # Long steps report their progress every 10 seconds with -v.
+    progress_callback = report if opts.verbose else None
+
+    if budget.fits('sort sequences',
+                   estimate_sort_memory(opts.input_fasta_fp,
+                                        opts.input_taxonomy_map),
+                   'an external merge sort on disk'):
+        # The input files are parsed as they are read, so parsing is part of
+        # the compute phase.
+        with profiler.phase('compute'):
+            seq_stats = compute_sequence_stats(opts.input_fasta_fp,
+                                               opts.input_taxonomy_map,
+                                               unknown_keywords,
+                                               progress_callback)
+        with profiler.phase('sort'):
+            seq_stats_sorted = sort_seqs_by_taxonomic_depth(seq_stats)
+    else:
+        # Runs are sorted and written as the input is read, and merged as the
+        # output is written, so the phases overlap.
+        seq_stats_sorted = sort_seqs_on_disk(opts.input_fasta_fp,
+                opts.input_taxonomy_map, unknown_keywords,
+                run_size=budget.max_memory // 4,
+                progress_callback=progress_callback)
 
     # Write out our sorted sequences.
-    out_fasta_f = open(opts.output_fp, 'w')
-    for seq in seq_stats_sorted:
-        out_fasta_f.write('>' + seq[0] + '\n' + seq[3] + '\n')
-    out_fasta_f.close()
+    with profiler.phase('write'):
+        progress = ProgressReporter('Writing sorted sequences',
+                                    progress_callback)
+        out_fasta_f = open(opts.output_fp, 'w')
+        for seq in seq_stats_sorted:
+            record = '>' + seq[0] + '\n' + seq[3] + '\n'
+            out_fasta_f.write(record)
+            progress.update(1, len(record))
+        out_fasta_f.close()
+        progress.finish()
+    profiler.write(opts.output_fp + '.profile.txt')
 
 
 if __name__ == "__main__":
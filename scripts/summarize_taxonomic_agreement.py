@@ -10,14 +10,24 @@ __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 __status__ = "Development"
 
+from os.path import realpath
 from qiime.util import (parse_command_line_parameters,
                         get_options_lookup,
                         make_option)
 from nested_reference_otus.summarize_taxonomic_agreement import (
-        summarize_taxonomic_agreement)
+        compute_taxonomic_agreement_statistics,
+        estimate_taxonomic_agreement_memory,
+        format_taxonomic_agreement_statistics, summarize_taxonomic_agreement,
+        summarize_taxonomic_agreement_arrays, update_taxonomic_agreement_summary)
+from nested_reference_otus.memory import MemoryBudget, memory_option
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+from nested_reference_otus.util import save_arrays
 
 options_lookup = get_options_lookup()
 
+level_names = ['Domain', 'Kingdom', 'Phylum', 'Class', 'Order', 'Family',
+               'Genus', 'Species']
+
 script_info = {}
 script_info['brief_description'] = "Summarizes the agreement of sequences with their reference taxonomy"
 script_info['script_description'] = """
@@ -32,9 +42,42 @@ script_info['script_usage'].append(("Summarize taxonomic agreement",
 "Summarizes the percentage of sequences in each OTU that have the same "
 "taxonomic level as the reference sequence", "%prog -i 99_otu_map.txt -t "
 "taxonomy_map.txt -o taxonomic_agreement_summary.txt"))
+script_info['script_usage'].append(("Summarize taxonomic agreement in binary "
+"format", "Writes the same summary as a directory of NumPy .npy arrays that "
+"can be memory-mapped with numpy.load(fp, mmap_mode='r')", "%prog -i "
+"99_otu_map.txt -t taxonomy_map.txt -o taxonomic_agreement_summary -f binary"))
+script_info['script_usage'].append(("Update a previous summary",
+"Summarizes taxonomic agreement for a new OTU map, reusing the rows of a "
+"previous summary for OTUs whose membership is unchanged and whose members' "
+"taxonomies are not listed in changed_ids.txt (one sequence ID per line). The "
+"output is identical to a full recompute", "%prog -i 99_otu_map.txt -t "
+"taxonomy_map.txt -o taxonomic_agreement_summary.txt --previous_otu_map_fp "
+"old_99_otu_map.txt --previous_summary_fp old_taxonomic_agreement_summary.txt "
+"--changed_seq_ids_fp changed_ids.txt"))
+script_info['script_usage'].append(("Approximate summary",
+"Summarizes OTUs with more than 1000 members from a reproducible random "
+"sample of 1000 of their members. Confidence intervals for each level's "
+"percent agreement are written as additional columns", "%prog -i "
+"61_otu_map.txt -t taxonomy_map.txt -o taxonomic_agreement_summary.txt "
+"--sample_size 1000"))
+script_info['script_usage'].append(("Dataset-level statistics",
+"Computes only the mean and size-weighted mean agreement and a 20-bin "
+"agreement histogram for each level, and the number of OTUs with less than 90% "
+"agreement at genus. No per-OTU output is kept, so memory use does not grow "
+"with the number of OTUs", "%prog -i 97_otu_map.txt -t taxonomy_map.txt -o "
+"taxonomic_agreement_stats.txt --summary_only --histogram_bins 20 "
+"--agreement_threshold 90"))
+script_info['script_usage'].append(("Summarize in limited memory",
+"Summarizes taxonomic agreement as above, but if the taxonomy is estimated to "
+"need more than 2G of memory, it is kept in a temporary database on disk "
+"instead. -v reports which was used", "%prog -i 99_otu_map.txt -t "
+"taxonomy_map.txt -o taxonomic_agreement_summary.txt --max_memory 2G -v"))
 script_info['output_description']= """
 The script creates a single tab-separated file containing the taxonomic
-agreement summary.
+agreement summary. If the binary output format is chosen, the output is instead
+a directory containing one NumPy .npy file per column: otu_ids, sizes,
+agreement (OTUs x taxonomic levels, float32), member_ids and member_offsets,
+and encountered_values and encountered_offsets.
 """
 
 script_info['required_options'] = [
@@ -45,24 +88,156 @@ script_info['required_options'] = [
         'string, and source string separated by a tab'),
     options_lookup['output_fp']
 ]
-script_info['optional_options'] = []
+script_info['optional_options'] = [
+    make_option('-f','--output_format',type='choice',
+        choices=['tsv','binary'],default='tsv',
+        help='the format of the output. tsv writes a single tab-separated '
+        'file. binary writes a directory of NumPy .npy arrays that can be '
+        'memory-mapped [default: %default]'),
+    make_option('--previous_otu_map_fp',
+        help='the OTU map that the summary passed as --previous_summary_fp '
+        'was generated from. If provided, only OTUs that have changed are '
+        'recomputed. Must be used with --previous_summary_fp and '
+        '--changed_seq_ids_fp [default: %default]'),
+    make_option('--previous_summary_fp',
+        help='a taxonomic agreement summary (in tsv format) previously '
+        'generated from --previous_otu_map_fp [default: %default]'),
+    make_option('--changed_seq_ids_fp',
+        help='a file listing the IDs of sequences whose taxonomy has changed '
+        'since --previous_summary_fp was generated, one per line. Only the '
+        'first tab-separated field of each line is used, so a taxonomy map '
+        'containing only the changed rows can also be provided '
+        '[default: %default]'),
+    make_option('--sample_size',type='int',
+        help='if provided, OTUs larger than --sample_min_otu_size are '
+        'summarized approximately from a random sample of this many of their '
+        'members, and 95% confidence intervals are reported. By default, the '
+        'summary is exact [default: %default]'),
+    make_option('--sample_min_otu_size',type='int',
+        help='only OTUs with more than this many members are sampled. Only '
+        'used with --sample_size [default: --sample_size + 1]'),
+    make_option('--random_seed',type='int',default=0,
+        help='the random seed used for sampling. Only used with '
+        '--sample_size [default: %default]'),
+    make_option('--summary_only',action='store_true',default=False,
+        help='write dataset-level statistics (mean and size-weighted mean '
+        'agreement and an agreement histogram for each level, and the number '
+        'of OTUs below --agreement_threshold) instead of a per-OTU summary '
+        '[default: %default]'),
+    make_option('--histogram_bins',type='int',default=10,
+        help='the number of agreement histogram bins for each level. Only '
+        'used with --summary_only [default: %default]'),
+    make_option('--agreement_threshold',type='float',default=100.0,
+        help='count the OTUs with less than this percent agreement at '
+        '--threshold_level. Only used with --summary_only [default: %default]'),
+    make_option('--threshold_level',type='choice',choices=level_names,
+        default='Genus',
+        help='the taxonomic level that --agreement_threshold applies to. Only '
+        'used with --summary_only [default: %default]'),
+    memory_option,
+    profile_option
+]
 script_info['version'] = __version__
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    results = summarize_taxonomic_agreement(
-            open(opts.otu_map_fp, 'U').readlines(),
-            open(opts.input_taxonomy_map, 'U').readlines())
+    incremental_options = [opts.previous_otu_map_fp, opts.previous_summary_fp,
+                           opts.changed_seq_ids_fp]
+    incremental = incremental_options.count(None) == 0
+    if not incremental and incremental_options.count(None) != 3:
+        option_parser.error("--previous_otu_map_fp, --previous_summary_fp, "
+                            "and --changed_seq_ids_fp must be used together.")
+    if incremental and realpath(opts.previous_summary_fp) == \
+                       realpath(opts.output_fp):
+        # The previous summary is streamed while the output is written.
+        option_parser.error("The output filepath must be different from "
+                            "--previous_summary_fp.")
+    if incremental and opts.output_format != 'tsv':
+        option_parser.error("Updating a previous summary is only supported "
+                            "with the tsv output format.")
+    approximate = opts.sample_size is not None
+    if approximate and (incremental or opts.output_format != 'tsv'):
+        option_parser.error("--sample_size is only supported with the tsv "
+                            "output format and cannot be used to update a "
+                            "previous summary.")
+    if approximate and opts.sample_size < 1:
+        option_parser.error("--sample_size must be at least 1.")
+    if opts.summary_only and (incremental or approximate or
+                              opts.output_format != 'tsv'):
+        option_parser.error("--summary_only cannot be combined with the binary "
+                            "output format, --sample_size, or updating a "
+                            "previous summary.")
+    if opts.histogram_bins < 1:
+        option_parser.error("--histogram_bins must be at least 1.")
+
+    def report(message):
+        if opts.verbose:
+            print message
+    try:
+        budget = MemoryBudget(opts.max_memory, report)
+    except ValueError, e:
+        option_parser.error(str(e))
+    # Long steps report their progress every 10 seconds with -v.
+    progress_callback = report if opts.verbose else None
+
+    profiler = PhaseProfiler(opts.profile)
+
+    # The input files are parsed as they are read, so parsing is part of the
+    # compute phase (and streamed summaries are computed as they are written).
+    otu_map_fp = opts.otu_map_fp
+    tax_map_fp = opts.input_taxonomy_map
+    on_disk = not budget.fits('load taxonomy',
+            estimate_taxonomic_agreement_memory(tax_map_fp),
+            'with the taxonomy in a temporary database on disk')
+
+    if opts.summary_only:
+        with profiler.phase('compute'):
+            stats = compute_taxonomic_agreement_statistics(otu_map_fp,
+                    tax_map_fp, num_bins=opts.histogram_bins,
+                    agreement_threshold=opts.agreement_threshold,
+                    threshold_level=level_names.index(opts.threshold_level),
+                    on_disk=on_disk, progress_callback=progress_callback)
 
-    out_f = open(opts.output_fp, 'w')
-    out_f.write('OTU_ID\tSize\tSeq_IDs\tDomain\tKingdom\tPhylum\tClass\t'
-                'Order\tFamily\tGenus\tSpecies\tDomain\tKingdom\tPhylum\t'
-                'Class\tOrder\tFamily\tGenus\tSpecies\n')
-    for line in results:
-        out_f.write(line)
-    out_f.close()
+        with profiler.phase('write'):
+            out_f = open(opts.output_fp, 'w')
+            for line in format_taxonomic_agreement_statistics(stats,
+                                                              level_names):
+                out_f.write(line)
+            out_f.close()
+    elif opts.output_format == 'binary':
+        with profiler.phase('compute'):
+            arrays = summarize_taxonomic_agreement_arrays(otu_map_fp,
+                    tax_map_fp, on_disk=on_disk,
+                    progress_callback=progress_callback)
+        with profiler.phase('write'):
+            save_arrays(opts.output_fp, arrays)
+    else:
+        if incremental:
+            changed_seq_ids = [line.split('\t')[0].strip() for line in
+                               open(opts.changed_seq_ids_fp, 'U')
+                               if line.strip()]
+            results = update_taxonomic_agreement_summary(otu_map_fp,
+                    tax_map_fp, opts.previous_otu_map_fp,
+                    opts.previous_summary_fp, changed_seq_ids,
+                    on_disk=on_disk, progress_callback=progress_callback)
+        else:
+            results = summarize_taxonomic_agreement(otu_map_fp, tax_map_fp,
+                    sample_size=opts.sample_size,
+                    size_cutoff=opts.sample_min_otu_size,
+                    seed=opts.random_seed, on_disk=on_disk,
+                    progress_callback=progress_callback)
 
+        with profiler.phase('compute and write'):
+            out_f = open(opts.output_fp, 'w')
+            header = ['OTU_ID', 'Size', 'Seq_IDs'] + level_names + level_names
+            if approximate:
+                header += [level_name + '_CI' for level_name in level_names]
+            out_f.write('\t'.join(header) + '\n')
+            for line in results:
+                out_f.write(line)
+            out_f.close()
+    profiler.write(opts.output_fp + '.profile.txt')
 
 if __name__ == "__main__":
     main()
@@ -13,7 +13,14 @@ __status__ = "Development"
 from qiime.util import (parse_command_line_parameters,
                         get_options_lookup,
                         make_option)
-from nested_reference_otus.unnest import parse_otu_map, make_nodes, join_nodes
+from nested_reference_otus.unnest import (write_newick, level_from_filename,
+        read_level_manifest, find_workflow_otu_maps,
+        build_nested_tree_from_files, estimate_unnest_memory)
+from nested_reference_otus.memory import MemoryBudget, memory_option
+from nested_reference_otus.membership_index import write_membership_index
+from nested_reference_otus.profiling import PhaseProfiler, profile_option
+from nested_reference_otus.progress import ProgressReporter
+from nested_reference_otus.util import open_output
 
 options_lookup = get_options_lookup()
 
@@ -27,43 +34,113 @@ script_info['script_usage'] = []
 script_info['script_usage'].append(("Unnests the OTUs",
 "Take the nested OTU maps and unroll them into a tree",
 "%prog -i gg_99_otu_map.txt,gg_97_otu_map.txt,gg_94_otu_map.txt -o unnested.ntree"))
+script_info['script_usage'].append(("Unnest and index the OTUs",
+"Also write an OTU membership index, which can be queried with "
+"query_otu_membership.py without loading the tree",
+"%prog -i gg_99_otu_map.txt,gg_97_otu_map.txt,gg_94_otu_map.txt -o "
+"unnested.ntree -x unnested_index"))
+script_info['script_usage'].append(("Unnest a manifest of OTU maps",
+"Take the levels and OTU maps from a manifest, where each line is a level and "
+"the path of its OTU map seperated by a tab, parsing 4 maps at a time",
+"%prog -m otu_maps.txt -o unnested.ntree -O 4"))
+script_info['script_usage'].append(("Unnest in limited memory",
+"Parse 4 maps at a time as above, unless that is estimated to need more than "
+"8G, in which case the maps are parsed one at a time. -v reports which was "
+"used",
+"%prog -m otu_maps.txt -o unnested.ntree -O 4 --max_memory 8G -v"))
+script_info['script_usage'].append(("Unnest the workflow output",
+"Take the OTU maps straight from the output directory of "
+"nested_reference_workflow.py",
+"%prog -w nested_otus -o unnested.ntree"))
 script_info['output_description']= """
-A newick string representing the relationships between the OTU clusters
+A newick string representing the relationships between the OTU clusters. If
+the output filepath ends with .gz, the output is gzip-compressed.
 """
 
 script_info['required_options'] = [
+    options_lookup['output_fp']
+]
+script_info['optional_options'] = [
     make_option('-i','--input_otu_maps',
         help="The input OTU maps. This should be a comma seperated list of "
-        "each OTU maps as produced by uclust"),
-    options_lookup['output_fp']
+        "each OTU maps as produced by uclust, from high to low similarity. "
+        "The level of each map is taken from its file name (e.g. "
+        "gg_97_otu_map.txt) [default: %default]"),
+    make_option('-m','--manifest_fp',
+        help="A file listing the level and OTU map path of each level, "
+        "seperated by a tab. Relative paths are relative to the manifest "
+        "[default: %default]"),
+    make_option('-w','--workflow_output_dir',
+        help="The output directory of nested_reference_workflow.py. The OTU "
+        "maps are taken from its otus directory [default: %default]"),
+    make_option('-O','--jobs_to_start',type='int',default=1,
+        help="The number of OTU maps to parse concurrently "
+        "[default: %default]"),
+    make_option('-x','--index_dir',
+        help="If provided, also write an OTU membership index to this "
+        "directory for use with query_otu_membership.py [default: %default]"),
+    memory_option,
+    profile_option
 ]
-script_info['optional_options'] = []
 script_info['version'] = __version__
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    # expects maps to be in assembly order, ie:
-    # gg_99_otu_map.txt,gg_97_otu_map.txt,gg_94_otu_map.txt,...
-    otus_in_order = opts.input_otu_maps.split(',')
+    sources = [opts.input_otu_maps, opts.manifest_fp, opts.workflow_output_dir]
+    if len([source for source in sources if source]) != 1:
+        option_parser.error("Exactly one of --input_otu_maps, --manifest_fp "
+                            "and --workflow_output_dir must be provided")
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1")
+
+    def report(message):
+        if opts.verbose:
+            print message
+    try:
+        budget = MemoryBudget(opts.max_memory, report)
+    except ValueError, e:
+        option_parser.error(str(e))
+    # joining and writing report their progress every 10 seconds with -v
+    progress_callback = report if opts.verbose else None
+
+    if opts.input_otu_maps:
+        # expects maps to be in assembly order, ie:
+        # gg_99_otu_map.txt,gg_97_otu_map.txt,gg_94_otu_map.txt,...
+        levels = [(level_from_filename(otus), otus)
+                  for otus in opts.input_otu_maps.split(',')]
+    elif opts.manifest_fp:
+        levels = read_level_manifest(opts.manifest_fp)
+    else:
+        levels = find_workflow_otu_maps(opts.workflow_output_dir)
+
+    # the tree has to be in memory to be written, so the only choice is
+    # whether loaded maps can pile up waiting for it
+    num_processes = opts.jobs_to_start
+    map_fps = [fp for level, fp in levels]
+    if num_processes > 1 and not budget.fits('parse OTU maps concurrently',
+            estimate_unnest_memory(map_fps, num_processes),
+            'with one map parsed at a time'):
+        num_processes = 1
 
-    last_level = 100 
-    nodes = []
-    for otus in otus_in_order:
-        tmp1,level,tmp2,tmp3 = otus.split('_')
+    profiler = PhaseProfiler(opts.profile)
 
-        level = int(level)
-        length = float(last_level - level)
-        otu_map = parse_otu_map(open(otus))
-    
-        nodes.append(make_nodes(otu_map, length, level))
-    
-        last_level = level
+    # the maps are parsed as the tree is built, so they share a phase
+    with profiler.phase('parse and build'):
+        tree = build_nested_tree_from_files(levels, num_processes,
+                                            progress_callback)
+    with profiler.phase('write'):
+        progress = ProgressReporter('Writing the tree', progress_callback,
+                                    total_records=len(tree))
+        f = open_output(opts.output_fp)
+        write_newick(tree, f, progress=progress)
+        f.close()
+        progress.finish()
 
-    tree = join_nodes(nodes)
-    f = open(opts.output_fp,'w')
-    f.write(tree.getNewick(with_distances=True))
-    f.close()
+    if opts.index_dir:
+        with profiler.phase('index'):
+            write_membership_index(tree, opts.index_dir)
+    profiler.write(opts.output_fp + '.profile.txt')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+from os import mkdir
+from os.path import join
+from random import Random
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.assign import (_iter_assignments, assign_batch,
+        assign_seqs, find_workflow_rep_set, jaccard_matrix, representative,
+        ReferenceHierarchy)
+from nested_reference_otus.exact_index import (write_exact_index,
+        ExactMatchIndex)
+from nested_reference_otus.seq_store import write_seq_store
+from nested_reference_otus.sketch_index import (compute_sketches,
+        estimate_jaccard)
+from nested_reference_otus.unnest import parse_otu_map, build_nested_tree
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class AssignTests(TestCase):
+    def setUp(self):
+        self.rand = Random(7)
+        a = self._random_seq()
+        c = self._mutate(a, 50)
+        self.seqs = {'a': a, 'a1': self._mutate(a, 3),
+                     'b': self._mutate(a, 20), 'c': c,
+                     'd': self._mutate(c, 15), 'e': self._random_seq()}
+        self.fasta = ['>%s\n%s\n' % e for e in sorted(self.seqs.items())]
+        self.tree = build_nested_tree(
+                [(parse_otu_map(StringIO(clst_99)), 1.0, 99),
+                 (parse_otu_map(StringIO(clst_97)), 2.0, 97),
+                 (parse_otu_map(StringIO(clst_94)), 3.0, 94)])
+        self.hierarchy = ReferenceHierarchy(self.tree, self.fasta)
+
+    def _random_seq(self):
+        return ''.join([self.rand.choice('ACGT') for i in range(1000)])
+
+    def _mutate(self, seq, num_changes):
+        seq = list(seq)
+        for pos in self.rand.sample(range(len(seq)), num_changes):
+            seq[pos] = 'ACGT'[('ACGT'.index(seq[pos]) + 1) % 4]
+        return ''.join(seq)
+
+    def test_representative(self):
+        """the first tip below an OTU"""
+        obs = [representative(self.tree, node)
+               for node in self.tree.children(self.tree.root)]
+        self.assertEqual(obs, ['a', 'e'])
+
+    def test_reference_hierarchy(self):
+        """OTUs are ordered by parent within each level"""
+        h = self.hierarchy
+        self.assertEqual(h.levels, [94, 97, 99])
+        self.assertEqual(h.num_otus(), [2, 3, 5])
+        self.assertEqual([ids.tolist() for ids in h.otu_ids],
+                         [['0', '1'], ['0', '1', '2'],
+                          ['0', '1', '2', '3', '4']])
+        self.assertEqual([ids.tolist() for ids in h.rep_ids],
+                         [['a', 'e'], ['a', 'c', 'e'],
+                          ['a', 'b', 'c', 'd', 'e']])
+        self.assertEqual([offsets.tolist() for offsets in h.child_offsets],
+                         [[0, 2, 3], [0, 2, 4, 5]])
+        self.assertEqual(h.sketches[1][1].tolist(),
+                         compute_sketches([self.seqs['c']], 16,
+                                          256)[0].tolist())
+        self.assertRaises(KeyError, ReferenceHierarchy, self.tree,
+                          self.fasta[1:])
+
+        # the same from a sequence store
+        store_dir = mkdtemp(prefix='assign')
+        try:
+            write_seq_store(self.fasta, store_dir)
+            obs = ReferenceHierarchy(self.tree, store_dir)
+            for level_idx in range(3):
+                self.assertEqual(obs.sketches[level_idx].tolist(),
+                                 h.sketches[level_idx].tolist())
+        finally:
+            rmtree(store_dir)
+
+    def test_jaccard_matrix(self):
+        """the same as estimate_jaccard for each row"""
+        sketches = compute_sketches(sorted(self.seqs.values()), 8, 32)
+        obs = jaccard_matrix(sketches[:2], sketches, max_cells=100)
+        for i in range(2):
+            self.assertFloatEqual(obs[i], estimate_jaccard(sketches[i],
+                                                           sketches))
+        self.assertEqual(jaccard_matrix(sketches[:0], sketches).shape,
+                         (0, 6))
+
+    def test_assign_batch(self):
+        """queries descend to their best match"""
+        queries = [self._mutate(self.seqs['b'], 3),
+                   self._mutate(self.seqs['d'], 2),
+                   self._random_seq()]
+        assignments, num_comparisons = assign_batch(self.hierarchy, queries)
+        self.assertEqual([[(level_idx, row) for level_idx, row, identity
+                           in rows] for rows in assignments],
+                         [[(0, 0), (1, 0), (2, 1)], [(0, 0), (1, 1), (2, 3)],
+                          []])
+        # 2 OTUs at 94, 2 nested in a at 97, and 2 nested in a or c at 99
+        self.assertEqual(num_comparisons, [6, 6, 6])
+        for rows in assignments:
+            for level_idx, row, identity in rows:
+                self.assertTrue(0.99 < identity <= 1.0)
+
+    def test_assign_batch_nested_match(self):
+        """a match further down the path assigns the lower levels"""
+        # more than 6% from a, but about 4% from c, which is nested in a
+        query = self._mutate(self.seqs['c'], 40)
+        assignments, num_comparisons = assign_batch(self.hierarchy, [query])
+        self.assertEqual(len(assignments[0]), 1)
+        level_idx, row, identity = assignments[0][0]
+        self.assertEqual((level_idx, row), (0, 0))
+        self.assertTrue(0.94 <= identity < 0.97)
+
+    def test_assign_seqs(self):
+        """assignments go high -> low and are the same in a pool"""
+        fasta = ['>q1 some description\n', self._mutate(self.seqs['d'], 2),
+                 '\n>q2\n', self._random_seq(), '\n>q3\n', self.seqs['e'],
+                 '\n']
+        obs = list(assign_seqs(self.hierarchy, fasta, batch_size=2))
+        self.assertEqual([(seq_id, [e[:3] for e in assignments], num)
+                          for seq_id, assignments, num in obs],
+                         [('q1', [(99, '3', 'd'), (97, '1', 'c'),
+                                  (94, '0', 'a')], 6),
+                          ('q2', [], 6),
+                          ('q3', [(99, '4', 'e'), (97, '2', 'e'),
+                                  (94, '1', 'e')], 4)])
+        self.assertEqual(list(assign_seqs(self.hierarchy, fasta, 1, 2)), obs)
+
+    def test_iter_assignments_levels(self):
+        """assignments keep their own level, not their position"""
+        results = [(['q1', 'q2'], [-1, -1],
+                    ([[(1, 2, 0.98), (2, 4, 0.99)], [(2, 3, 0.995)]],
+                     [6, 4]))]
+        self.assertEqual(list(_iter_assignments(self.hierarchy, results,
+                                                None)),
+                         [('q1', [(99, '4', 'e', 0.99),
+                                  (97, '2', 'e', 0.98)], 6),
+                          ('q2', [(99, '3', 'd', 0.995)], 4)])
+
+    def test_assign_seqs_exact_index(self):
+        """exact matches are resolved without searching"""
+        index_dir = mkdtemp(prefix='assign')
+        try:
+            write_exact_index(self.tree, self.fasta, index_dir)
+            exact_index = ExactMatchIndex(index_dir)
+            fasta = ['>q1\n', self.seqs['b'].lower(), '\n>q2\n',
+                     self._mutate(self.seqs['d'], 2), '\n>q3\n',
+                     self.seqs['e'], '\n']
+            for num_processes in [1, 2]:
+                obs = list(assign_seqs(self.hierarchy, fasta, 2,
+                                       num_processes, exact_index))
+                self.assertEqual(obs[0], ('q1', [(99, '1', 'b', 1.0),
+                                                 (97, '0', 'a', 1.0),
+                                                 (94, '0', 'a', 1.0)], 0))
+                self.assertEqual([e[:3] for e in obs[1][1]],
+                                 [(99, '3', 'd'), (97, '1', 'c'),
+                                  (94, '0', 'a')])
+                self.assertEqual(obs[1][2], 6)
+                self.assertEqual(obs[2], ('q3', [(99, '4', 'e', 1.0),
+                                                 (97, '2', 'e', 1.0),
+                                                 (94, '1', 'e', 1.0)], 0))
+        finally:
+            rmtree(index_dir)
+
+    def test_find_workflow_rep_set(self):
+        """the rep set for a level"""
+        output_dir = mkdtemp(prefix='assign')
+        try:
+            mkdir(join(output_dir, 'rep_set'))
+            for fn in ['97_otus_run1.fasta', '99_otus_run1.fasta']:
+                open(join(output_dir, 'rep_set', fn), 'w').close()
+            self.assertEqual(find_workflow_rep_set(output_dir, 99),
+                             join(output_dir, 'rep_set', '99_otus_run1.fasta'))
+            self.assertRaises(ValueError, find_workflow_rep_set, output_dir,
+                              94)
+        finally:
+            rmtree(output_dir)
+
+clst_99 = """0	a	a1
+1	b
+2	c
+3	d
+4	e
+"""
+clst_97 = """0	a	b
+1	c	d
+2	e
+"""
+clst_94 = """0	a	c
+1	e
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from numpy import array, uint64
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.unnest import parse_otu_map, build_nested_tree
+from nested_reference_otus.exact_index import (build_exact_index,
+        build_hash_table, probe_hash_table, sequence_digests,
+        write_exact_index, ExactMatchIndex)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class ExactIndexTests(TestCase):
+    def setUp(self):
+        self.tree = build_nested_tree(
+                [(parse_otu_map(StringIO(clst_99)), 1.0, 99),
+                 (parse_otu_map(StringIO(clst_97)), 2.0, 97)])
+        self.index_dir = mkdtemp(prefix='exact_index')
+
+    def tearDown(self):
+        rmtree(self.index_dir)
+
+    def test_sequence_digests(self):
+        """case, gaps and U/T don't change the digest"""
+        obs = sequence_digests(['ACGT', 'a-cg.u', 'ACGA'])
+        self.assertEqual(obs.shape, (3, 2))
+        self.assertEqual(obs[0].tolist(), obs[1].tolist())
+        self.assertNotEqual(obs[0].tolist(), obs[2].tolist())
+        self.assertEqual(sequence_digests([]).shape, (0, 2))
+
+    def test_hash_table(self):
+        """colliding keys probe to the next free slot"""
+        keys = array([0, 8, 16, 1, 3], dtype=uint64)
+        slots = build_hash_table(keys)
+        self.assertEqual(len(slots), 16)
+        self.assertEqual(slots[:5].tolist(), [0, 3, 2, 4, -1])
+        self.assertEqual(slots[8], 1)
+        obs = probe_hash_table(slots, keys,
+                               array([16, 3, 24, 1, 5], dtype=uint64))
+        self.assertEqual(obs.tolist(), [2, 4, -1, 3, -1])
+        self.assertEqual(build_hash_table(keys[:0]).tolist(), [-1, -1])
+
+    def test_build_exact_index(self):
+        """duplicate and unclustered sequences aren't indexed"""
+        obs = build_exact_index(self.tree, StringIO(fasta))
+        self.assertEqual(obs['levels'].tolist(), [99, 97])
+        self.assertEqual(obs['ref_ids'].tolist(), ['1', '2', '3', '4'])
+        self.assertEqual(obs['otu_ids'].tolist(),
+                         [['0', '0'], ['0', '0'], ['1', '0'], ['2', '1']])
+        self.assertEqual(obs['rep_ids'].tolist(),
+                         [['1', '1'], ['1', '1'], ['3', '1'], ['4', '4']])
+        self.assertEqual(obs['digests'].shape, (4, 2))
+        self.assertEqual(sorted(obs['slots'][obs['slots'] != -1].tolist()),
+                         [0, 1, 2, 3])
+
+    def test_build_exact_index_batches(self):
+        """digesting in batches gives the same index"""
+        exp = build_exact_index(self.tree, StringIO(fasta))
+        for batch_size in 1, 5, 1000:
+            obs = build_exact_index(self.tree, StringIO(fasta), batch_size)
+            for name in exp:
+                self.assertEqual(obs[name].tolist(), exp[name].tolist())
+
+    def test_lookup(self):
+        """identical sequences resolve to every level's OTU"""
+        write_exact_index(self.tree, StringIO(fasta), self.index_dir)
+        index = ExactMatchIndex(self.index_dir)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup('aggtac'),
+                         ('3', [(99, '1', '3'), (97, '0', '1')]))
+        self.assertEqual(index.lookup('AGGT'),
+                         ('1', [(99, '0', '1'), (97, '0', '1')]))
+        self.assertEqual(index.lookup('AGGTA'), None)
+        self.assertEqual(index.lookup_rows(['TTTT', 'AG', 'TTTA']).tolist(),
+                         [3, -1, -1])
+
+clst_99 = """0	1	2	5
+1	3
+2	4
+"""
+clst_97 = """0	1	3
+1	4
+"""
+fasta = """>1 first
+AGGT
+>2
+AGGA
+>3
+AGGTAC
+>4
+TTTT
+>5
+AGGT
+>6
+CCCC
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from StringIO import StringIO
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.unnest import parse_otu_map
+from nested_reference_otus.expand_otu_maps import (expand_nested_otu_maps,
+        format_otu_map)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+def _parse(*maps):
+    return [parse_otu_map(StringIO(m)) for m in maps]
+
+class ExpandOTUMapsTests(TestCase):
+    def test_expand_nested_otu_maps(self):
+        """every level lists the original sequences"""
+        obs = list(expand_nested_otu_maps(_parse(clst_99, clst_97, clst_94)))
+        self.assertEqual(obs[0], [('0', ['10', '20', '30']),
+                                  ('1', ['1', '6']),
+                                  ('2', ['3']),
+                                  ('3', ['8', '7'])])
+        self.assertEqual(obs[1], [('0', ['3', '8', '7']),
+                                  ('1', ['1', '6']),
+                                  ('2', ['10', '20', '30'])])
+        self.assertEqual(obs[2], [('0', ['3', '8', '7']),
+                                  ('1', ['1', '6', '10', '20', '30'])])
+
+    def test_expand_nested_otu_maps_single(self):
+        """a single level is unchanged"""
+        obs = list(expand_nested_otu_maps(_parse(clst_99)))
+        self.assertEqual(obs, [[('0', ['10', '20', '30']), ('1', ['1', '6']),
+                                ('2', ['3']), ('3', ['8', '7'])]])
+
+    def test_expand_nested_otu_maps_inconsistent(self):
+        """maps that aren't nested raise"""
+        obs = expand_nested_otu_maps(_parse(clst_99, "0\t3\t8\t42\n"))
+        self.assertRaises(ValueError, list, obs)
+
+        obs = expand_nested_otu_maps(_parse(clst_99, "0\t3\t8\n1\t1\n"))
+        self.assertRaises(ValueError, list, obs)
+
+    def test_format_otu_map(self):
+        """OTU map lines"""
+        obs = list(format_otu_map([('0', ['3', '8', '7']), ('1', ['1'])]))
+        self.assertEqual(obs, ['0\t3\t8\t7\n', '1\t1\n'])
+
+clst_99 = """0	10	20	30
+1	1	6
+2	3
+3	8	7
+"""
+clst_97 = """0	3	8
+1	1
+2	10
+"""
+clst_94 = """0	3
+1	1	10
+"""
+
+
+if __name__ == '__main__':
+    main()
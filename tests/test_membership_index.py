@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.unnest import parse_otu_map, build_nested_tree
+from nested_reference_otus.membership_index import (build_membership_index,
+        write_membership_index, OTUMembershipIndex)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class MembershipIndexTests(TestCase):
+    def setUp(self):
+        self.tree = build_nested_tree(
+                [(parse_otu_map(StringIO(clst_99)), 1.0, 99),
+                 (parse_otu_map(StringIO(clst_97)), 2.0, 97),
+                 (parse_otu_map(StringIO(clst_94)), 3.0, 94)])
+        self.index_dir = mkdtemp(prefix='membership_index')
+
+    def tearDown(self):
+        rmtree(self.index_dir)
+
+    def test_build_membership_index(self):
+        """tips are numbered in preorder and OTUs are sorted by level, id"""
+        obs = build_membership_index(self.tree)
+        self.assertEqual(obs['levels'].tolist(), [99, 97, 94])
+        self.assertEqual(obs['tip_names'].tolist(),
+                         ['3', '8', '7', '1', '6', '10', '20', '30'])
+        self.assertEqual(obs['sorted_tip_names'].tolist(),
+                         ['1', '10', '20', '3', '30', '6', '7', '8'])
+        self.assertEqual(obs['sorted_tip_ranks'].tolist(),
+                         [3, 5, 6, 0, 7, 4, 2, 1])
+        self.assertEqual(obs['otu_level'].tolist(),
+                         [0, 0, 0, 0, 1, 1, 1, 2, 2])
+        self.assertEqual(obs['otu_ids'].tolist(),
+                         ['0', '1', '2', '3', '0', '1', '2', '0', '1'])
+        self.assertEqual(obs['otu_start'].tolist(),
+                         [5, 3, 0, 1, 0, 3, 5, 0, 3])
+        self.assertEqual(obs['otu_end'].tolist(),
+                         [8, 5, 1, 3, 3, 5, 8, 3, 8])
+        self.assertEqual(obs['otu_by_start'].tolist(),
+                         [2, 3, 1, 0, 4, 5, 6, 7, 8])
+        self.assertEqual(obs['sorted_otu_starts'].tolist(),
+                         [0, 1, 3, 5, 0, 3, 5, 0, 3])
+
+    def test_tips(self):
+        """all tips of an OTU"""
+        write_membership_index(self.tree, self.index_dir)
+        index = OTUMembershipIndex(self.index_dir)
+        self.assertEqual(index.tips(99, '3').tolist(), ['8', '7'])
+        self.assertEqual(index.tips(97, '0').tolist(), ['3', '8', '7'])
+        self.assertEqual(index.tips(94, '1').tolist(),
+                         ['1', '6', '10', '20', '30'])
+        self.assertRaises(KeyError, index.tips, 94, '2')
+        self.assertRaises(KeyError, index.tips, 90, '0')
+
+    def test_ancestors(self):
+        """the OTUs containing a tip at every level"""
+        write_membership_index(self.tree, self.index_dir)
+        index = OTUMembershipIndex(self.index_dir)
+        self.assertEqual(index.ancestors('7'),
+                         [(99, '3', '8'), (97, '0', '3'), (94, '0', '3')])
+        self.assertEqual(index.ancestors('20'),
+                         [(99, '0', '10'), (97, '2', '10'), (94, '1', '1')])
+        self.assertRaises(KeyError, index.ancestors, '42')
+
+clst_99 = """0	10	20	30
+1	1	6
+2	3
+3	8	7
+"""
+clst_97 = """0	3	8
+1	1
+2	10
+"""
+clst_94 = """0	3
+1	1	10
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the memory.py module."""
+
+from os import close, remove
+from tempfile import mkdtemp, mkstemp
+from shutil import rmtree
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.memory import MemoryBudget, format_size, input_size
+
+class MemoryTests(TestCase):
+    """Tests for the memory.py module."""
+
+    def test_input_size(self):
+        """Test that only files have a size."""
+        fd, fp = mkstemp(prefix='nested_reference_otus_memory')
+        close(fd)
+        temp_dir = mkdtemp(prefix='nested_reference_otus_memory')
+        try:
+            open(fp, 'w').write('>a\nACGT\n')
+            self.assertEqual(input_size(fp), 8)
+            self.assertEqual(input_size(temp_dir), 0)
+            self.assertEqual(input_size(['>a\n', 'ACGT\n']), 0)
+            self.assertEqual(input_size(None), 0)
+        finally:
+            remove(fp)
+            rmtree(temp_dir)
+
+    def test_format_size(self):
+        """Test formatting sizes in the largest whole unit."""
+        self.assertEqual(format_size(0), '0B')
+        self.assertEqual(format_size(1023), '1023B')
+        self.assertEqual(format_size(1536), '1.5K')
+        self.assertEqual(format_size(20 * 1024 ** 3), '20.0G')
+        self.assertEqual(format_size(3 * 1024 ** 4), '3.0T')
+
+    def test_fits(self):
+        """Test choosing and reporting in-memory and fallback algorithms."""
+        messages = []
+        budget = MemoryBudget('1K', messages.append)
+        self.assertEqual(budget.max_memory, 1024)
+        self.assertTrue(budget.fits('sort', 1024))
+        self.assertFalse(budget.fits('load', 2048, 'with a database'))
+        self.assertEqual(budget.choices, [('sort', 1024, True),
+                                          ('load', 2048, False)])
+        self.assertEqual(messages,
+                ['sort: estimated 1.0K in memory with a 1.0K limit, so '
+                 'running in memory.',
+                 'load: estimated 2.0K in memory with a 1.0K limit, so '
+                 'running with a database.'])
+
+    def test_fits_unlimited(self):
+        """Test that everything fits without a limit."""
+        budget = MemoryBudget()
+        self.assertEqual(budget.max_memory, None)
+        self.assertTrue(budget.fits('sort', 1024 ** 5))
+        self.assertEqual(MemoryBudget(512).max_memory, 512)
+        self.assertRaises(ValueError, MemoryBudget, 'lots')
+
+
+if __name__ == "__main__":
+    main()
@@ -14,16 +14,27 @@ __status__ = "Development"
 import signal
 from shutil import rmtree
 from os.path import exists, join
-from os import makedirs, getcwd, chdir
+from os import makedirs, getcwd, chdir, listdir
 from cogent.util.unit_test import TestCase, main
 from cogent.util.misc import remove_files
 from cogent.parse.fasta import MinimalFastaParser
 from cogent import LoadTree
+from qiime.filter import filter_tree
 from qiime.util import get_tmp_filename
 from qiime.util import load_qiime_config
 from qiime.workflow.util import no_status_updates, call_commands_serially
 from nested_reference_otus.nested_reference_workflow import (get_second_field,
         rename_rep_seqs, pick_nested_reference_otus)
+from nested_reference_otus.unnest import (build_nested_tree_from_files,
+        find_workflow_otu_maps, parse_otu_map, write_newick)
+from nested_reference_otus.membership_index import (OTUMembershipIndex,
+        write_membership_index)
+from nested_reference_otus.exact_index import ExactMatchIndex
+from nested_reference_otus.otu_collection import NestedOTUCollection
+from nested_reference_otus.profiling import PhaseProfiler
+from nested_reference_otus.stage_cache import StageCache
+from nested_reference_otus.tree_cache import write_tree_cache
+from StringIO import StringIO
 
 ## The test case timing code included in this file is adapted from
 ## recipes provided at:
@@ -123,6 +134,232 @@ class NestedReferenceWorkflowTests(TestCase):
             
             self.assertEqual(set(seq_ids) - set(input_ids), set())
             
+    def test_pick_nested_reference_otus_tree_cache(self):
+        """pick_nested_reference_otus filters a tree cache like newick"""
+        thresholds = [90,80,70]
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   self.intree1_fp,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates)
+        tree_cache_dir = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='nested_reference_tree',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(tree_cache_dir)
+        write_tree_cache(open(self.intree1_fp,'U'), tree_cache_dir)
+        wf_out2 = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='qiime_wf_out',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(wf_out2)
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   tree_cache_dir,
+                                   output_dir=wf_out2,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates)
+        # each threshold's tree is the one filter_tree.py used to write
+        current_tree_fp = self.intree1_fp
+        for t in thresholds:
+            tree_fp = join('trees','%d_otus_test-blah.tre' % t)
+            self.assertEqual(open(join(wf_out2,tree_fp)).read(),
+                             open(join(self.wf_out,tree_fp)).read())
+            seqs_fp = join(self.wf_out,'rep_set','%d_otus_test-blah.fasta' % t)
+            seq_ids = [e.split()[0] for e,_ in
+                       MinimalFastaParser(open(seqs_fp))]
+            exp = filter_tree(LoadTree(current_tree_fp), seq_ids)
+            self.assertEqual(open(join(self.wf_out,tree_fp)).read(),
+                             exp.getNewick(with_distances=True))
+            current_tree_fp = join(self.wf_out,tree_fp)
+    
+    def test_pick_nested_reference_otus_unnested_tree(self):
+        """pick_nested_reference_otus builds the unnested tree as it goes"""
+        thresholds = [90,80,70]
+        messages = []
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   None,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=messages.append,
+                                   build_unnested_tree=True)
+        # joining and writing report their progress
+        self.assertTrue([m for m in messages
+                         if m.startswith('Joining the 70 OTUs: ')])
+        self.assertTrue([m for m in messages
+                         if m.startswith('Writing the unnested tree: ')])
+        
+        # same as running unnest.py on the workflow output
+        exp = StringIO()
+        write_newick(build_nested_tree_from_files(
+            find_workflow_otu_maps(self.wf_out)), exp)
+        self.assertEqual(open(join(self.wf_out,'unnested.ntree')).read(),
+                         exp.getvalue())
+        
+        index = OTUMembershipIndex(join(self.wf_out,'unnested_index'))
+        self.assertEqual(index.levels.tolist(), thresholds)
+        input_ids = [e for e,_ in MinimalFastaParser(open(self.inseqs1_fp))]
+        self.assertEqual(sorted(index.tip_names.tolist()), sorted(input_ids))
+    
+    def test_pick_nested_reference_otus_exact_index(self):
+        """pick_nested_reference_otus writes an exact match index"""
+        thresholds = [90,80,70]
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   None,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   build_exact_index=True)
+        self.assertFalse(exists(join(self.wf_out,'unnested.ntree')))
+        index = ExactMatchIndex(join(self.wf_out,'exact_index'))
+        self.assertEqual(index.levels.tolist(), thresholds)
+        
+        # every input sequence resolves to the OTUs unnest.py would give it
+        membership_dir = join(self.wf_out,'unnested_index')
+        write_membership_index(build_nested_tree_from_files(
+            find_workflow_otu_maps(self.wf_out)), membership_dir)
+        membership = OTUMembershipIndex(membership_dir)
+        for seq_id, seq in MinimalFastaParser(open(self.inseqs1_fp)):
+            ref_id, assignments = index.lookup(seq.lower())
+            self.assertEqual(assignments, membership.ancestors(ref_id))
+        self.assertEqual(index.lookup('ACGT'), None)
+    
+    def test_pick_nested_reference_otus_max_memory(self):
+        """a small memory budget builds the same index, and is logged"""
+        thresholds = [90,80,70]
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   None,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   build_exact_index=True,
+                                   max_memory='1K')
+        index = ExactMatchIndex(join(self.wf_out,'exact_index'))
+        for seq_id, seq in MinimalFastaParser(open(self.inseqs1_fp)):
+            self.assertNotEqual(index.lookup(seq), None)
+        log_fps = [fn for fn in listdir(self.wf_out) if fn.startswith('log_')]
+        log = open(join(self.wf_out,log_fps[0])).read()
+        self.assertTrue('build exact index: estimated' in log)
+        self.assertTrue('with a 1.0K limit, so running with the sequences '
+                        'digested in batches' in log)
+    
+    def test_pick_nested_reference_otus_otu_collection(self):
+        """pick_nested_reference_otus writes a nested OTU collection"""
+        thresholds = [90,80,70]
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   None,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=thresholds,
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   write_otu_collection=True)
+        collection = NestedOTUCollection(join(self.wf_out,'nested_otus.npz'))
+        self.assertEqual(collection.levels.tolist(), thresholds)
+        self.assertEqual(collection.run_id, 'test-blah')
+        for t in thresholds:
+            otu_map_fp = join(self.wf_out,'otus','%d_otu_map.txt' % t)
+            self.assertEqual(list(collection.otu_map(t)),
+                             parse_otu_map(open(otu_map_fp,'U')))
+            seqs_fp = join(self.wf_out,'rep_set','%d_otus_test-blah.fasta' % t)
+            self.assertEqual(list(collection.rep_set(t)),
+                             list(MinimalFastaParser(open(seqs_fp))))
+    
+    def test_pick_nested_reference_otus_stage_cache(self):
+        """pick_nested_reference_otus reuses the outputs of an earlier run"""
+        cache_dir = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='nested_reference_cache',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(cache_dir)
+        wf_out2 = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='qiime_wf_out',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(wf_out2)
+        
+        profiler = PhaseProfiler()
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   self.intree1_fp,
+                                   output_dir=self.wf_out,
+                                   run_id="test-blah",
+                                   similarity_thresholds=[90,80],
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   stage_cache=StageCache(cache_dir),
+                                   profiler=profiler)
+        self.assertEqual(profiler.counts, {'stage cache misses': 4})
+        
+        # adding a lower threshold only picks OTUs for the new threshold
+        profiler = PhaseProfiler()
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   self.intree1_fp,
+                                   output_dir=wf_out2,
+                                   run_id="test-blah",
+                                   similarity_thresholds=[90,80,70],
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   stage_cache=StageCache(cache_dir),
+                                   profiler=profiler)
+        self.assertEqual(profiler.counts, {'stage cache hits': 4,
+                                           'stage cache misses': 2})
+        for t in [90,80]:
+            for fp in ['otus/%d_otu_map.txt' % t,
+                       'rep_set/%d_otus_test-blah.fasta' % t,
+                       'trees/%d_otus_test-blah.tre' % t]:
+                self.assertEqual(open(join(wf_out2,fp)).read(),
+                                 open(join(self.wf_out,fp)).read())
+        self.assertTrue(exists(join(wf_out2,'otus','70_otu_map.txt')))
+    
+    def test_pick_nested_reference_otus_stage_cache_rerun(self):
+        """rerunning into an output dir doesn't change earlier cache entries"""
+        cache_dir = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='nested_reference_cache',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(cache_dir)
+        wf_out2 = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='qiime_wf_out',suffix='',result_constructor=str)
+        self.dirs_to_remove.append(wf_out2)
+        inseqs2_fp = get_tmp_filename(tmp_dir=self.tmp_dir,
+         prefix='nested_reference_wf',suffix='.fna')
+        inseqs2_f = open(inseqs2_fp,'w')
+        seqs = list(MinimalFastaParser(inseqs1.split('\n')))[:5]
+        inseqs2_f.write(''.join(['>%s\n%s\n' % e for e in seqs]))
+        inseqs2_f.close()
+        self.files_to_remove.append(inseqs2_fp)
+        outputs = ['otus/90_otu_map.txt',
+                   'rep_set/90_otus_test-blah.fasta',
+                   'trees/90_otus_test-blah.tre']
+        
+        # two runs with different inputs into the same output dir
+        for inseqs_fp in [self.inseqs1_fp, inseqs2_fp]:
+            pick_nested_reference_otus(inseqs_fp,
+                                       self.intree1_fp,
+                                       output_dir=self.wf_out,
+                                       run_id="test-blah",
+                                       similarity_thresholds=[90],
+                                       command_handler=call_commands_serially,
+                                       status_update_callback=no_status_updates,
+                                       stage_cache=StageCache(cache_dir))
+            if inseqs_fp == self.inseqs1_fp:
+                expected = [open(join(self.wf_out,fp)).read()
+                            for fp in outputs]
+        
+        # the first run's entries still hold the first run's outputs
+        profiler = PhaseProfiler()
+        pick_nested_reference_otus(self.inseqs1_fp,
+                                   self.intree1_fp,
+                                   output_dir=wf_out2,
+                                   run_id="test-blah",
+                                   similarity_thresholds=[90],
+                                   command_handler=call_commands_serially,
+                                   status_update_callback=no_status_updates,
+                                   stage_cache=StageCache(cache_dir),
+                                   profiler=profiler)
+        self.assertEqual(profiler.counts, {'stage cache hits': 2})
+        self.assertEqual([open(join(wf_out2,fp)).read() for fp in outputs],
+                         expected)
+        
         
         
 
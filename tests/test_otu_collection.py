@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.unnest import (build_nested_tree, parse_otu_map,
+        write_newick)
+from nested_reference_otus.otu_collection import (build_collection,
+        export_legacy_files, find_workflow_levels, write_collection,
+        NestedOTUCollection)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class OTUCollectionTests(TestCase):
+    def setUp(self):
+        self.output_dir = mkdtemp(prefix='otu_collection')
+        self.workflow_dir = join(self.output_dir, 'workflow')
+        makedirs(join(self.workflow_dir, 'otus'))
+        makedirs(join(self.workflow_dir, 'rep_set'))
+        for level, otu_map, rep_set in ((99, clst_99, rep_set_99),
+                                        (97, clst_97, rep_set_97),
+                                        (94, clst_94, rep_set_94)):
+            open(join(self.workflow_dir, 'otus', '%d_otu_map.txt' % level),
+                 'w').write(otu_map)
+            open(join(self.workflow_dir, 'rep_set', '%d_otus_r1.fasta' %
+                      level), 'w').write(rep_set)
+        self.levels = find_workflow_levels(self.workflow_dir)
+        self.collection_fp = join(self.output_dir, 'nested_otus.npz')
+
+    def tearDown(self):
+        rmtree(self.output_dir)
+
+    def test_find_workflow_levels(self):
+        """the OTU map and rep set of each level, high -> low"""
+        self.assertEqual([(level, fp.split('/')[-1], rep_fp.split('/')[-1])
+                          for level, fp, rep_fp in self.levels],
+                         [(99, '99_otu_map.txt', '99_otus_r1.fasta'),
+                          (97, '97_otu_map.txt', '97_otus_r1.fasta'),
+                          (94, '94_otu_map.txt', '94_otus_r1.fasta')])
+
+    def test_build_collection(self):
+        """each level refers to the OTUs of the level above"""
+        obs = build_collection(self.levels)
+        self.assertEqual(obs['levels'].tolist(), [99, 97, 94])
+        self.assertEqual(str(obs['run_id']), 'r1')
+        self.assertEqual(obs['store_seq_ids'].tolist(), ['4', '1', '3'])
+        self.assertEqual(obs['tip_ids'].tolist(), ['1', '2', '5', '3', '4'])
+        self.assertEqual(obs['tip_parent'].tolist(), [0, 0, 0, 1, 2])
+        self.assertEqual(obs['otu_ids'].tolist(),
+                         ['0', '1', '2', '0', '1', '0'])
+        self.assertEqual(obs['otu_reps'].tolist(), [1, 2, 0, 1, 0, 0])
+        self.assertEqual(obs['otu_parent'].tolist(), [0, 0, 1, 0, 0, -1])
+        self.assertEqual(obs['otu_offsets'].tolist(), [0, 3, 5, 6])
+        self.assertEqual(obs['members'].tolist(),
+                         [0, 1, 2, 3, 4, 0, 1, 2, 1, 0])
+        self.assertEqual(obs['member_offsets'].tolist(),
+                         [0, 3, 4, 5, 7, 8, 10])
+        self.assertEqual(obs['centroid_rows'].tolist(), [0, 1, 2, 1, 0, 0])
+        self.assertEqual(obs['centroid_offsets'].tolist(), [0, 3, 5, 6])
+
+        self.assertEqual(str(build_collection(self.levels, 'r2')['run_id']),
+                         'r2')
+
+    def test_build_collection_not_nested(self):
+        """a member that isn't a representative of the level above fails"""
+        open(self.levels[1][1], 'w').write('0\t1\t2\n1\t4\n')
+        self.assertRaises(ValueError, build_collection, self.levels)
+
+    def test_reader(self):
+        """the collection gives back each level's OTU map and rep set"""
+        write_collection(self.levels, self.collection_fp)
+        collection = NestedOTUCollection(self.collection_fp)
+        self.assertEqual(collection.levels.tolist(), [99, 97, 94])
+        self.assertEqual(collection.run_id, 'r1')
+        self.assertEqual([collection.num_otus(l) for l in 99, 97, 94],
+                         [3, 2, 1])
+        for level, otu_map, rep_set in ((99, clst_99, rep_set_99),
+                                        (97, clst_97, rep_set_97),
+                                        (94, clst_94, rep_set_94)):
+            self.assertEqual(list(collection.otu_map(level)),
+                             parse_otu_map(StringIO(otu_map)))
+            self.assertEqual(''.join(['>%s\n%s\n' % e for e in
+                                      collection.rep_set(level)]), rep_set)
+        self.assertEqual(collection.centroid_ids(97), ['1', '4'])
+        self.assertEqual(collection.sequence('3'), 'AGGTAC')
+        self.assertRaises(KeyError, collection.sequence, '2')
+        self.assertRaises(KeyError, list, collection.otu_map(50))
+
+    def test_parent(self):
+        """parents are at the next lower level"""
+        write_collection(self.levels, self.collection_fp)
+        collection = NestedOTUCollection(self.collection_fp)
+        self.assertEqual(collection.parent(99, '2'), (97, '1'))
+        self.assertEqual(collection.parent(99, '1'), (97, '0'))
+        self.assertEqual(collection.parent(97, '1'), (94, '0'))
+        self.assertEqual(collection.parent(94, '0'), None)
+        self.assertEqual(collection.representative(97, '1'), '4')
+        self.assertRaises(KeyError, collection.parent, 99, '7')
+
+    def test_nested_tree(self):
+        """the tree is the same as unnesting the OTU maps"""
+        write_collection(self.levels, self.collection_fp)
+        obs = NestedOTUCollection(self.collection_fp).nested_tree()
+        exp = build_nested_tree([(parse_otu_map(StringIO(clst_99)), 1.0, 99),
+                                 (parse_otu_map(StringIO(clst_97)), 2.0, 97),
+                                 (parse_otu_map(StringIO(clst_94)), 3.0, 94)])
+        obs_f = StringIO()
+        write_newick(obs, obs_f)
+        exp_f = StringIO()
+        write_newick(exp, exp_f)
+        self.assertEqual(obs_f.getvalue(), exp_f.getvalue())
+
+    def test_export_legacy_files(self):
+        """exporting writes the files the collection was built from"""
+        write_collection(self.levels, self.collection_fp)
+        collection = NestedOTUCollection(self.collection_fp)
+        export_dir = join(self.output_dir, 'export')
+        export_legacy_files(collection, export_dir)
+        for level, otu_map_fp, rep_set_fp in self.levels:
+            self.assertEqual(open(join(export_dir, 'otus', '%d_otu_map.txt' %
+                                       level)).read(),
+                             open(otu_map_fp).read())
+            self.assertEqual(open(join(export_dir, 'rep_set',
+                                       '%d_otus_r1.fasta' % level)).read(),
+                             open(rep_set_fp).read())
+        export_legacy_files(collection, export_dir, 'r2')
+        self.assertEqual(open(join(export_dir, 'rep_set',
+                                   '94_otus_r2.fasta')).read(), rep_set_94)
+
+clst_99 = """0	1	2	5
+1	3
+2	4
+"""
+
+clst_97 = """0	1	3
+1	4
+"""
+
+clst_94 = """0	4	1
+"""
+
+rep_set_99 = """>4
+TTTT
+>1
+AGGT
+>3
+AGGTAC
+"""
+
+rep_set_97 = """>1
+AGGT
+>4
+TTTT
+"""
+
+rep_set_94 = """>4
+TTTT
+"""
+
+if __name__ == '__main__':
+    main()
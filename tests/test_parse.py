@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the parse.py module."""
+
+from os import close, remove
+from StringIO import StringIO
+from tempfile import mkstemp
+from cogent.parse.fasta import MinimalFastaParser
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.parse import (fields_to_dict, iter_fields,
+                                         iter_lines, iter_taxonomy_map,
+                                         parse_fasta, rereadable_lines)
+from nested_reference_otus.progress import ProgressReporter
+
+class ParseTests(TestCase):
+    """Tests for the parse.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.fasta = ">1 first seq\nAGGT\nCC\n>2\nAGGA\n>3\nAGGC\nA\n"
+        self.messy_fasta = ("# a comment\n\n  >1 first seq  \r\nAG GT \r\n"
+                            "\n#ACGT\n  CC\n>2\n\tAGGA\n >3\nAGGC\n")
+        self.tax_map = ["ID Number\tGenBank Number\tNew Taxon String\t"
+                        "Source\n",
+                        "1\tX67\tA;B; ;C\tsrc\n",
+                        "2\tX68\tA;B;D\tsrc\n",
+                        "3\tX69\tA\tsrc\n"]
+        fd, self.tmp_fp = mkstemp(prefix='nested_reference_otus_parse')
+        close(fd)
+
+    def tearDown(self):
+        """Remove the temporary file."""
+        remove(self.tmp_fp)
+
+    def _write_tmp(self, lines):
+        f = open(self.tmp_fp, 'w')
+        f.writelines(lines)
+        f.close()
+        return self.tmp_fp
+
+    def test_parse_fasta_file(self):
+        """Test parsing FASTA from a file in chunks of various sizes."""
+        exp = [('1 first seq', 'AGGTCC'), ('2', 'AGGA'), ('3', 'AGGCA')]
+        for buffer_size in [1, 2, 5, 1048576]:
+            obs = list(parse_fasta(StringIO(self.fasta), buffer_size))
+            self.assertEqual(obs, exp)
+
+    def test_parse_fasta_filepath(self):
+        """Test parsing FASTA from a filepath."""
+        fp = self._write_tmp([self.fasta])
+        self.assertEqual(list(parse_fasta(fp, 3)),
+                         [('1 first seq', 'AGGTCC'), ('2', 'AGGA'),
+                          ('3', 'AGGCA')])
+
+    def test_parse_fasta_lines(self):
+        """Test parsing FASTA from lines, with or without newlines."""
+        exp = [('1 first seq', 'AGGTCC'), ('2', 'AGGA'), ('3', 'AGGCA')]
+        self.assertEqual(list(parse_fasta(self.fasta.splitlines(True))), exp)
+        self.assertEqual(list(parse_fasta(self.fasta.splitlines())), exp)
+
+    def test_parse_fasta_matches_minimal_fasta_parser(self):
+        """Test that comments, blank lines and whitespace match cogent."""
+        exp = list(MinimalFastaParser(self.messy_fasta.splitlines()))
+        self.assertEqual(exp, [('1 first seq', 'AG GTCC'), ('2', 'AGGA'),
+                               ('3', 'AGGC')])
+        for buffer_size in [1, 3, 1048576]:
+            obs = list(parse_fasta(StringIO(self.messy_fasta), buffer_size))
+            self.assertEqual(obs, exp)
+        self.assertEqual(list(parse_fasta(self.messy_fasta.splitlines())),
+                         exp)
+
+    def test_parse_fasta_empty(self):
+        """Test parsing empty input."""
+        self.assertEqual(list(parse_fasta(StringIO(''))), [])
+        self.assertEqual(list(parse_fasta([])), [])
+        self.assertEqual(list(parse_fasta(['# only a comment', ''])), [])
+
+    def test_parse_fasta_invalid(self):
+        """Test that labels without sequences and unlabeled data raise."""
+        self.assertRaises(ValueError, list, parse_fasta(['>1', '>2', 'A']))
+        self.assertRaises(ValueError, list, parse_fasta(['>1', 'A', '>2']))
+        self.assertRaises(ValueError, list, parse_fasta(['A', '>1', 'A']))
+
+    def test_parse_fasta_progress(self):
+        """Test counting the records parsed and bytes read."""
+        for buffer_size in [1, 5, 1048576]:
+            progress = ProgressReporter('Parsing')
+            self.assertEqual(len(list(parse_fasta(StringIO(self.fasta),
+                                                  buffer_size, progress))), 3)
+            self.assertEqual(progress.records, 3)
+            self.assertEqual(progress.bytes, len(self.fasta))
+
+    def test_iter_fields(self):
+        """Test parsing lines the same way as qiime's fields_to_dict."""
+        lines = ["0\t10 \t20\n", "\t30\n", "1\t1\n", " 2 \n"]
+        self.assertEqual(list(iter_fields(lines)),
+                         [('0', ['10', '20']), ('1', ['1']), ('2', [])])
+
+    def test_fields_to_dict(self):
+        """Test that the last line for a repeated key wins."""
+        lines = ["0\t10\t20\n", "1\t1\n", "0\t30\n"]
+        self.assertEqual(fields_to_dict(lines), {'0': ['30'], '1': ['1']})
+
+    def test_iter_taxonomy_map(self):
+        """Test parsing a taxonomy map, skipping empty levels."""
+        self.assertEqual(list(iter_taxonomy_map(self.tax_map)),
+                         [('1', 'A;B; ;C', ['A', 'B', 'C']),
+                          ('2', 'A;B;D', ['A', 'B', 'D']),
+                          ('3', 'A', ['A'])])
+        self.assertEqual(list(iter_taxonomy_map(self.tax_map, set(['2']))),
+                         [('2', 'A;B;D', ['A', 'B', 'D'])])
+
+    def test_iter_taxonomy_map_progress(self):
+        """Test counting every line read, including skipped rows."""
+        progress = ProgressReporter('Parsing')
+        self.assertEqual(len(list(iter_taxonomy_map(self.tax_map, set(['2']),
+                                                    progress))), 1)
+        self.assertEqual(progress.records, 4)
+        self.assertEqual(progress.bytes, len(''.join(self.tax_map)))
+
+    def test_iter_taxonomy_map_lazy(self):
+        """Test that only the header is read before it is validated."""
+        def lines():
+            yield "1\tX67\tA;B; ;C\tsrc\n"
+            raise AssertionError("Read past an invalid header.")
+        self.assertRaises(ValueError, list, iter_taxonomy_map(lines()))
+
+        fp = self._write_tmp(self.tax_map)
+        self.assertEqual([e[0] for e in iter_taxonomy_map(fp)],
+                         ['1', '2', '3'])
+
+    def test_iter_lines(self):
+        """Test iterating over filepaths, open files and lists of lines."""
+        fp = self._write_tmp(["a\r\n", "b\n"])
+        self.assertEqual(list(iter_lines(fp)), ["a\n", "b\n"])
+        self.assertEqual(list(iter_lines(open(fp, 'U'))), ["a\n", "b\n"])
+        self.assertEqual(list(iter_lines(["a", "b"])), ["a", "b"])
+
+    def test_rereadable_lines(self):
+        """Test that inputs which can only be read once are read into lists."""
+        fp = self._write_tmp(["a\n", "b\n"])
+        self.assertTrue(rereadable_lines(fp) is fp)
+        lines = ["a\n"]
+        self.assertTrue(rereadable_lines(lines) is lines)
+        self.assertEqual(rereadable_lines(open(fp, 'U')), ["a\n", "b\n"])
+        self.assertEqual(rereadable_lines(iter(lines)), lines)
+
+    def test_iter_taxonomy_map_invalid(self):
+        """Test that invalid taxonomy maps raise."""
+        self.assertRaises(ValueError, list,
+                          iter_taxonomy_map(self.tax_map[1:]))
+        self.assertRaises(ValueError, list, iter_taxonomy_map([]))
+        self.assertRaises(ValueError, list,
+                          iter_taxonomy_map(self.tax_map + ["4\tA;B\n"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the profiling.py module."""
+
+from os import listdir
+from os.path import join
+from pstats import Stats
+from shutil import rmtree
+from tempfile import mkdtemp
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.profiling import PhaseProfiler
+
+class PhaseProfilerTests(TestCase):
+    """Tests for the PhaseProfiler class."""
+
+    def setUp(self):
+        """Create a temporary output directory."""
+        self.output_dir = mkdtemp(prefix='nested_reference_otus_profiling')
+        self.report_fp = join(self.output_dir, 'out.txt.profile.txt')
+
+    def tearDown(self):
+        """Remove the temporary output directory."""
+        rmtree(self.output_dir)
+
+    def test_disabled(self):
+        """Test that a disabled profiler records and writes nothing."""
+        profiler = PhaseProfiler()
+        self.assertFalse(profiler.enabled)
+        # The same do-nothing context manager is used for every phase.
+        self.assertTrue(profiler.phase('parse') is profiler.phase('write'))
+        with profiler.phase('parse'):
+            with profiler.phase('compute'):
+                pass
+        self.assertEqual(profiler.phases, [])
+        profiler.write(self.report_fp)
+        self.assertEqual(listdir(self.output_dir), [])
+
+    def test_timers(self):
+        """Test timing phases, including repeated phases."""
+        profiler = PhaseProfiler('timers')
+        with profiler.phase('parse'):
+            sum(range(1000))
+        with profiler.phase('compute'):
+            sorted(range(1000), reverse=True)
+        with profiler.phase('parse'):
+            pass
+        self.assertEqual(profiler.phases, ['parse', 'compute'])
+        self.assertTrue(profiler.wall_times['parse'] >= 0)
+        self.assertTrue(profiler.peak_rss_kb['compute'] > 0)
+        self.assertEqual(profiler.profiles, {})
+
+        report = profiler.format_report()
+        self.assertTrue(report[0].startswith('Phase\tWall time (s)'))
+        self.assertTrue(report[1].startswith('parse\t'))
+        self.assertTrue(report[2].startswith('compute\t'))
+        self.assertTrue(report[3].startswith('Total\t'))
+        self.assertEqual(len(report), 4)
+
+        profiler.write(self.report_fp)
+        self.assertEqual(listdir(self.output_dir), ['out.txt.profile.txt'])
+        self.assertEqual(open(self.report_fp).readlines(), report)
+
+    def test_cprofile(self):
+        """Test capturing cProfile stats for each phase."""
+        profiler = PhaseProfiler('cprofile')
+        with profiler.phase('sort'):
+            sorted(range(1000), reverse=True)
+        profiler.write(self.report_fp)
+
+        self.assertEqual(sorted(listdir(self.output_dir)),
+                         ['out.txt.profile.txt',
+                          'out.txt.profile.txt.sort.prof'])
+        report = open(self.report_fp).read()
+        self.assertTrue('cProfile stats for phase sort:' in report)
+        stats = Stats(join(self.output_dir, 'out.txt.profile.txt.sort.prof'))
+        self.assertTrue(any(['sorted' in func[2] for func in stats.stats]))
+
+    def test_nested_phases(self):
+        """Test that nested phases raise an error."""
+        profiler = PhaseProfiler('timers')
+
+        def nested():
+            with profiler.phase('parse'):
+                with profiler.phase('compute'):
+                    pass
+        self.assertRaises(ValueError, nested)
+
+        # The profiler is still usable afterwards.
+        with profiler.phase('compute'):
+            pass
+        self.assertEqual(profiler.phases, ['parse', 'compute'])
+
+    def test_counts(self):
+        """Test that counters are reported after the phases."""
+        profiler = PhaseProfiler('timers')
+        with profiler.phase('parse'):
+            profiler.count('exact matches', 3)
+            profiler.count('searched')
+            profiler.count('exact matches')
+        self.assertEqual(profiler.counts, {'exact matches': 4, 'searched': 1})
+        report = profiler.format_report()
+        self.assertEqual(report[3:], ['\nCounter\tCount\n',
+                                      'exact matches\t4\n', 'searched\t1\n'])
+
+        # Counters are kept when profiling is disabled.
+        profiler = PhaseProfiler()
+        profiler.count('searched', 2)
+        self.assertEqual(profiler.counts, {'searched': 2})
+
+    def test_invalid_mode(self):
+        """Test that an invalid mode raises an error."""
+        self.assertRaises(ValueError, PhaseProfiler, 'bogus')
+
+
+if __name__ == "__main__":
+    main()
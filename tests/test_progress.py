@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the progress.py module."""
+
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.progress import (ProgressReporter,
+                                            format_duration, forward_progress,
+                                            track_lines)
+
+class FakeTimer(object):
+    """A clock that only moves when it's told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ProgressTests(TestCase):
+    """Tests for the progress.py module."""
+
+    def setUp(self):
+        """Create a reporter with a fake clock."""
+        self.timer = FakeTimer()
+        self.messages = []
+
+    def _reporter(self, **kwargs):
+        return ProgressReporter('Parsing', self.messages.append,
+                                timer=self.timer, **kwargs)
+
+    def test_update_throttled(self):
+        """Test that messages are only reported every interval seconds."""
+        progress = self._reporter(total_bytes=4096)
+        progress.update(10, 1024)
+        self.timer.now += 5
+        progress.update(10, 1024)
+        self.assertEqual(self.messages, [])
+        self.timer.now += 5
+        progress.update()
+        self.assertEqual(self.messages,
+                ['Parsing: 21 records, 2.0K of 4.0K (50.0%), 2.1 records/s, '
+                 '204B/s, ETA 0:00:10'])
+
+        # The rates are measured since the last message.
+        self.timer.now += 20
+        progress.update(99, 1024)
+        self.assertEqual(self.messages[1],
+                'Parsing: 120 records, 3.0K of 4.0K (75.0%), 5.0 records/s, '
+                '51B/s, ETA 0:00:20')
+
+    def test_update_records_only(self):
+        """Test the ETA from the record rate when only they are counted."""
+        progress = self._reporter(total_records=1000, interval=1)
+        self.timer.now += 2
+        progress.update(250)
+        self.assertEqual(self.messages,
+                ['Parsing: 250 records of 1,000 (25.0%), 125 records/s, '
+                 'ETA 0:00:06'])
+
+        progress = self._reporter(interval=1)
+        self.timer.now += 2
+        progress.update()
+        self.assertEqual(self.messages[1], 'Parsing: 1 record, 0.5 records/s')
+
+    def test_finish(self):
+        """Test reporting the totals and overall rate."""
+        progress = self._reporter(interval=60)
+        for line in progress.track(['a', 'b', 'c', 'd']):
+            self.timer.now += 1
+        progress.finish()
+        self.assertEqual(self.messages,
+                         ['Parsing: 4 records, done in 0:00:04, 1.0 records/s'])
+
+    def test_disabled(self):
+        """Test that a reporter without a callback only counts."""
+        progress = ProgressReporter('Parsing', timer=self.timer, interval=0)
+        progress.update(5, 10)
+        progress.finish()
+        self.assertEqual((progress.records, progress.bytes), (5, 10))
+
+    def test_track_lines(self):
+        """Test counting lines and their lengths."""
+        progress = self._reporter()
+        self.assertEqual(list(track_lines(['ab\n', 'c\n'], progress)),
+                         ['ab\n', 'c\n'])
+        self.assertEqual((progress.records, progress.bytes), (2, 5))
+        self.assertEqual(list(track_lines(['ab\n'], None)), ['ab\n'])
+
+    def test_forward_progress(self):
+        """Test passing messages to several callbacks."""
+        other = []
+        callback = forward_progress(self.messages.append, None, other.append)
+        callback('hello')
+        self.assertEqual((self.messages, other), (['hello'], ['hello']))
+        self.assertEqual(forward_progress(None), None)
+
+    def test_format_duration(self):
+        """Test formatting durations as H:MM:SS."""
+        self.assertEqual(format_duration(0), '0:00:00')
+        self.assertEqual(format_duration(59.6), '0:01:00')
+        self.assertEqual(format_duration(3723), '1:02:03')
+        self.assertEqual(format_duration(100 * 3600), '100:00:00')
+
+
+if __name__ == "__main__":
+    main()
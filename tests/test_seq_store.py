@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import array, uint8
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.seq_store import (build_seq_store,
+        get_reference_seqs, iter_reference_seqs, pack_codes, unpack_codes,
+        write_seq_store, SequenceStore)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class SeqStoreTests(TestCase):
+    def setUp(self):
+        self.store_dir = mkdtemp(prefix='seq_store')
+
+    def tearDown(self):
+        rmtree(self.store_dir)
+
+    def test_pack_codes(self):
+        """4 codes to a byte, first code in the high bits"""
+        codes = array([0, 1, 2, 3, 3, 2], dtype=uint8)
+        packed = pack_codes(codes)
+        self.assertEqual(packed.tolist(), [0x1b, 0xe0])
+        self.assertEqual(unpack_codes(packed, 0, 6).tolist(),
+                         codes.tolist())
+        self.assertEqual(unpack_codes(packed, 3, 5).tolist(), [3, 3])
+        self.assertEqual(unpack_codes(packed, 5, 5).tolist(), [])
+        self.assertEqual(pack_codes(codes[:0]).tolist(), [])
+
+    def test_build_seq_store(self):
+        """ambiguous bases go in the exception table"""
+        obs = build_seq_store(fasta.splitlines())
+        self.assertEqual(obs['seq_ids'].tolist(), ['s2', 's1', 's3'])
+        self.assertEqual(obs['sorted_seq_ids'].tolist(), ['s1', 's2', 's3'])
+        self.assertEqual(obs['sorted_seq_ranks'].tolist(), [1, 0, 2])
+        self.assertEqual(obs['offsets'].tolist(), [0, 6, 11, 13])
+        self.assertEqual(len(obs['packed']), 4)
+        self.assertEqual(obs['exception_positions'].tolist(), [2, 9, 12])
+        self.assertEqual(obs['exception_chars'].tostring(), 'NR-')
+
+    def test_batches(self):
+        """batches that split a byte give the same store"""
+        exp = build_seq_store(fasta.splitlines())
+        for batch_size in [1, 5, 7]:
+            obs = build_seq_store(fasta.splitlines(), batch_size)
+            for name in exp:
+                self.assertEqual(obs[name].tolist(), exp[name].tolist())
+
+    def test_sequences(self):
+        """sequences decode by index and id, in uppercase"""
+        write_seq_store(fasta.splitlines(), self.store_dir)
+        store = SequenceStore(self.store_dir)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(list(store), [('s2', 'ACNTGA'), ('s1', 'TTGRA'),
+                                       ('s3', 'C-')])
+        self.assertEqual(store.sequence(1), 'TTGRA')
+        self.assertEqual(store.get('s3'), 'C-')
+        self.assertEqual(store.index('s1'), 1)
+        self.assertEqual(store.index('s4'), -1)
+        self.assertRaises(KeyError, store.get, 's0')
+        self.assertEqual(list(store.iter_seqs([2, 0])),
+                         [('s3', 'C-'), ('s2', 'ACNTGA')])
+
+    def test_from_arrays(self):
+        """a store can be made from arrays in memory"""
+        store = SequenceStore.from_arrays(build_seq_store(fasta.splitlines()))
+        self.assertEqual(list(store), [('s2', 'ACNTGA'), ('s1', 'TTGRA'),
+                                       ('s3', 'C-')])
+
+    def test_reference_seqs(self):
+        """stores and FASTA give the same sequences"""
+        write_seq_store(fasta.splitlines(), self.store_dir)
+        for source in [self.store_dir, SequenceStore(self.store_dir)]:
+            self.assertEqual(list(iter_reference_seqs(source)),
+                             [('s2', 'ACNTGA'), ('s1', 'TTGRA'),
+                              ('s3', 'C-')])
+            self.assertEqual(get_reference_seqs(source, ['s3', 's1', 's4']),
+                             {'s3': 'C-', 's1': 'TTGRA'})
+        self.assertEqual(get_reference_seqs(fasta.splitlines(), ['s3']),
+                         {'s3': 'C-'})
+        self.assertEqual(list(iter_reference_seqs(fasta.splitlines()))[0],
+                         ('s2 first', 'acNtgA'))
+
+fasta = """>s2 first
+acNtgA
+>s1
+TTG
+RA
+>s3
+C-
+"""
+
+
+if __name__ == '__main__':
+    main()
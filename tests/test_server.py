@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the server.py module."""
+
+from os import mkdir, stat, symlink
+from os.path import exists, join
+from shutil import rmtree
+from socket import AF_UNIX, SOCK_STREAM, socket
+from StringIO import StringIO
+from tempfile import mkdtemp
+from threading import Thread
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.membership_index import write_membership_index
+from nested_reference_otus.seq_store import write_seq_store
+from nested_reference_otus.server import (answer_request, ReferenceCache,
+                                          ReferenceServer, RequestError,
+                                          send_request, send_requests)
+from nested_reference_otus.summarize_taxonomic_agreement import \
+        summarize_taxonomic_agreement
+from nested_reference_otus.unnest import build_nested_tree, parse_otu_map
+
+class ServerTests(TestCase):
+    """Tests for the server.py module."""
+
+    def setUp(self):
+        """Write some sample reference files to a temporary directory."""
+        self.output_dir = mkdtemp(prefix='nested_reference_otus_server')
+        self.tax_map = [
+                "ID Number\tGenBank Number\tNew Taxon String\tSource\n",
+                "1\tG1\tA;B;C\tfoo\n",
+                "2\tG2\tA;B;unidentified\tfoo\n",
+                "3\tG3\tA;Z;T\tfoo\n"]
+        self.tax_map_fp = self._write('taxonomy.txt', self.tax_map)
+        self.fasta = ">1\nAGGT\n>2\nAGGTAC\n>3\nAG\n>4\nAGGTACGT\n"
+        self.fasta_fp = self._write('seqs.fasta', [self.fasta])
+        self.otu_map = ["A\t1\t2\n", "B\t3\n"]
+        self.otu_map_fp = self._write('otu_map.txt', self.otu_map)
+        self.cache = ReferenceCache()
+        self.socket_fp = join(self.output_dir, 'server.sock')
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        rmtree(self.output_dir)
+
+    def _write(self, name, lines):
+        fp = join(self.output_dir, name)
+        f = open(fp, 'w')
+        f.writelines(lines)
+        f.close()
+        return fp
+
+    def test_sort_seqs(self):
+        """Test sorting inline and on-disk FASTA against a cached taxonomy."""
+        exp = [['1', 3, 4, 'AGGT'], ['3', 3, 2, 'AG'], ['2', 2, 6, 'AGGTAC'],
+               ['4', 0, 8, 'AGGTACGT']]
+        obs = answer_request(self.cache, {'command': 'sort_seqs',
+                                          'taxonomy_fp': self.tax_map_fp,
+                                          'fasta': self.fasta})
+        self.assertEqual(obs, {'status': 'ok', 'seqs': exp})
+        obs = answer_request(self.cache, {'command': 'sort_seqs',
+                                          'taxonomy_fp': self.tax_map_fp,
+                                          'fasta_fp': self.fasta_fp})
+        self.assertEqual(obs, {'status': 'ok', 'seqs': exp})
+
+        # Only the sequences in the request are returned.
+        obs = answer_request(self.cache, {'command': 'sort_seqs',
+                                          'taxonomy_fp': self.tax_map_fp,
+                                          'fasta': ['>3', 'AG', '>1', 'A'],
+                                          'unknown_keywords': ['Z']})
+        self.assertEqual(obs['seqs'], [['1', 3, 1, 'A'], ['3', 2, 2, 'AG']])
+        # Once for each set of unknown keywords, and once for the FASTA file.
+        self.assertEqual(self.cache.num_loads, 3)
+
+    def test_summarize(self):
+        """Test summarizing inline and on-disk OTU maps."""
+        exp = list(summarize_taxonomic_agreement(self.otu_map, self.tax_map,
+                                                   3))
+        for otu_map_param in [{'otu_map': self.otu_map},
+                              {'otu_map_fp': self.otu_map_fp}]:
+            request = {'command': 'summarize', 'taxonomy_fp': self.tax_map_fp,
+                       'taxonomic_levels': 3}
+            request.update(otu_map_param)
+            self.assertEqual(answer_request(self.cache, request),
+                             {'status': 'ok', 'lines': exp})
+        self.assertEqual(self.cache.num_loads, 2)
+
+    def test_membership_queries(self):
+        """Test querying a membership index."""
+        tree = build_nested_tree(
+                [(parse_otu_map(StringIO("0\t1\t2\n1\t3\n")), 1.0, 99),
+                 (parse_otu_map(StringIO("0\t1\t3\n")), 2.0, 97)])
+        index_dir = join(self.output_dir, 'index')
+        write_membership_index(tree, index_dir)
+
+        obs = answer_request(self.cache, {'command': 'tips',
+                                          'index_dir': index_dir,
+                                          'level': 97, 'otu_id': '0'})
+        self.assertEqual(sorted(obs['tips']), ['1', '2', '3'])
+        obs = answer_request(self.cache, {'command': 'ancestors',
+                                          'index_dir': index_dir,
+                                          'seq_id': '2'})
+        self.assertEqual(obs['ancestors'], [[99, '0', '1'], [97, '0', '1']])
+        obs = answer_request(self.cache, {'command': 'tips',
+                                          'index_dir': index_dir,
+                                          'level': 94, 'otu_id': '0'})
+        self.assertEqual(obs, {'status': 'error',
+                               'message': 'Unknown level: 94'})
+        self.assertEqual(self.cache.num_loads, 1)
+
+    def test_seq_store(self):
+        """Test sorting and looking up sequences from a sequence store."""
+        store_dir = join(self.output_dir, 'seq_store')
+        write_seq_store([self.fasta], store_dir)
+        obs = answer_request(self.cache, {'command': 'sort_seqs',
+                                          'taxonomy_fp': self.tax_map_fp,
+                                          'fasta_fp': store_dir})
+        self.assertEqual(obs['seqs'], [['1', 3, 4, 'AGGT'], ['3', 3, 2, 'AG'],
+                                       ['2', 2, 6, 'AGGTAC'],
+                                       ['4', 0, 8, 'AGGTACGT']])
+        obs = answer_request(self.cache, {'command': 'get_seqs',
+                                          'store_dir': store_dir,
+                                          'seq_ids': [u'4', u'1']})
+        self.assertEqual(obs, {'status': 'ok',
+                               'seqs': [['4', 'AGGTACGT'], ['1', 'AGGT']]})
+        obs = answer_request(self.cache, {'command': 'get_seqs',
+                                          'store_dir': store_dir,
+                                          'seq_ids': ['5']})
+        self.assertEqual(obs, {'status': 'error',
+                               'message': 'Unknown sequence: 5'})
+        # The taxonomy, and the store once as FASTA and once as a store.
+        self.assertEqual(self.cache.num_loads, 3)
+
+    def test_reload_changed_files(self):
+        """Test that files are only reloaded after they change."""
+        request = {'command': 'sort_seqs', 'taxonomy_fp': self.tax_map_fp,
+                   'fasta': ['>1', 'A', '>3', 'AG']}
+        self.assertEqual(answer_request(self.cache, request)['seqs'],
+                         [['3', 3, 2, 'AG'], ['1', 3, 1, 'A']])
+        answer_request(self.cache, request)
+        self.assertEqual(self.cache.num_loads, 1)
+
+        self._write('taxonomy.txt', self.tax_map[:3] + ["3\tG3\tA\tfoo\n"])
+        self.assertEqual(answer_request(self.cache, request)['seqs'],
+                         [['1', 3, 1, 'A'], ['3', 1, 2, 'AG']])
+        self.assertEqual(self.cache.num_loads, 2)
+
+    def test_invalid_requests(self):
+        """Test that invalid requests return an error instead of raising."""
+        for request in [{}, {'command': 'bogus'},
+                        {'command': 'sort_seqs', 'fasta': self.fasta},
+                        {'command': 'sort_seqs', 'fasta': self.fasta,
+                         'taxonomy_fp': join(self.output_dir, 'missing')},
+                        {'command': 'summarize', 'otu_map': self.otu_map,
+                         'taxonomy_fp': self.tax_map_fp}]:
+            obs = answer_request(self.cache, request)
+            self.assertEqual(obs['status'], 'error')
+            self.assertTrue(obs['message'])
+        self.assertEqual(answer_request(self.cache, {'command': 'ping'}),
+                         {'status': 'ok'})
+        for request in [5, None, 'command', ['command']]:
+            self.assertEqual(answer_request(self.cache, request, None),
+                             {'status': 'error', 'message':
+                              'Requests must be JSON objects.'})
+
+    def test_error_messages(self):
+        """Test that only errors in the request are sent to the client."""
+        bad_fasta_fp = self._write('bad.fasta', ['secret line\n', 'AGGT\n'])
+        request = {'command': 'sort_seqs', 'taxonomy_fp': self.tax_map_fp,
+                   'fasta_fp': bad_fasta_fp}
+        error_f = StringIO()
+        obs = answer_request(self.cache, request, error_f)
+        self.assertEqual(obs, {'status': 'error', 'message':
+                "The sort_seqs request failed (ValueError). See the "
+                "server's error output for details."})
+        self.assertTrue('secret line' in error_f.getvalue())
+
+        obs = answer_request(self.cache, {'command': 'sort_seqs',
+                                          'fasta': self.fasta})
+        self.assertEqual(obs, {'status': 'error', 'message':
+                               'Missing required parameter: taxonomy_fp'})
+
+    def test_reference_dirs(self):
+        """Test that only files in the reference directories are loaded."""
+        ref_dir = join(self.output_dir, 'ref')
+        mkdir(ref_dir)
+        tax_map_fp = join(ref_dir, 'taxonomy.txt')
+        open(tax_map_fp, 'w').writelines(self.tax_map)
+        symlink(self.tax_map_fp, join(ref_dir, 'link.txt'))
+        cache = ReferenceCache([ref_dir])
+
+        request = {'command': 'sort_seqs', 'fasta': ['>1', 'A']}
+        for fp in [tax_map_fp, join(ref_dir, '..', 'ref', 'taxonomy.txt')]:
+            request['taxonomy_fp'] = fp
+            self.assertEqual(answer_request(cache, request)['status'], 'ok')
+        for fp in [self.tax_map_fp, join(ref_dir, '..', 'taxonomy.txt'),
+                   join(ref_dir, 'link.txt'), ref_dir + 'x/taxonomy.txt']:
+            request['taxonomy_fp'] = fp
+            self.assertEqual(answer_request(cache, request), {
+                    'status': 'error', 'message': "%s isn't in one of the "
+                    "server's reference directories." % fp})
+        self.assertRaises(RequestError, cache.check_path, 42)
+        self.assertEqual(ReferenceCache().check_path(self.tax_map_fp),
+                         self.tax_map_fp)
+
+    def test_server(self):
+        """Test answering requests over a Unix socket."""
+        server = ReferenceServer(self.socket_fp, self.cache)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            # A second server can't take over the socket.
+            self.assertRaises(ValueError, ReferenceServer, self.socket_fp)
+            # Only the server's user can connect.
+            self.assertEqual(stat(self.socket_fp).st_mode & 0777, 0600)
+
+            request = {'command': 'summarize', 'taxonomy_fp': self.tax_map_fp,
+                       'otu_map_fp': self.otu_map_fp, 'taxonomic_levels': 3}
+            exp = list(summarize_taxonomic_agreement(self.otu_map,
+                                                     self.tax_map, 3))
+            obs = send_requests(self.socket_fp, [{'command': 'ping'}, request,
+                                                 {'command': 'bogus'}])
+            self.assertEqual(obs[:2], [{'status': 'ok'},
+                                       {'status': 'ok', 'lines': exp}])
+            self.assertEqual(obs[2]['status'], 'error')
+
+            # Requests that aren't JSON objects don't drop the connection.
+            obs = send_requests(self.socket_fp, [5, None, 'command',
+                                                 {'command': 'ping'}])
+            self.assertEqual(obs, [{'status': 'error', 'message':
+                                    'Requests must be JSON objects.'}] * 3 +
+                                  [{'status': 'ok'}])
+
+            # Several clients at once.
+            results = []
+            clients = [Thread(target=lambda: results.append(
+                               send_request(self.socket_fp, request)))
+                       for i in range(4)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, [{'status': 'ok', 'lines': exp}] * 4)
+            self.assertEqual(self.cache.num_loads, 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(exists(self.socket_fp))
+
+    def test_server_stale_socket(self):
+        """Test that a socket file left behind by a dead server is replaced."""
+        sock = socket(AF_UNIX, SOCK_STREAM)
+        sock.bind(self.socket_fp)
+        sock.close()
+        self.assertTrue(exists(self.socket_fp))
+
+        server = ReferenceServer(self.socket_fp)
+        server.server_close()
+        self.assertFalse(exists(self.socket_fp))
+
+
+if __name__ == "__main__":
+    main()
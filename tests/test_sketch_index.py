@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import array, uint8, uint64
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.sketch_index import (band_recall,
+        build_sketch_index, choose_rows_per_band, compute_sketches,
+        estimate_jaccard, identity_to_jaccard, jaccard_to_identity,
+        kmer_hashes, write_sketch_index, EMPTY, SketchIndex)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+class SketchIndexTests(TestCase):
+    def setUp(self):
+        rand = Random(42)
+        self.seqs = [''.join([rand.choice('ACGT') for i in range(500)])
+                     for j in range(20)]
+        # 2% of the bases of the first sequence changed
+        mutant = list(self.seqs[0])
+        for pos in rand.sample(range(500), 10):
+            mutant[pos] = 'ACGT'[('ACGT'.index(mutant[pos]) + 1) % 4]
+        self.mutant = ''.join(mutant)
+        self.fasta = []
+        for i, seq in enumerate(self.seqs):
+            self.fasta.extend(['>r%d some description\n' % i, seq + '\n'])
+        self.index_dir = mkdtemp(prefix='sketch_index')
+
+    def tearDown(self):
+        rmtree(self.index_dir)
+
+    def test_kmer_hashes(self):
+        """k-mers containing invalid bases are skipped"""
+        codes = array([0, 1, 2, 3, 4, 0, 1, 2], dtype=uint8)
+        positions, hashes = kmer_hashes(codes, 3)
+        self.assertEqual(positions.tolist(), [0, 1, 5])
+        # the same k-mer hashes the same wherever it is
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertNotEqual(hashes[0], hashes[1])
+        self.assertEqual(len(kmer_hashes(codes, 9)[0]), 0)
+
+    def test_compute_sketches(self):
+        """sketches are independent of the batch and case"""
+        obs = compute_sketches(self.seqs[:3], 8, 16)
+        self.assertEqual(obs.shape, (3, 16))
+        self.assertEqual(obs.dtype, uint64)
+        for i, seq in enumerate(self.seqs[:3]):
+            self.assertEqual(compute_sketches([seq], 8, 16)[0].tolist(),
+                             obs[i].tolist())
+        self.assertEqual(compute_sketches([self.seqs[0].lower()], 8,
+                                          16).tolist(), obs[:1].tolist())
+        # too short to hold a k-mer
+        obs = compute_sketches(['ACGTN', 'ACG'], 4, 8)
+        self.assertEqual(obs[1].tolist(), [EMPTY] * 8)
+        self.assertEqual(compute_sketches([], 4, 8).shape, (0, 8))
+
+    def test_estimate_jaccard(self):
+        """the fraction of the non-empty bins that agree"""
+        sketch = array([1, 2, EMPTY, EMPTY], dtype=uint64)
+        sketches = array([[1, 2, EMPTY, EMPTY],
+                          [1, 3, 4, EMPTY],
+                          [EMPTY, EMPTY, EMPTY, EMPTY]], dtype=uint64)
+        self.assertFloatEqual(estimate_jaccard(sketch, sketches),
+                              [1.0, 1 / 3., 0.0])
+
+    def test_identity_conversions(self):
+        """the identity and Jaccard conversions are inverses"""
+        for identity in [0.8, 0.94, 0.97, 1.0]:
+            self.assertFloatEqual(jaccard_to_identity(
+                    identity_to_jaccard(identity, 16), 16), identity)
+        self.assertEqual(jaccard_to_identity(0, 16), 0.0)
+        self.assertEqual(identity_to_jaccard(0, 16), 0.0)
+
+    def test_choose_rows_per_band(self):
+        """the most rows per band that find 97% of the matches"""
+        for identity, rows_per_band in [(0.99, 6), (0.97, 3), (0.94, 2),
+                                        (0.90, 1), (0.5, 1)]:
+            self.assertEqual(choose_rows_per_band(identity), rows_per_band)
+            self.assertTrue(band_recall(identity, 16, 128,
+                                        rows_per_band + 1) < 0.97)
+        self.assertTrue(band_recall(0.97, 16, 128, 3) >= 0.97)
+        # a dissimilar sequence is rarely a candidate
+        self.assertTrue(band_recall(0.8, 16, 128, 3) < 0.001)
+        self.assertEqual(choose_rows_per_band(1.0, sketch_size=8), 8)
+
+    def test_build_sketch_index(self):
+        """band keys are sorted within each band"""
+        obs = build_sketch_index(self.fasta, 12, 32, 4, batch_size=7)
+        self.assertEqual(obs['params'].tolist(), [12, 32, 4])
+        self.assertEqual(obs['seq_ids'].tolist(),
+                         ['r%d' % i for i in range(20)])
+        self.assertEqual(obs['sketches'].tolist(),
+                         compute_sketches(self.seqs, 12, 32).tolist())
+        self.assertEqual(obs['band_keys'].shape, (8, 20))
+        for band in obs['band_keys']:
+            self.assertEqual(band.tolist(), sorted(band.tolist()))
+        self.assertEqual(sorted(obs['band_order'][0].tolist()), range(20))
+        # the rows per band are chosen from the minimum identity
+        obs = build_sketch_index(self.fasta)
+        self.assertEqual(obs['params'].tolist(), [16, 128, 3])
+        self.assertEqual(obs['band_keys'].shape, (42, 20))
+        obs = build_sketch_index(self.fasta, min_identity=0.94)
+        self.assertEqual(obs['params'].tolist(), [16, 128, 2])
+        self.assertRaises(ValueError, build_sketch_index, self.fasta, 33)
+        self.assertRaises(ValueError, build_sketch_index, self.fasta, 16, 8,
+                          9)
+
+    def test_query(self):
+        """similar sequences are found, unrelated ones aren't"""
+        write_sketch_index(self.fasta, self.index_dir)
+        index = SketchIndex(self.index_dir)
+        self.assertEqual(len(index), 20)
+
+        obs = index.query(self.seqs[3], 0.97)
+        self.assertEqual(obs, [('r3', 1.0)])
+        for use_bands in [True, False]:
+            obs = index.query(self.mutant, 0.9, use_bands)
+            self.assertEqual([seq_id for seq_id, identity in obs], ['r0'])
+            self.assertTrue(0.95 < obs[0][1] < 1.0)
+        self.assertEqual(index.query(self.mutant, 0.999), [])
+        self.assertEqual(index.query('ACGT', 0.5), [])
+
+
+if __name__ == '__main__':
+    main()
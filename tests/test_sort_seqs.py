@@ -12,11 +12,17 @@ __status__ = "Development"
 
 """Test suite for the sort_seqs.py module."""
 
+from os import listdir
+from shutil import rmtree
 from StringIO import StringIO
 import sys
+from tempfile import mkdtemp
 from cogent.util.unit_test import TestCase, main
 from nested_reference_otus.sort_seqs import (compute_sequence_stats,
-                                             sort_seqs_by_taxonomic_depth)
+                                             compute_taxonomic_depths,
+                                             estimate_sort_memory,
+                                             sort_seqs_by_taxonomic_depth,
+                                             sort_seqs_on_disk)
 
 class SortSeqsTests(TestCase):
     """Tests for the sort_seqs.py module."""
@@ -92,6 +98,13 @@ class SortSeqsTests(TestCase):
                            '2': [3, 7, 'AGGAGTC']}
 
 
+    def test_compute_taxonomic_depths(self):
+        """Test computing taxonomic depths without any sequences."""
+        obs = compute_taxonomic_depths(self.tax_map4, ['Z'])
+        self.assertEqual(obs, {'1': 3, '2': 3, '3': 3})
+        obs = compute_taxonomic_depths(self.tax_map4)
+        self.assertEqual(obs, {'1': 3, '2': 3, '3': 5})
+
     def test_compute_sequence_stats_unequal_depths(self):
         """Test computing seq stats on unequal taxonomic depths."""
         exp = {'1': [3, 4, 'AGGT'], '3': [2, 4, 'AGGC'], '2': [3, 4, 'AGGA']}
@@ -230,6 +243,110 @@ class SortSeqsTests(TestCase):
         finally:
             sys.stdout = saved_stdout
 
+    def test_sort_seqs_on_disk(self):
+        """Test that sorting on disk matches sorting in memory."""
+        temp_dir = mkdtemp(prefix='nested_reference_otus_sort_seqs')
+        saved_stdout = sys.stdout
+        try:
+            # Ignore the warnings about sequences without taxonomy.
+            sys.stdout = StringIO()
+            fasta = [">1", "AGGTAC", ">2", "AG", ">3", "AGGCAAA", ">4", "AGGC",
+                     ">5 a\tdescription", "AGGTAC", ">6", "A"]
+            exp = sort_seqs_by_taxonomic_depth(
+                    compute_sequence_stats(fasta, self.tax_map1, ['Z']))
+            # Every run holds one or two sequences, so several are merged.
+            for run_size in 1, 10, 1000:
+                obs = list(sort_seqs_on_disk(fasta, self.tax_map1, ['Z'],
+                                             run_size=run_size,
+                                             temp_dir=temp_dir))
+                self.assertEqual(obs, exp)
+                self.assertEqual(listdir(temp_dir), [])
+            self.assertEqual(obs[:3], [['1', 3, 6, 'AGGTAC'],
+                                       ['2', 3, 2, 'AG'],
+                                       ['3', 2, 7, 'AGGCAAA']])
+            self.assertEqual(obs[-2:], [['4', 0, 4, 'AGGC'], ['6', 0, 1, 'A']])
+            self.assertEqual(list(sort_seqs_on_disk([], self.tax_map1[:1],
+                                                   temp_dir=temp_dir)),
+                             [])
+        finally:
+            sys.stdout = saved_stdout
+            rmtree(temp_dir)
+
+    def test_sort_seqs_on_disk_missing_seqs(self):
+        """Test sorting on disk with sequences missing from either file."""
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            obs = list(sort_seqs_on_disk([">1", "AGGT", ">4", "AACCGGTT"],
+                                         self.tax_map1, ['Z'], run_size=1))
+            self.assertEqual(obs, [['1', 3, 4, 'AGGT'],
+                                   ['4', 0, 8, 'AACCGGTT']])
+            output = sorted(out.getvalue().strip().split('\n\n'))
+            self.assertEqual(output,
+                    ["Found sequence id '2' in the taxonomy mapping file that "
+                     "wasn't in the FASTA file",
+                     "Found sequence id '3' in the taxonomy mapping file that "
+                     "wasn't in the FASTA file",
+                     "Found sequence id '4' in the FASTA file that wasn't in "
+                     "the taxonomy mapping file"])
+        finally:
+            sys.stdout = saved_stdout
+
+    def test_sort_seqs_ties_and_duplicates(self):
+        """Test that both sorts keep ties in FASTA order and drop duplicates."""
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            fasta = [">3", "AGGC", ">9", "AGGA", ">1", "AGGT", ">3", "AG",
+                     ">8", "AC\tGT", ">2", "AGGA", ">9", "ACGTACGT"]
+            exp = [['1', 3, 4, 'AGGT'], ['2', 3, 4, 'AGGA'],
+                   ['3', 2, 4, 'AGGC'], ['8', 0, 5, 'AC\tGT'],
+                   ['9', 0, 4, 'AGGA']]
+            obs = sort_seqs_by_taxonomic_depth(
+                    compute_sequence_stats(fasta, self.tax_map1, ['Z']))
+            self.assertEqual(obs, exp)
+            in_memory_output = out.getvalue()
+            self.assertEqual(in_memory_output.count("Found duplicate "
+                    "sequence id '3' in the FASTA file"), 1)
+            self.assertEqual(in_memory_output.count("Found duplicate "
+                    "sequence id '9' in the FASTA file"), 1)
+
+            out.truncate(0)
+            for run_size in 1, 1000:
+                obs = list(sort_seqs_on_disk(fasta, self.tax_map1, ['Z'],
+                                             run_size=run_size))
+                self.assertEqual(obs, exp)
+            self.assertEqual(out.getvalue(), in_memory_output * 2)
+        finally:
+            sys.stdout = saved_stdout
+
+    def test_compute_sequence_stats_fasta_order(self):
+        """Test that seq stats are in FASTA order, then taxonomy-only IDs."""
+        saved_stdout = sys.stdout
+        try:
+            sys.stdout = StringIO()
+            obs = compute_sequence_stats([">3", "AGGC", ">4", "A", ">1",
+                                          "AGGT"], self.tax_map1, ['Z'])
+        finally:
+            sys.stdout = saved_stdout
+        self.assertEqual(obs.keys(), ['3', '4', '1', '2'])
+        self.assertEqual(obs['2'], [3])
+
+    def test_estimate_sort_memory(self):
+        """Test estimating the memory needed to sort in memory."""
+        self.assertEqual(estimate_sort_memory(self.fasta1, self.tax_map1), 0)
+        temp_dir = mkdtemp(prefix='nested_reference_otus_sort_seqs')
+        try:
+            fasta_fp = temp_dir + '/seqs.fasta'
+            open(fasta_fp, 'w').write('>1\nAGGT\n')
+            self.assertEqual(estimate_sort_memory(fasta_fp, self.tax_map1), 16)
+        finally:
+            rmtree(temp_dir)
+
 
 if __name__ == "__main__":
     main()
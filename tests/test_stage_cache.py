@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the stage_cache.py module."""
+
+from hashlib import sha1
+from os import link, listdir, makedirs, stat, utime
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.stage_cache import StageCache
+from nested_reference_otus.util import open_output
+
+class StageCacheTests(TestCase):
+    """Tests for the StageCache class."""
+
+    def setUp(self):
+        """Create a cache and some input and output files."""
+        self.temp_dir = mkdtemp(prefix='nested_reference_otus_stage_cache')
+        self.cache_dir = join(self.temp_dir, 'cache')
+        self.cache = StageCache(self.cache_dir)
+        self.run1_dir = join(self.temp_dir, 'run1')
+        self.run2_dir = join(self.temp_dir, 'run2')
+        makedirs(self.run1_dir)
+        makedirs(self.run2_dir)
+        self.seqs1_fp = self._write(self.run1_dir, 'seqs.fasta', '>a\nACGT\n')
+        self.seqs2_fp = self._write(self.run2_dir, 'other.fasta', '>a\nACGT\n')
+        self.otu_map_fp = self._write(self.run1_dir, 'otu_map.txt', '0\ta\n')
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        rmtree(self.temp_dir)
+
+    def _write(self, dir_, fn, data):
+        fp = join(dir_, fn)
+        f = open(fp, 'w')
+        f.write(data)
+        f.close()
+        return fp
+
+    def test_key(self):
+        """Test that keys depend on input contents, not input names."""
+        key = self.cache.key('pick', [self.seqs1_fp], {'similarity': 0.97})
+        self.assertEqual(len(key), 40)
+        self.assertEqual(self.cache.key('pick', [self.seqs2_fp],
+                                        {'similarity': 0.97}), key)
+        self.assertNotEqual(self.cache.key('pick', [self.seqs1_fp],
+                                           {'similarity': 0.94}), key)
+        self.assertNotEqual(self.cache.key('filter', [self.seqs1_fp],
+                                           {'similarity': 0.97}), key)
+        self.assertNotEqual(self.cache.key('pick',
+                                           [self.seqs1_fp, self.otu_map_fp],
+                                           {'similarity': 0.97}), key)
+
+        # Changing an input changes the key.
+        self._write(self.run2_dir, 'other.fasta', '>a\nACGA\n')
+        utime(self.seqs2_fp, (0, 0))
+        self.assertNotEqual(self.cache.key('pick', [self.seqs2_fp],
+                                           {'similarity': 0.97}), key)
+
+    def test_store_fetch(self):
+        """Test that stored outputs are fetched by a later run."""
+        key = self.cache.key('pick', [self.seqs1_fp])
+        out_fp = join(self.run2_dir, 'otus.txt')
+        self.assertFalse(self.cache.fetch(key, {'otu_map': out_fp}))
+        self.assertFalse(exists(out_fp))
+
+        self.cache.store(key, {'otu_map': self.otu_map_fp})
+        self.assertEqual(listdir(self.cache_dir), [key])
+        self.assertTrue(self.cache.fetch(key, {'otu_map': out_fp}))
+        self.assertEqual(open(out_fp).read(), '0\ta\n')
+        # The outputs are hardlinked on the same filesystem.
+        self.assertEqual(stat(out_fp).st_ino, stat(self.otu_map_fp).st_ino)
+
+        # Storing the same key again keeps the first entry.
+        self.cache.store(key, {'otu_map': out_fp})
+        self.assertEqual(listdir(self.cache_dir), [key])
+
+    def test_rerun_into_same_output_dir(self):
+        """Test that rerunning a stage doesn't change earlier entries."""
+        tree_fp = join(self.run1_dir, '97_otus.tre')
+        runs = [('(a,b);', 'v1'), ('(c,d);', 'v2'), ('(e,f);', 'v3')]
+        for newick, version in runs:
+            key = self.cache.key('filter tree', [self.seqs1_fp],
+                                 {'version': version})
+            self.assertFalse(self.cache.fetch(key, {'tree.tre': tree_fp}))
+            tree_f = open_output(tree_fp)
+            tree_f.write(newick)
+            tree_f.close()
+            self.cache.store(key, {'tree.tre': tree_fp})
+
+            # A run that hits the cache shares the entry's file.
+            self.assertTrue(self.cache.fetch(key, {'tree.tre': tree_fp}))
+
+        for newick, version in runs:
+            key = self.cache.key('filter tree', [self.seqs1_fp],
+                                 {'version': version})
+            out_fp = join(self.run2_dir, '%s.tre' % version)
+            self.assertTrue(self.cache.fetch(key, {'tree.tre': out_fp}))
+            self.assertEqual(open(out_fp).read(), newick)
+        self.assertEqual(open(tree_fp).read(), '(e,f);')
+
+    def test_fetch_incomplete(self):
+        """Test that a fetch missing an output leaves nothing behind."""
+        key = self.cache.key('pick', [self.seqs1_fp])
+        self.cache.store(key, {'otu_map': self.otu_map_fp})
+        out_fp = join(self.run2_dir, 'otus.txt')
+        uc_fp = join(self.run2_dir, 'clusters.uc')
+        self.assertFalse(self.cache.fetch(key, {'otu_map': out_fp,
+                                                'clusters': uc_fp}))
+        self.assertFalse(exists(out_fp))
+        self.assertFalse(exists(uc_fp))
+
+    def test_evict(self):
+        """Test that the least recently used entries are evicted."""
+        cache = StageCache(self.cache_dir, max_size=10)
+        keys = []
+        for i, data in enumerate(['aaaa', 'bbbb', 'cccc']):
+            fp = self._write(self.run1_dir, 'out%d.txt' % i, data)
+            keys.append(cache.key('stage', [], {'i': i}))
+            cache.store(keys[-1], {'out': fp})
+            utime(join(self.cache_dir, keys[-1]), (i, i))
+            self.assertEqual(cache.size(), min(4 * (i + 1), 8))
+        # The first entry was evicted when the third was stored.
+        self.assertEqual(sorted(listdir(self.cache_dir)),
+                         sorted(keys[1:]))
+
+        # Fetching the second entry makes the third the least recently used.
+        self.assertTrue(cache.fetch(keys[1],
+                                    {'out': join(self.run2_dir, 'out.txt')}))
+        fp = self._write(self.run1_dir, 'out3.txt', 'dddd')
+        key = cache.key('stage', [], {'i': 3})
+        cache.store(key, {'out': fp})
+        self.assertEqual(sorted(listdir(self.cache_dir)),
+                         sorted([keys[1], key]))
+
+        # Unbounded caches never evict.
+        self.assertEqual(self.cache.evict(), [])
+
+    def test_file_digest(self):
+        """Test that digests are remembered, and shared by hardlinks."""
+        self.assertEqual(self.cache.file_digest(self.seqs1_fp),
+                         sha1('>a\nACGT\n').hexdigest())
+        self.assertEqual(len(self.cache._digests), 1)
+        self.cache.file_digest(self.seqs1_fp)
+        self.assertEqual(len(self.cache._digests), 1)
+
+        linked_fp = join(self.run2_dir, 'linked.fasta')
+        link(self.seqs1_fp, linked_fp)
+        self.cache.file_digest(linked_fp)
+        self.assertEqual(len(self.cache._digests), 1)
+        self.cache.file_digest(self.seqs2_fp)
+        self.assertEqual(len(self.cache._digests), 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,17 @@ __status__ = "Development"
 
 """Test suite for the summarize_taxonomic_agreement.py module."""
 
+from os import close, remove
+from tempfile import mkstemp
 from cogent.util.unit_test import TestCase, main
 from nested_reference_otus.summarize_taxonomic_agreement import (
+        _DiskTaxonomyMap, _estimate_otu_taxonomic_agreement,
         _generate_taxonomic_agreement_summary, _parse_taxonomic_information,
-        summarize_taxonomic_agreement)
+        _sample_otu_members, compute_taxonomic_agreement_statistics,
+        estimate_taxonomic_agreement_memory, parse_taxonomic_information,
+        format_taxonomic_agreement_statistics, summarize_taxonomic_agreement,
+        summarize_taxonomic_agreement_arrays,
+        update_taxonomic_agreement_summary)
 
 class SummarizeTaxonomicAgreementTests(TestCase):
     """Tests for the summarize_taxonomic_agreement.py module."""
@@ -96,6 +103,23 @@ class SummarizeTaxonomicAgreementTests(TestCase):
         self.assertRaises(ValueError, _parse_taxonomic_information,
                           self.tax_map_invalid3, 3)
 
+    def test_parse_taxonomic_information_seq_ids(self):
+        """Test parsing only the requested rows of a taxonomy map."""
+        exp = {'1': ['A', 'B', 'C'], '3': ['A', 'Z', 'T']}
+        obs = _parse_taxonomic_information(self.tax_map1, 3, set(['1', '3']))
+        self.assertEqual(obs, exp)
+
+        obs = _parse_taxonomic_information(self.tax_map1, 3, set())
+        self.assertEqual(obs, {})
+
+        # Invalid rows that aren't requested are never validated.
+        exp = {'1': ['A', 'B', 'C'], '2': ['A', 'B', 'D']}
+        obs = _parse_taxonomic_information(self.tax_map_invalid3, 3,
+                                           set(['1', '2']))
+        self.assertEqual(obs, exp)
+        self.assertRaises(ValueError, _parse_taxonomic_information,
+                          self.tax_map_invalid3, 3, set(['3']))
+
     def test_generate_taxonomic_agreement_summary_standard(self):
         """Test computing the taxonomic agreement for seqs in OTUs."""
         exp = {'A': [3, ['1', '2', '3'], [100.0, 66.66666666666666,
@@ -113,20 +137,321 @@ class SummarizeTaxonomicAgreementTests(TestCase):
                                                     self.tax_map1, 3)
         self.assertFloatEqual(obs, exp)
 
+    def test_generate_taxonomic_agreement_summary_unreferenced_rows(self):
+        """Test that taxonomy rows not in the OTU map are not validated."""
+        exp = {'A': [2, ['1', '2'], [100.0, 100.0, 50.0], [['A'], ['B'],
+                    ['C', 'D']]]}
+        obs = _generate_taxonomic_agreement_summary(["A\t1\t2\n"],
+                                                    self.tax_map_invalid3, 3)
+        self.assertFloatEqual(obs, exp)
+
     def test_summarize_taxonomic_agreement_standard(self):
         """Test writing out the taxonomic agreement for seqs in OTUs."""
         exp = ['A\t3\t\'1\',\'2\',\'3\'\t100.00%\t66.67%\t33.33%\tA\tB,Z\t'
                'C,D,T\n']
-        obs = summarize_taxonomic_agreement(self.otu_map1, self.tax_map1, 3)
+        obs = list(summarize_taxonomic_agreement(self.otu_map1, self.tax_map1,
+                                                 3))
         self.assertEqual(obs, exp)
 
     def test_summarize_taxonomic_agreement_multiple_otus(self):
         """Test writing out the taxonomic agreement for multiple OTUs."""
         exp = ['A\t2\t\'1\',\'2\'\t100.00%\t100.00%\t50.00%\tA\tB\tC,D\n',
                'B\t1\t\'3\'\t100.00%\t100.00%\t100.00%\tA\tZ\tT\n']
-        obs = summarize_taxonomic_agreement(self.otu_map2, self.tax_map1, 3)
+        obs = list(summarize_taxonomic_agreement(self.otu_map2, self.tax_map1,
+                                                 3))
+        self.assertEqual(obs, exp)
+
+    def test_summarize_taxonomic_agreement_parsed_tax_map(self):
+        """Test summarizing against an already-parsed taxonomy map."""
+        tax_map = parse_taxonomic_information(self.tax_map1, 3)
+        self.assertEqual(tax_map, {'1': ['A', 'B', 'C'], '2': ['A', 'B', 'D'],
+                                   '3': ['A', 'Z', 'T']})
+        obs = list(summarize_taxonomic_agreement(self.otu_map2, None, 3,
+                                                 tax_map=tax_map))
+        self.assertEqual(obs, list(summarize_taxonomic_agreement(
+                self.otu_map2, self.tax_map1, 3)))
+
+    def test_summarize_taxonomic_agreement_streaming_inputs(self):
+        """Test summarizing from filepaths, open files and generators."""
+        exp = list(summarize_taxonomic_agreement(self.otu_map2, self.tax_map1,
+                                                 3))
+        fps = []
+        for lines in [self.otu_map2, self.tax_map1]:
+            fd, fp = mkstemp(prefix='summarize_taxonomic_agreement')
+            close(fd)
+            f = open(fp, 'w')
+            f.writelines(lines)
+            f.close()
+            fps.append(fp)
+        try:
+            otu_map_fp, tax_map_fp = fps
+            self.assertEqual(list(summarize_taxonomic_agreement(otu_map_fp,
+                    tax_map_fp, 3)), exp)
+            self.assertEqual(list(summarize_taxonomic_agreement(
+                    open(otu_map_fp, 'U'), open(tax_map_fp, 'U'), 3)), exp)
+            self.assertEqual(compute_taxonomic_agreement_statistics(
+                    open(otu_map_fp, 'U'), tax_map_fp, 3),
+                    compute_taxonomic_agreement_statistics(self.otu_map2,
+                                                           self.tax_map1, 3))
+        finally:
+            for fp in fps:
+                remove(fp)
+
+        otu_map = (line for line in self.otu_map2)
+        tax_map = (line for line in self.tax_map1)
+        obs = summarize_taxonomic_agreement(otu_map, tax_map, 3)
+        self.assertEqual(list(obs), exp)
+
+    def test_sample_otu_members(self):
+        """Test reproducibly sampling the non-reference members of an OTU."""
+        seq_ids = [str(i) for i in range(100)]
+        obs = _sample_otu_members(seq_ids, 10, seed=42)
+        self.assertEqual(len(obs), 10)
+        self.assertFalse('0' in obs)
+        self.assertEqual(obs, sorted(obs, key=int))
+        self.assertEqual(obs, _sample_otu_members(seq_ids, 10, seed=42))
+        self.assertNotEqual(obs, _sample_otu_members(seq_ids, 10, seed=43))
+
+        # The sample is everything if the OTU is small enough.
+        self.assertEqual(_sample_otu_members(['1', '2', '3'], 5), ['2', '3'])
+
+    def test_estimate_otu_taxonomic_agreement(self):
+        """Test estimating taxonomic agreement from a sample of members."""
+        tax_map = {'1': ['A', 'B'], '2': ['A', 'B'], '3': ['A', 'C'],
+                   '4': ['A', 'D'], '5': ['A', 'E']}
+        obs = _estimate_otu_taxonomic_agreement(['1', '2', '3', '4', '5'],
+                                                ['2', '3'], tax_map)
+        self.assertEqual(obs[0], 5)
+        self.assertEqual(obs[1], ['1', '2', '3', '4', '5'])
+        # Level 1: all sampled members agree. Level 2: half of them agree, so
+        # the estimate is (1 + 0.5 * 4) / 5.
+        self.assertFloatEqual(obs[2], [100.0, 60.0])
+        self.assertEqual(obs[3], [['A'], ['B', 'C']])
+        self.assertEqual(len(obs[4]), 2)
+        for (lower, upper), estimate in zip(obs[4], obs[2]):
+            self.assertTrue(20.0 <= lower <= estimate <= upper <= 100.0)
+        self.assertFloatEqual(obs[4][0][1], 100.0)
+
+    def test_summarize_taxonomic_agreement_sampled(self):
+        """Test writing out an approximate taxonomic agreement summary."""
+        # The first OTU is sampled, the second is small enough to be exact.
+        tax_map = ["ID Number\tGenBank Number\tNew Taxon String\tSource\n"]
+        otu_map = ['A\t' + '\t'.join([str(i) for i in range(50)]) + '\n',
+                   'B\t50\t51\n']
+        for i in range(52):
+            tax_map.append('%d\tG%d\tA;%s\tfoo\n' % (i, i, 'BC'[i % 2]))
+        obs = list(summarize_taxonomic_agreement(otu_map, tax_map, 2,
+                                                 sample_size=10, seed=1))
+        self.assertEqual(len(obs), 2)
+        fields = obs[0].strip().split('\t')
+        self.assertEqual(fields[:2], ['A', '50'])
+        self.assertEqual(len(fields[2].split(',')), 50)
+        self.assertEqual(fields[3], '100.00%')
+        self.assertEqual(fields[5], 'A')
+        self.assertEqual(fields[6], 'B,C')
+        # Every sampled member agreed at the first level, but the interval
+        # still reflects the uncertainty from sampling.
+        self.assertTrue(fields[7].endswith('%-100.00%'))
+        self.assertNotEqual(fields[7], '100.00%-100.00%')
+        self.assertEqual(obs, list(summarize_taxonomic_agreement(otu_map,
+                tax_map, 2, sample_size=10, seed=1)))
+        self.assertEqual(obs[1], "B\t2\t'50','51'\t100.00%\t50.00%\tA\tB,C\t"
+                                 "100.00%-100.00%\t50.00%-50.00%\n")
+
+        self.assertRaises(ValueError, list,
+                          summarize_taxonomic_agreement(otu_map, tax_map, 2, 0))
+
+    def test_compute_taxonomic_agreement_statistics(self):
+        """Test computing dataset-level taxonomic agreement statistics."""
+        obs = compute_taxonomic_agreement_statistics(self.otu_map2,
+                self.tax_map1, 3, num_bins=4, agreement_threshold=75.0)
+        self.assertEqual(obs['num_otus'], 2)
+        self.assertEqual(obs['num_seqs'], 3)
+        self.assertFloatEqual(obs['mean_agreement'], [100.0, 100.0, 75.0])
+        self.assertFloatEqual(obs['weighted_mean_agreement'],
+                              [100.0, 100.0, 200.0 / 3])
+        self.assertEqual(obs['histograms'], [[0, 0, 0, 2], [0, 0, 0, 2],
+                                             [0, 0, 1, 1]])
+        self.assertEqual(obs['threshold_level'], 1)
+        self.assertEqual(obs['num_below_threshold'], 0)
+
+        obs = compute_taxonomic_agreement_statistics(self.otu_map2,
+                self.tax_map1, 3, agreement_threshold=75.0, threshold_level=2)
+        self.assertEqual(obs['num_below_threshold'], 1)
+
+    def test_compute_taxonomic_agreement_statistics_empty(self):
+        """Test computing statistics for an empty OTU map."""
+        obs = compute_taxonomic_agreement_statistics([], self.tax_map1, 3,
+                                                     num_bins=2)
+        self.assertEqual(obs['num_otus'], 0)
+        self.assertEqual(obs['mean_agreement'], [0.0, 0.0, 0.0])
+        self.assertEqual(obs['histograms'], [[0, 0], [0, 0], [0, 0]])
+
+    def test_compute_taxonomic_agreement_statistics_invalid(self):
+        """Test computing statistics with invalid parameters."""
+        self.assertRaises(ValueError, compute_taxonomic_agreement_statistics,
+                          self.otu_map2, self.tax_map1, 3, 0)
+        self.assertRaises(ValueError, compute_taxonomic_agreement_statistics,
+                          self.otu_map2, self.tax_map1, 3, 10, 100.0, 3)
+
+    def test_format_taxonomic_agreement_statistics(self):
+        """Test formatting dataset-level taxonomic agreement statistics."""
+        stats = compute_taxonomic_agreement_statistics(self.otu_map2,
+                self.tax_map1, 3, num_bins=2, agreement_threshold=75.0,
+                threshold_level=2)
+        exp = ['# Number of OTUs: 2\n',
+               '# Number of sequences: 3\n',
+               '# OTUs below 75.00% agreement at C: 1\n',
+               'Level\tMean agreement\tSize-weighted mean agreement\t'
+               '0-50%\t50-100%\n',
+               'A\t100.00%\t100.00%\t0\t2\n',
+               'B\t100.00%\t100.00%\t0\t2\n',
+               'C\t75.00%\t66.67%\t0\t2\n']
+        obs = format_taxonomic_agreement_statistics(stats, ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+        obs = format_taxonomic_agreement_statistics(stats)
+        self.assertEqual(obs[2], '# OTUs below 75.00% agreement at Level 3: 1\n')
+
+    def test_update_taxonomic_agreement_summary_unchanged(self):
+        """Test that unchanged OTUs are copied from the previous summary."""
+        # Use a bogus previous summary line so that we can tell it was reused,
+        # and check that the reused line takes on the new OTU ID.
+        previous_summary = ['OTU_ID\tSize\tSeq_IDs\n',
+                            'X\t2\tcopied\n',
+                            'Y\t1\t\'3\'\t100.00%\t100.00%\t100.00%\tA\tZ\tT\n']
+        exp = ['A\t2\tcopied\n',
+               'B\t1\t\'3\'\t100.00%\t100.00%\t100.00%\tA\tZ\tT\n']
+        obs = list(update_taxonomic_agreement_summary(self.otu_map2,
+                self.tax_map1, ["X\t1\t2\n", "Y\t3\n"], previous_summary, [],
+                3))
+        self.assertEqual(obs, exp)
+
+    def test_update_taxonomic_agreement_summary_changed(self):
+        """Test that changed OTUs are recomputed."""
+        previous_summary = ['A\t2\tcopied\n', 'B\t1\tcopied\n']
+
+        # Membership changed for A (different ref) and taxonomy changed for 3.
+        exp = ['A\t2\t\'2\',\'1\'\t100.00%\t100.00%\t50.00%\tA\tB\tD,C\n',
+               'B\t1\t\'3\'\t100.00%\t100.00%\t100.00%\tA\tZ\tT\n']
+        obs = list(update_taxonomic_agreement_summary(
+                ["A\t2\t1\n", "B\t3\n"], self.tax_map1, self.otu_map2,
+                previous_summary, ['3'], 3))
+        self.assertEqual(obs, exp)
+
+        # The result matches a full recompute.
+        self.assertEqual(obs, list(summarize_taxonomic_agreement(
+                ["A\t2\t1\n", "B\t3\n"], self.tax_map1, 3)))
+
+    def test_update_taxonomic_agreement_summary_new_otu(self):
+        """Test that OTUs missing from the previous summary are computed."""
+        exp = ['A\t3\t\'1\',\'2\',\'3\'\t100.00%\t66.67%\t33.33%\tA\tB,Z\t'
+               'C,D,T\n']
+        obs = list(update_taxonomic_agreement_summary(self.otu_map1,
+                self.tax_map1, self.otu_map2, ['A\t2\tcopied\n'], [], 3))
         self.assertEqual(obs, exp)
 
+    def test_summarize_taxonomic_agreement_arrays(self):
+        """Test computing the taxonomic agreement as columnar arrays."""
+        obs = summarize_taxonomic_agreement_arrays(self.otu_map2,
+                                                   self.tax_map1, 3)
+        self.assertEqual(obs['otu_ids'].tolist(), ['A', 'B'])
+        self.assertEqual(obs['sizes'].tolist(), [2, 1])
+        self.assertEqual(obs['agreement'].shape, (2, 3))
+        self.assertEqual(obs['agreement'].dtype.name, 'float32')
+        self.assertFloatEqual(obs['agreement'].tolist(),
+                              [[100.0, 100.0, 50.0], [100.0, 100.0, 100.0]])
+        self.assertEqual(obs['member_ids'].tolist(), ['1', '2', '3'])
+        self.assertEqual(obs['member_offsets'].tolist(), [0, 2, 3])
+        self.assertEqual(obs['encountered_values'].tolist(),
+                         ['A', 'B', 'C', 'D', 'A', 'Z', 'T'])
+        self.assertEqual(obs['encountered_offsets'].tolist(),
+                         [0, 1, 2, 4, 5, 6, 7])
+
+    def test_summarize_taxonomic_agreement_arrays_empty(self):
+        """Test computing columnar arrays for an empty OTU map."""
+        obs = summarize_taxonomic_agreement_arrays([], self.tax_map1, 3)
+        self.assertEqual(obs['agreement'].shape, (0, 3))
+        self.assertEqual(obs['member_offsets'].tolist(), [0])
+        self.assertEqual(obs['encountered_offsets'].tolist(), [0])
+
+    def test_parse_taxonomic_information_on_disk(self):
+        """Test loading the taxonomy into a temporary database."""
+        obs = _parse_taxonomic_information(self.tax_map1, 3, set(['1', '3']),
+                                           on_disk=True)
+        self.assertTrue(isinstance(obs, _DiskTaxonomyMap))
+        self.assertEqual(len(obs), 2)
+        self.assertEqual(obs['1'], ['A', 'B', 'C'])
+        self.assertEqual(obs['3'], ['A', 'Z', 'T'])
+        self.assertTrue('3' in obs)
+        self.assertFalse('2' in obs)
+        self.assertRaises(KeyError, obs.__getitem__, '2')
+        obs.close()
+
+        # Non-ASCII taxonomy is kept as byte strings.
+        tax_map = _DiskTaxonomyMap()
+        tax_map['\xc3\xa9'] = ['A', 'B\xc3\xa9']
+        self.assertEqual(tax_map['\xc3\xa9'], ['A', 'B\xc3\xa9'])
+        tax_map.close()
+
+    def test_summarize_taxonomic_agreement_on_disk(self):
+        """Test that every output is the same with the taxonomy on disk."""
+        self.assertEqual(list(summarize_taxonomic_agreement(self.otu_map2,
+                self.tax_map1, 3, on_disk=True)),
+                list(summarize_taxonomic_agreement(self.otu_map2,
+                                                   self.tax_map1, 3)))
+        self.assertEqual(list(summarize_taxonomic_agreement(self.otu_map1,
+                self.tax_map1, 3, sample_size=1, on_disk=True)),
+                list(summarize_taxonomic_agreement(self.otu_map1,
+                        self.tax_map1, 3, sample_size=1)))
+        self.assertEqual(list(update_taxonomic_agreement_summary(
+                ["A\t2\t1\n", "B\t3\n"], self.tax_map1, self.otu_map2,
+                ['A\t2\tcopied\n', 'B\t1\tcopied\n'], ['3'], 3,
+                on_disk=True)),
+                list(summarize_taxonomic_agreement(["A\t2\t1\n", "B\t3\n"],
+                                                   self.tax_map1, 3)))
+        self.assertEqual(compute_taxonomic_agreement_statistics(self.otu_map2,
+                self.tax_map1, 3, on_disk=True),
+                compute_taxonomic_agreement_statistics(self.otu_map2,
+                                                       self.tax_map1, 3))
+        obs = summarize_taxonomic_agreement_arrays(self.otu_map2,
+                                                   self.tax_map1, 3, True)
+        exp = summarize_taxonomic_agreement_arrays(self.otu_map2,
+                                                   self.tax_map1, 3)
+        for name in exp:
+            self.assertEqual(obs[name].tolist(), exp[name].tolist())
+
+    def test_summarize_taxonomic_agreement_progress(self):
+        """Test that parsing and computing report their progress."""
+        messages = []
+        list(summarize_taxonomic_agreement(self.otu_map2, self.tax_map1, 3,
+                                           progress_callback=messages.append))
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[0].startswith(
+                'Parsing taxonomy: 4 records, 95B, done in 0:00:00'))
+        self.assertTrue(messages[1].startswith(
+                'Computing taxonomic agreement: 2 records, done in 0:00:00'))
+
+        messages = []
+        compute_taxonomic_agreement_statistics(self.otu_map2, self.tax_map1, 3,
+                progress_callback=messages.append)
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[1].startswith(
+                'Computing taxonomic agreement: 2 records'))
+
+    def test_estimate_taxonomic_agreement_memory(self):
+        """Test estimating the memory needed to hold the taxonomy."""
+        self.assertEqual(estimate_taxonomic_agreement_memory(self.tax_map1), 0)
+        fd, tax_map_fp = mkstemp(prefix='nested_reference_otus_tax_map',
+                                 suffix='.txt')
+        close(fd)
+        try:
+            open(tax_map_fp, 'w').write(''.join(self.tax_map1))
+            self.assertEqual(estimate_taxonomic_agreement_memory(tax_map_fp),
+                             4 * len(''.join(self.tax_map1)))
+        finally:
+            remove(tax_map_fp)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+from random import Random
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from numpy import isnan
+from cogent.parse.tree import DndParser
+from cogent.core.tree import PhyloNode
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.tree_cache import (load_tree, parse_newick,
+        tree_arrays, tree_files, write_tree_cache, PreorderTree)
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+def newick(tree, with_distances=True):
+    out_f = StringIO()
+    tree.write_newick(out_f, with_distances)
+    return out_f.getvalue()
+
+def filter_tree(tree_str, tips_to_keep):
+    """qiime.filter.filter_tree, which the workflow used to run"""
+    result = DndParser(tree_str, PhyloNode)
+    def f(node):
+        return (node.istip() and node.Name != None and
+                node.Name not in tips_to_keep)
+    result.removeDeleted(f)
+    result.prune()
+    return result.getNewick(with_distances=True)
+
+def random_newick(rng, num_tips, unnamed_tips=True):
+    """a random tree, with some unnamed nodes and missing lengths
+
+    unnamed tips have no length, as cogent can't parse them with one
+    """
+    def length():
+        if rng.random() < 0.8:
+            return ':%r' % rng.choice([0.0, 0.1, 0.2, 0.3, 1.7])
+        return ''
+    nodes = []
+    for i in range(num_tips):
+        if unnamed_tips and rng.random() < 0.1:
+            nodes.append('')
+        else:
+            nodes.append('t%d%s' % (i, length()))
+    while len(nodes) > 1:
+        num_children = min(rng.choice([1, 2, 2, 2, 3]), len(nodes))
+        start = rng.randrange(len(nodes) - num_children + 1)
+        name = 'n%d' % len(nodes) if rng.random() < 0.3 else ''
+        nodes[start:start + num_children] = ['(%s)%s%s' % (
+                ','.join(nodes[start:start + num_children]), name, length())]
+    return nodes[0] + ';'
+
+class TreeCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp(prefix='tree_cache')
+        self.tree = PreorderTree.from_arrays(tree_arrays(
+                *parse_newick(tree_str)))
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_parse_newick(self):
+        """nodes come out in preorder with their labels and lengths"""
+        parent, names, lengths = parse_newick(tree_str)
+        self.assertEqual(parent.tolist(), [-1, 0, 1, 1, 0, 4, 4, 6, 6])
+        self.assertEqual(names, [None, 'x', 'a', 'b_c', 'y', "d'e", 'z',
+                                 'f', None])
+        self.assertEqual(lengths.tolist()[1:], [0.5, 1.0, 2.0, 0.25, 3.0,
+                                                0.125, 4.0, 5.0])
+        self.assertTrue(isnan(lengths[0]))
+        self.assertRaises(ValueError, parse_newick, '((a,b);')
+        # unnamed tips don't need a length
+        parent, names, lengths = parse_newick('(a,,(b,));')
+        self.assertEqual(parent.tolist(), [-1, 0, 0, 0, 3, 3])
+        self.assertEqual(names, [None, 'a', None, None, 'b', None])
+
+    def test_tree_arrays(self):
+        """subtrees are contiguous and tips are indexed by name"""
+        tree = self.tree
+        self.assertEqual(tree.subtree_end.tolist(),
+                         [9, 4, 3, 4, 9, 6, 9, 8, 9])
+        self.assertEqual(tree.tips().tolist(), [2, 3, 5, 7, 8])
+        self.assertEqual(tree.tip_nodes(['f', 'b_c', 'x', 'q']).tolist(),
+                         [7, 3, -1, -1])
+        self.assertEqual(tree.tip_nodes([]).tolist(), [])
+
+    def test_write_newick(self):
+        """the newick is the same as cogent writes"""
+        exp = DndParser(cogent_tree_str, PhyloNode)
+        obs = PreorderTree.from_arrays(tree_arrays(
+                *parse_newick(cogent_tree_str)))
+        self.assertEqual(newick(obs), exp.getNewick(with_distances=True))
+        self.assertEqual(newick(obs, False), exp.getNewick())
+        self.assertEqual(newick(self.tree),
+                         "((a:1.0,'b_c':2.0)x:0.5,('d''e':3.0,(f:4.0,:5.0)"
+                         "z:0.125)y:0.25);")
+        single = PreorderTree.from_arrays(tree_arrays(*parse_newick('a:1;')))
+        self.assertEqual(newick(single), 'a:1.0;')
+
+    def test_prune(self):
+        """unary nodes are collapsed into their child"""
+        obs = self.tree.prune(['a', 'b_c', 'f'])
+        self.assertEqual(newick(obs),
+                         "((a:1.0,'b_c':2.0)x:0.5,(f:4.0,:5.0)z:0.375);")
+        obs = self.tree.prune(['a', "d'e", 'missing'])
+        self.assertEqual(newick(obs), "(('d''e':3.0,:5.125)y:0.25,a:1.5);")
+        # unnamed tips are always kept
+        self.assertEqual(newick(self.tree.prune([])), '(:5.375);')
+        self.assertEqual(newick(PreorderTree.from_arrays(tree_arrays(
+                *parse_newick('(a:1,b:2);'))).prune([])), ';')
+
+    def test_prune_matches_filter_tree(self):
+        """pruning writes the same newick as qiime's filter_tree"""
+        # the child of a collapsed node moves after its siblings
+        tree_str2 = '((a:1,b:2)x:0.5,(c:3,d:4)y:0.25,e:1)r;'
+        tree = PreorderTree.from_arrays(tree_arrays(*parse_newick(tree_str2)))
+        self.assertEqual(newick(tree.prune(['a', 'c', 'd', 'e'])),
+                         '((c:3.0,d:4.0)y:0.25,e:1.0,a:1.5)r;')
+        self.assertEqual(newick(tree.prune(['a', 'c', 'd', 'e'])),
+                         filter_tree(tree_str2, ['a', 'c', 'd', 'e']))
+
+        rng = Random(42)
+        for i in range(300):
+            unnamed_tips = i % 2 == 0
+            random_str = random_newick(rng, rng.randrange(2, 30),
+                                       unnamed_tips)
+            tree = PreorderTree.from_arrays(tree_arrays(
+                    *parse_newick(random_str)))
+            names = [name for name in tree.names[tree.tips()].tolist()
+                     if name]
+            keep = rng.sample(names, rng.randrange(len(names) + 1))
+            pruned = tree.prune(keep)
+            self.assertEqual(newick(pruned), filter_tree(random_str, keep))
+            # as the workflow does, prune the pruned tree again (cogent can't
+            # parse an unnamed tip or a lone root with a length, so
+            # filter_tree can't either)
+            keep_less = keep[:len(keep) // 2]
+            if unnamed_tips or not keep_less:
+                continue
+            self.assertEqual(newick(pruned.prune(keep_less)),
+                             filter_tree(filter_tree(random_str, keep),
+                                         keep_less))
+
+    def test_cache_round_trip(self):
+        """a tree cache is loaded memory-mapped"""
+        write_tree_cache(StringIO(tree_str), self.cache_dir)
+        tree = load_tree(self.cache_dir)
+        self.assertEqual(newick(tree), newick(self.tree))
+        self.assertEqual(sorted(fp.split('/')[-1] for fp in
+                                tree_files(self.cache_dir)),
+                         ['lengths.npy', 'names.npy', 'parent.npy',
+                          'sorted_tip_names.npy', 'sorted_tip_nodes.npy',
+                          'subtree_end.npy'])
+
+tree_str = """((a:1.0,b_c:2.0)x:0.5,('d''e':3.0,(f:4.0,:5.0)z:0.125)y:0.25);"""
+
+cogent_tree_str = """((a:1,b_c:2)'x:1':0.5,(d:3,(f:4,g)z:0.125)y:0.25)r;"""
+
+if __name__ == '__main__':
+    main()
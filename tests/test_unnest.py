@@ -1,10 +1,19 @@
 #1/usr/bin/env python
 
+from os import mkdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from cogent.core.tree import PhyloNode
 from cogent.util.unit_test import TestCase, main
-from unnest import parse_otu_map, make_nodes, join_nodes
+from unnest import (parse_otu_map, make_nodes, join_nodes,
+        NestedOTUTreeBuilder, build_nested_tree, write_newick, load_otu_map,
+        iter_otu_map, load_otu_maps, level_from_filename,
+        parse_level_manifest, find_workflow_otu_maps,
+        build_nested_tree_from_files, estimate_unnest_memory)
 from StringIO import StringIO
 from cogent.parse.tree import DndParser
+from nested_reference_otus.progress import ProgressReporter
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2012, The QIIME project"
@@ -82,7 +91,174 @@ class UnnestTests(TestCase):
 
         self.assertEqual(obs.getNewick(with_distances=True),
                          expt.getNewick(with_distances=True))
-    
+
+    def test_build_nested_tree(self):
+        """array tree matches join_nodes"""
+        parsed = [(self.clst_99, 0.01, 99),
+                  (self.clst_97, 0.02, 97),
+                  (self.clst_94, 0.03, 94)]
+        tree = build_nested_tree(parsed)
+
+        exp = join_nodes([make_nodes(*p) for p in parsed])
+        self.assertEqual(tree.to_phylonode().getNewick(with_distances=True),
+                         exp.getNewick(with_distances=True))
+
+        # 8 tips + 4 + 3 + 2 clusters + root
+        self.assertEqual(len(tree), 18)
+        self.assertEqual(tree.names[tree.root], None)
+        self.assertEqual(tree.length(tree.root), None)
+        self.assertEqual([tree.names[n] for n in tree.children(tree.root)],
+                         ['94_0_3', '94_1_1'])
+        self.assertEqual([tree.names[n] for n in tree.tips()],
+                         ['3', '8', '7', '1', '6', '10', '20', '30'])
+        self.assertEqual(tree.length(tree.names.index('99_1_1')), 0.01)
+        self.assertEqual(tree.length(tree.names.index('97_1_1')), 0.015)
+        self.assertEqual(tree.length(tree.names.index('94_1_1')), None)
+        self.assertEqual(tree.length(tree.names.index('6')), 0.005)
+
+        for node in tree.preorder():
+            for child in tree.children(node):
+                self.assertEqual(tree.parent[child], node)
+        self.assertEqual(tree.parent[tree.root], -1)
+
+    def test_write_newick(self):
+        """streamed newick matches getNewick"""
+        tree = build_nested_tree([(self.clst_99, 0.01, 99),
+                                  (self.clst_97, 0.02, 97),
+                                  (self.clst_94, 0.03, 94)])
+        exp = tree.to_phylonode()
+        for with_distances in [True, False]:
+            # a tiny buffer forces lots of partial writes
+            for buffer_size in [1, 65536]:
+                out = StringIO()
+                progress = ProgressReporter('Writing')
+                write_newick(tree, out, with_distances, buffer_size,
+                             progress)
+                self.assertEqual(out.getvalue(),
+                                 exp.getNewick(with_distances=with_distances))
+                # every node and byte is counted, however it was buffered
+                self.assertEqual(progress.records, len(tree))
+                self.assertEqual(progress.bytes, len(out.getvalue()))
+
+    def test_write_newick_deep(self):
+        """deep hierarchies don't hit the recursion limit"""
+        builder = NestedOTUTreeBuilder()
+        builder.add_level([('0', ['a', 'b'])], 1.0, 5000)
+        for level in range(4999, 0, -1):
+            builder.add_level([('0', ['a'])], 1.0, level)
+        out = StringIO()
+        write_newick(builder.build(), out)
+        obs = out.getvalue()
+        self.assertTrue(obs.startswith('(' * 5001 + 'a:0.5,b:0.5)'))
+        self.assertTrue(obs.endswith(")'1_0_a');"))
+
+    def test_nested_otu_tree_builder_single_level(self):
+        """a single level tree is just the clusters under a root"""
+        builder = NestedOTUTreeBuilder()
+        builder.add_level(self.clst_94, 6.0, 94)
+        tree = builder.build()
+        self.assertEqual(tree.to_phylonode().getNewick(with_distances=True),
+                join_nodes([make_nodes(self.clst_94, 6.0, 94)]).getNewick(
+                    with_distances=True))
+
+    def _write_maps(self, dir_, fmt):
+        fps = []
+        for level, data in [(99, clst_99), (97, clst_97), (94, clst_94)]:
+            fp = join(dir_, fmt % level)
+            f = open(fp, 'w')
+            f.write(data)
+            f.close()
+            fps.append((level, fp))
+        return fps
+
+    def test_load_otu_map(self):
+        """loaded maps iterate like parse_otu_map"""
+        tmp_dir = mkdtemp(prefix='unnest')
+        try:
+            (level, fp) = self._write_maps(tmp_dir, 'gg_%d_otu_map.txt')[0]
+            loaded = load_otu_map(fp)
+            self.assertEqual(loaded[0], ['0', '1', '2', '3'])
+            self.assertEqual(list(loaded[2]), [0, 3, 5, 6, 8])
+            self.assertEqual(list(iter_otu_map(loaded)), self.clst_99)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_build_nested_tree_from_files(self):
+        """concurrent loading gives the same tree as serial loading"""
+        tmp_dir = mkdtemp(prefix='unnest')
+        try:
+            levels = self._write_maps(tmp_dir, 'gg_%d_otu_map.txt')
+            exp = build_nested_tree([(self.clst_99, 1.0, 99),
+                                     (self.clst_97, 2.0, 97),
+                                     (self.clst_94, 3.0, 94)])
+            exp = exp.to_phylonode().getNewick(with_distances=True)
+            for num_processes in [1, 2]:
+                loaded = list(load_otu_maps([fp for l, fp in levels],
+                                            num_processes))
+                self.assertEqual([list(iter_otu_map(l)) for l in loaded],
+                                 [self.clst_99, self.clst_97, self.clst_94])
+                tree = build_nested_tree_from_files(levels, num_processes)
+                self.assertEqual(
+                    tree.to_phylonode().getNewick(with_distances=True), exp)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_build_nested_tree_from_files_progress(self):
+        """each level reports how many of its OTUs were joined"""
+        tmp_dir = mkdtemp(prefix='unnest')
+        try:
+            levels = self._write_maps(tmp_dir, 'gg_%d_otu_map.txt')
+            messages = []
+            build_nested_tree_from_files(levels,
+                                         progress_callback=messages.append)
+            self.assertEqual([m.split(', done')[0] for m in messages],
+                             ['Joining the 99 OTUs: 4 records',
+                              'Joining the 97 OTUs: 3 records',
+                              'Joining the 94 OTUs: 2 records'])
+        finally:
+            rmtree(tmp_dir)
+
+    def test_estimate_unnest_memory(self):
+        """concurrent loading may hold every map at once"""
+        tmp_dir = mkdtemp(prefix='unnest')
+        try:
+            fps = [fp for l, fp in self._write_maps(tmp_dir, '%d_otu_map.txt')]
+            sizes = [len(clst_99), len(clst_97), len(clst_94)]
+            self.assertEqual(estimate_unnest_memory(fps),
+                             4 * sum(sizes) + 3 * max(sizes))
+            self.assertEqual(estimate_unnest_memory(fps, 2), 7 * sum(sizes))
+            self.assertEqual(estimate_unnest_memory(fps[:1], 2), 7 * sizes[0])
+            self.assertEqual(estimate_unnest_memory([], 2), 0)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_level_from_filename(self):
+        """the level is the first number in the file name"""
+        self.assertEqual(level_from_filename('gg_97_otu_map.txt'), 97)
+        self.assertEqual(level_from_filename('a_b/97_otu_map.txt'), 97)
+        self.assertRaises(ValueError, level_from_filename, 'otu_map.txt')
+
+    def test_parse_level_manifest(self):
+        """manifests are sorted high -> low, relative to base_dir"""
+        manifest = ["# level\tpath\n", "94\tc.txt\n", "\n",
+                    "99\t/a.txt\n", "97\tb.txt\n"]
+        self.assertEqual(parse_level_manifest(manifest, '/maps'),
+                         [(99, '/a.txt'), (97, '/maps/b.txt'),
+                          (94, '/maps/c.txt')])
+
+    def test_find_workflow_otu_maps(self):
+        """finds the OTU maps in the workflow's output directory"""
+        tmp_dir = mkdtemp(prefix='unnest')
+        try:
+            otu_dir = join(tmp_dir, 'otus')
+            mkdir(otu_dir)
+            levels = self._write_maps(otu_dir, '%d_otu_map.txt')
+            open(join(otu_dir, '97_clusters.uc'), 'w').close()
+            self.assertEqual(find_workflow_otu_maps(tmp_dir), levels)
+        finally:
+            rmtree(tmp_dir)
+        self.assertRaises(OSError, find_workflow_otu_maps, tmp_dir)
+
 clst_99 = """0	10	20	30
 1	1	6
 2	3
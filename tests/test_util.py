@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012, The QIIME project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "1.5.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+__status__ = "Development"
+
+"""Test suite for the util.py module."""
+
+from gzip import GzipFile
+from os import link
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import array, float32, memmap
+from cogent.util.unit_test import TestCase, main
+from nested_reference_otus.util import (load_arrays, open_output,
+        parse_size, save_arrays)
+
+class UtilTests(TestCase):
+    """Tests for the util.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.output_dir = mkdtemp(prefix='nested_reference_otus_util')
+        self.arrays = {'ids': array(['a', 'bb', 'ccc']),
+                       'values': array([[1.5, 2.0], [3.0, 4.25]],
+                                       dtype=float32)}
+
+    def tearDown(self):
+        """Remove the temporary output directory."""
+        rmtree(self.output_dir)
+
+    def test_open_output(self):
+        """Test writing plain and gzip-compressed output."""
+        fp = join(self.output_dir, 'out.txt')
+        out_f = open_output(fp)
+        out_f.write('foo\nbar\n')
+        out_f.close()
+        self.assertEqual(open(fp).read(), 'foo\nbar\n')
+
+        fp = join(self.output_dir, 'out.txt.gz')
+        out_f = open_output(fp)
+        out_f.write('foo\nbar\n')
+        out_f.close()
+        self.assertEqual(GzipFile(fp).read(), 'foo\nbar\n')
+
+        # A hardlinked file is replaced, leaving the other link alone.
+        fp = join(self.output_dir, 'out.txt')
+        link_fp = join(self.output_dir, 'link.txt')
+        link(fp, link_fp)
+        out_f = open_output(fp)
+        out_f.write('baz\n')
+        out_f.close()
+        self.assertEqual(open(fp).read(), 'baz\n')
+        self.assertEqual(open(link_fp).read(), 'foo\nbar\n')
+
+    def test_save_load_arrays(self):
+        """Test that arrays survive a round trip through the filesystem."""
+        save_arrays(self.output_dir, self.arrays)
+        obs = load_arrays(self.output_dir)
+        self.assertEqual(sorted(obs.keys()), ['ids', 'values'])
+        self.assertEqual(obs['ids'].tolist(), ['a', 'bb', 'ccc'])
+        self.assertEqual(obs['values'].tolist(), [[1.5, 2.0], [3.0, 4.25]])
+        self.assertEqual(obs['values'].dtype.name, 'float32')
+        self.assertTrue(isinstance(obs['values'], memmap))
+
+    def test_load_arrays_in_memory(self):
+        """Test loading arrays without memory-mapping them."""
+        save_arrays(self.output_dir, self.arrays)
+        obs = load_arrays(self.output_dir, mmap_mode=None)
+        self.assertFalse(isinstance(obs['values'], memmap))
+        self.assertEqual(obs['ids'].tolist(), ['a', 'bb', 'ccc'])
+
+    def test_parse_size(self):
+        """Test parsing sizes with and without units."""
+        self.assertEqual(parse_size('1048576'), 1048576)
+        self.assertEqual(parse_size(2048), 2048)
+        self.assertEqual(parse_size('500M'), 500 * 1024 ** 2)
+        self.assertEqual(parse_size('20gb'), 20 * 1024 ** 3)
+        self.assertEqual(parse_size('1.5K'), 1536)
+        self.assertEqual(parse_size(' 2T '), 2 * 1024 ** 4)
+        self.assertRaises(ValueError, parse_size, '20X')
+        self.assertRaises(ValueError, parse_size, '')
+        self.assertRaises(ValueError, parse_size, '-5M')
+
+
+if __name__ == "__main__":
+    main()